@@ -1,12 +1,26 @@
 import os
+import hmac
 import streamlit as st
+import asyncio
 import concurrent.futures
 import time
-from PIL import Image
 from datetime import datetime
 import j           # <-- Backend for Medicine
 import j_surgery   # <-- Backend for General Surgery
 import obs         # <-- Backend for OBGYN (NEW)
+import token_cache # <-- Shared Google credentials (loaded once per process)
+import export_cache # <-- Shared .docx byte cache (exports are lazy / prefetched)
+import session_store # <-- Spills uploads to disk, per-session memory cap
+import doc_patch   # <-- Edit & Regenerate: patches fields of an existing summary
+import page_cache  # <-- Per-page transcripts of earlier uploads
+import transcribe  # <-- Two-stage mode: pages transcribed in parallel, then one text call
+import preprocess  # <-- PDF / TIFF pages, blank + duplicate filter, auto-crop
+import pipeline_async # <-- ASYNC_PIPELINE=1: cases run as coroutines on one shared event loop
+import template_pool # <-- Warm pool of ready template copies per department
+import metrics_store # <-- Per-job throughput / latency / cost rows for the admin page
+import resilience  # <-- Circuit breaker state for the admin page
+import profiling   # <-- PROFILE_EVERY=N: every Nth case profiled (flame graph / pstats)
+import structured_log # <-- JSON-lines logs tagged with case ID / department / stage
 
 # --- AUTHENTICATION FIREWALL ---
 if "GOOGLE_TOKEN" in st.secrets:
@@ -16,10 +30,20 @@ if "GOOGLE_TOKEN" in st.secrets:
         f.write(secret_value)
         f.flush()
         os.fsync(f.fileno()) # <--- This forces the write instantly
+
+# Load the token in the background now, so the first case doesn't wait for it
+token_cache.warm_up()
+# Keep ready copies of every department template (only with TEMPLATE_STAGING_FOLDER_ID set)
+template_pool.warm_up([j.MASTER_TEMPLATE_ID, j_surgery.MASTER_TEMPLATE_ID, obs.MASTER_TEMPLATE_ID], j.get_user_credentials)
+# Delete "~ In progress" copies that an earlier run left behind mid-case (once per process)
+template_pool.sweep_leftovers([j.OUTPUT_FOLDER_ID, j_surgery.OUTPUT_FOLDER_ID, obs.OUTPUT_FOLDER_ID], j.get_user_credentials)
     
 if "OPENAI_KEY" in st.secrets:
     os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_KEY"]
 
+# Admin dashboard: error texts can name patients' documents - only with a password set
+ADMIN_PASSWORD = st.secrets["ADMIN_PASSWORD"] if "ADMIN_PASSWORD" in st.secrets else os.getenv("ADMIN_PASSWORD")
+
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
     page_title="AI Medical Scribe",
@@ -95,8 +119,38 @@ if 'active_jobs' not in st.session_state: st.session_state.active_jobs = {}
 if 'executor' not in st.session_state:
     st.session_state.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
+if 'store' not in st.session_state:
+    session_store.purge_stale()  # New session - clear out folders from dead ones
+    st.session_state.store = session_store.SessionStore()
+
+DEBUG_MODE = os.getenv("SCRIBE_DEBUG") == "1" or st.query_params.get("debug") == "1"
+
+# Backend module by name (finished cases remember which one wrote them)
+BACKENDS = {"j": j, "j_surgery": j_surgery, "obs": obs}
+
+log = structured_log.get_logger("app")  # Streamlit runs this file as __main__
+
+TWO_STAGE_HELP = ("Each page is transcribed separately, all at once, then the summary is written from the text. "
+                  "Faster for long notes, and pages uploaded again on a later day are not re-read.")
+AUTO_CROP_HELP = ("Cuts each photo down to the sheet of paper and straightens it before the AI sees it. "
+                  "Fewer pixels = cheaper and faster. Best for lab printouts photographed on a desk.")
+
 # --- HELPER FUNCTIONS ---
 def go_home(): st.session_state.page = 'home'
+
+def admin_unlocked():
+    """Password prompt for the admin page. True once this session has entered ADMIN_PASSWORD."""
+    if not ADMIN_PASSWORD:
+        return False
+    if st.session_state.get('admin_ok'):
+        return True
+    password = st.text_input("Admin password", type="password")
+    if password:
+        if hmac.compare_digest(password.encode(), str(ADMIN_PASSWORD).encode()):
+            st.session_state.admin_ok = True
+            st.rerun()
+        st.error("Wrong password.")
+    return False
 def go_medicine(): st.session_state.page = 'medicine'
 
 def add_case():
@@ -107,8 +161,13 @@ def remove_case(case_id):
     if case_id in st.session_state.cases: st.session_state.cases.remove(case_id)
     if case_id in st.session_state.results: del st.session_state.results[case_id]
     if case_id in st.session_state.active_jobs: del st.session_state.active_jobs[case_id]
+    st.session_state.store.release(case_id)
     st.rerun()
 
+def fetch_docx(doc_id, revision):
+    # We use j.export_docx because the file ID is universal on Drive
+    return export_cache.get_docx(doc_id, revision, j.export_docx)
+
 def save_feedback(text):
     try:
         return j.save_feedback_online(text)
@@ -116,13 +175,231 @@ def save_feedback(text):
         return False
 
 # THE BACKGROUND TASK (GENERIC)
-# We pass the 'module' (j or j_surgery) to this function now
-def background_task(images, model, backend_module):
+# We pass the 'module' (j or j_surgery) to this function now.
+# Only file paths are captured by the future - the pages are decoded here, on
+# the worker, and freed the moment the run is over. The files stay on disk for
+# "Re-extract Section" until the case is deleted or started over.
+def prepare_pages(image_paths, auto_crop=None):
+    images = session_store.open_images(image_paths)
+    # Blank backs of sheets and double shots never reach Gemini
+    images, dropped = preprocess.drop_redundant(images)
+    if preprocess.crop_enabled(auto_crop):
+        images = preprocess.crop_pages(images)
+    return images, dropped
+
+# Log lines of a case carry "<session>-<case>" as case_id, whichever thread or task writes them
+def log_case(store, case_id, backend_module):
+    return structured_log.case(case_id=f"{store.session_id[:8]}-{case_id}", department=backend_module.__name__)
+
+def background_task(image_paths, model, backend_module, store, case_id, two_stage=None, auto_crop=None):
+    images = []
+    with log_case(store, case_id, backend_module):
+        try:
+            images, dropped = prepare_pages(image_paths, auto_crop)
+            # Call run_pipeline on the specific backend (j or j_surgery)
+            result = backend_module.run_pipeline(images, model_choice=model, two_stage=two_stage)
+            if isinstance(result, dict):
+                result.update(backend=backend_module.__name__, model=model, dropped=dropped, auto_crop=auto_crop)
+            return result
+        except Exception as e:
+            log.error("Case failed", error=e)
+            return {"error": str(e)}
+        finally:
+            session_store.close_images(images)
+            store.finish(case_id)
+
+# Same job on the shared event loop (ASYNC_PIPELINE=1): no worker thread waits on Gemini
+async def background_task_async(image_paths, model, backend_module, store, case_id, two_stage=None, auto_crop=None):
+    images = []
+    with log_case(store, case_id, backend_module):
+        try:
+            # Decoding and the page filters are CPU work - off the loop
+            images, dropped = await asyncio.to_thread(prepare_pages, image_paths, auto_crop)
+            result = await backend_module.run_pipeline_async(images, model_choice=model, two_stage=two_stage)
+            if isinstance(result, dict):
+                result.update(backend=backend_module.__name__, model=model, dropped=dropped, auto_crop=auto_crop)
+            return result
+        except Exception as e:
+            log.error("Case failed", error=e)
+            return {"error": str(e)}
+        finally:
+            session_store.close_images(images)
+            store.finish(case_id)
+
+# EDIT & REGENERATE: patch the existing document instead of starting over
+def patch_task(backend_module, res, changes):
+    with structured_log.case(department=backend_module.__name__):
+        try:
+            return doc_patch.apply_patch(backend_module, res['id'], res['fields'], changes)
+        except Exception as e:
+            log.error("Patch failed", document_id=res['id'], error=e)
+            return {"error": str(e)}
+
+def reextract_task(backend_module, res, placeholders, store, case_id):
+    image_paths = store.checkout(case_id)
+    if not image_paths:
+        return {"error": "The note pages were cleared to make room. Use Start Over to upload them again."}
+    images = []
+    with log_case(store, case_id, backend_module):
+        try:
+            images, _ = preprocess.drop_redundant(session_store.open_images(image_paths))
+            if preprocess.crop_enabled(res.get('auto_crop')):
+                images = preprocess.crop_pages(images)
+            return doc_patch.reextract_section(backend_module, images, res['id'], res['fields'], placeholders,
+                                               model_choice=res.get('model', "Gemini 2.5 Pro"))
+        except Exception as e:
+            log.error("Re-extraction failed", document_id=res['id'], error=e)
+            return {"error": str(e)}
+        finally:
+            session_store.close_images(images)
+            store.finish(case_id)
+
+def submit_edit(case_id, task, *args):
+    job = metrics_store.metrics.submit(args[0].__name__, kind=task.__name__.replace("_task", ""))
+    future = st.session_state.executor.submit(metrics_store.tracked(job, task), *args)
+    st.session_state.active_jobs[case_id] = future
+    st.rerun()
+
+def edit_panel(case_id, res):
+    backend_module = BACKENDS.get(res.get('backend'))
+    fields = res.get('fields')
+    if not backend_module or not fields:
+        return
+    label = lambda placeholder: placeholder.strip("{}").replace("_", " ").title()
+
+    with st.expander("✏️ Edit & Regenerate"):
+        st.caption("Changes go straight into the existing document - nothing else is regenerated.")
+        field = st.selectbox("Field", list(fields), format_func=label, key=f"edit_f_{case_id}")
+        # The revision in the key reloads the box after every update
+        new_text = st.text_area("Text", value=fields[field], height=150, key=f"edit_v_{case_id}_{field}_{res.get('revision')}")
+        if st.button("💾 Update Document", key=f"edit_save_{case_id}"):
+            if new_text.strip() != fields[field]:
+                submit_edit(case_id, patch_task, backend_module, res, {field: new_text.strip()})
+            else:
+                st.info("Nothing changed.")
+
+        groups = getattr(backend_module, "PLACEHOLDER_GROUPS", {})
+        if groups:
+            st.write("---")
+            group = st.selectbox("Re-read one section from the notes", list(groups), key=f"edit_g_{case_id}")
+            has_pages = st.session_state.store.has_pages(case_id)
+            if st.button("🔁 Re-extract Section", key=f"edit_rx_{case_id}", disabled=not has_pages):
+                submit_edit(case_id, reextract_task, backend_module, res, groups[group], st.session_state.store, case_id)
+            if not has_pages:
+                st.caption("The note pages were cleared to make room - use Start Over to upload them again.")
+
+def submit_case(case_id, uploaded_files, model, backend_module, two_stage=None, auto_crop=None):
+    store = st.session_state.store
     try:
-        # Call run_pipeline on the specific backend (j or j_surgery)
-        return backend_module.run_pipeline(images, model_choice=model)
-    except Exception as e:
-        return {"error": str(e)}
+        image_paths = store.spill_uploads(case_id, uploaded_files)
+    except session_store.SessionLimitError as e:
+        st.warning(f"⚠️ {e}")
+        return
+    except OSError as e:
+        st.error(f"❌ Could not save uploads: {e}")
+        return
+    args = (image_paths, model, backend_module, store, case_id, two_stage, auto_crop)
+    job = metrics_store.metrics.submit(backend_module.__name__)
+    label = f"{backend_module.__name__}-case{case_id}"
+    if pipeline_async.enabled():
+        task = profiling.profiled_async(background_task_async, label)
+        future = pipeline_async.submit(metrics_store.tracked_async(job, task)(*args))
+    else:
+        task = profiling.profiled(background_task, label)
+        future = st.session_state.executor.submit(metrics_store.tracked(job, task), *args)
+    st.session_state.active_jobs[case_id] = future
+    st.rerun()
+
+def debug_panel():
+    mb = lambda n: f"{(n or 0) / (1024 * 1024):.1f} MB"
+    with st.sidebar.expander("🛠️ Memory (debug)", expanded=True):
+        st.metric("Process RSS", mb(session_store.process_rss()))
+        store_stats = st.session_state.store.stats()
+        st.write(f"**Session {store_stats['session']}:** {store_stats['pending_cases']} pending case(s), "
+                 f"{store_stats['kept_cases']} finished with pages kept, "
+                 f"{mb(store_stats['bytes'])} of {mb(store_stats['max_bytes'])} spilled uploads")
+        st.write(f"**Cases:** {len(st.session_state.cases)} open, {len(st.session_state.active_jobs)} running, "
+                 f"{len(st.session_state.results)} finished")
+        cache_stats = export_cache.docx_cache.stats()
+        st.write(f"**.docx cache:** {cache_stats['items']} in memory ({mb(cache_stats['bytes'])} of {mb(cache_stats['max_bytes'])}), "
+                 f"{cache_stats['spilled_items']} on disk ({mb(cache_stats['spilled_bytes'])}), "
+                 f"{cache_stats['hits']} hits / {cache_stats['misses']} misses")
+        pages = page_cache.page_cache.stats()
+        st.write(f"**Page cache:** {pages['pages']} page(s) loaded, {pages['hits']} hits / {pages['misses']} misses")
+        if template_pool.pool.enabled():
+            pool_stats = template_pool.pool.stats()
+            st.write(f"**Template pool:** {sum(pool_stats['ready'].values())} ready ({pool_stats['size']} per department), "
+                     f"{pool_stats['hits']} claimed / {pool_stats['misses']} copied on demand")
+
+# --- ADMIN DASHBOARD FRAGMENT ---
+DEPARTMENT_NAMES = {"j": "Medicine", "j_surgery": "Surgery", "obs": "OBGYN"}
+
+@st.fragment(run_every=10)
+def admin_dashboard(hours):
+    name = lambda backend: DEPARTMENT_NAMES.get(backend, backend)
+    live = metrics_store.metrics.live()
+    summary = metrics_store.metrics.summary(hours)
+
+    # Live: what the workers are doing right now (every session of this process)
+    cols = st.columns(4)
+    cols[0].metric("Waiting for a worker", sum(v["queued"] for v in live.values()))
+    cols[1].metric("Running", sum(v["active"] for v in live.values()))
+    jobs = sum(v["jobs"] for v in summary.values())
+    errors = sum(v["errors"] for v in summary.values())
+    cols[2].metric(f"Jobs ({hours} h)", jobs, f"{errors} failed" if errors else None, delta_color="inverse")
+    cols[3].metric(f"Spend ({hours} h)", f"₹{sum(v['cost'] for v in summary.values()):.2f}")
+
+    if live:
+        st.caption("  |  ".join(f"**{name(b)}**: {v['active']} running, {v['queued']} waiting" for b, v in live.items()))
+
+    if not summary:
+        st.info("No finished jobs in this window yet.")
+        return
+
+    st.subheader("Per department")
+    rows = []
+    for backend, v in sorted(summary.items()):
+        service = v["gemini"] + v["drive"] + v["docs"]
+        rows.append({
+            "Department": name(backend),
+            "Jobs": v["jobs"],
+            "Cases/hour": round(v["cases"] / hours, 2),
+            "p50 (s)": round(v["p50"], 1),
+            "p95 (s)": round(v["p95"], 1),
+            "Error rate": f"{v['error_rate']:.0%}",
+            "Gemini share": f"{v['gemini'] / service:.0%}" if service else "-",
+            "Drive + Docs share": f"{(v['drive'] + v['docs']) / service:.0%}" if service else "-",
+            "Avg worker wait (s)": round(v["worker_wait"] / v["jobs"], 1),
+            "Avg quota wait (s)": round(v["quota"] / v["jobs"], 1),
+            "Spend (₹)": round(v["cost"], 2),
+        })
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+
+    st.subheader("Throughput per hour")
+    hourly = metrics_store.metrics.hourly(hours)
+    backends = sorted({b for counts in hourly.values() for b in counts})
+    hours_axis = sorted(hourly)
+    st.bar_chart({
+        "hour": [datetime.fromtimestamp(h).strftime("%d %b %H:00") for h in hours_axis],
+        **{name(b): [hourly[h].get(b, 0) for h in hours_axis] for b in backends},
+    }, x="hour")
+
+    st.subheader("Google services")
+    breakers = resilience.get_metrics()
+    st.dataframe([{
+        "Service": service,
+        "Circuit": m["circuit"],
+        "Calls": m["calls"],
+        "Failures": m["failures"],
+        "Retries": m["retries"],
+        "Avg call (s)": round(m["total_seconds"] / m["calls"], 2) if m["calls"] else 0.0,
+    } for service, m in breakers.items()], use_container_width=True, hide_index=True)
+
+    failures = metrics_store.metrics.recent_errors()
+    if failures:
+        with st.expander(f"Recent errors ({len(failures)})"):
+            for finished, backend, kind, error in failures:
+                st.write(f"`{datetime.fromtimestamp(finished):%d %b %H:%M}` **{name(backend)}** ({kind}): {error}")
 
 # --- STATUS MONITOR FRAGMENT ---
 @st.fragment(run_every=2)
@@ -131,15 +408,20 @@ def status_monitor(case_id):
         future = st.session_state.active_jobs[case_id]
         if future.done():
             data = future.result()
+            # An Edit & Regenerate job runs on a case that already has a document
+            previous = st.session_state.results.get(case_id, {})
+            editing = "id" in previous
             
             if isinstance(data, str):
                 st.session_state.results[case_id] = {"error": data}
+            elif "error" in data and editing:
+                # The document is still there - keep it and show what went wrong
+                st.session_state.results[case_id] = dict(previous, notice=f"⚠️ Update failed: {data['error']}")
             elif "error" in data:
                  st.session_state.results[case_id] = {"error": data['error']}
             else:
-                # Success!
-                # We use j.export_docx because the file ID is universal on Drive
-                file_bytes = j.export_docx(data['id'])
+                # Success! Prefetch the .docx in the background - never on this UI thread
+                st.session_state.executor.submit(fetch_docx, data['id'], data.get('revision'))
                 
                 cost_info = data.get('cost', "N/A")
                 if cost_info != "N/A":
@@ -147,13 +429,29 @@ def status_monitor(case_id):
 
                 st.session_state.results[case_id] = {
                     "link": data['link'],
-                    "name": data['name'],
-                    "bytes": file_bytes,
-                    "cost": cost_info 
+                    "name": data.get('name', previous.get('name')),
+                    "id": data['id'],
+                    "revision": data.get('revision'),
+                    "cost": cost_info,
+                    "queue_wait": data.get('queue_wait', 0),
+                    "fields": data.get('fields', {}),
+                    "backend": data.get('backend', previous.get('backend')),
+                    "model": data.get('model', previous.get('model')),
+                    "dropped": data.get('dropped', previous.get('dropped', [])),
+                    "auto_crop": data.get('auto_crop', previous.get('auto_crop')),
+                    "profile": data.get('profile', previous.get('profile'))
                 }
+                if data.get('skipped'):
+                    names = ", ".join(p.strip("{}") for p in data['skipped'])
+                    st.session_state.results[case_id]["notice"] = (
+                        f"⚠️ Not updated (the text was changed by hand in Docs?): {names}")
+                elif editing:
+                    st.toast(f"✏️ Updated {len(data.get('patched', []))} field(s)")
             
             del st.session_state.active_jobs[case_id]
             st.rerun()
+        elif case_id in st.session_state.results:
+            st.markdown(f"<div class='processing-badge'>✏️ Updating the document for Case {case_id}...</div>", unsafe_allow_html=True)
         else:
             st.markdown(f"<div class='processing-badge'>⏳ AI is working on Case {case_id}...</div>", unsafe_allow_html=True)
     
@@ -164,27 +462,49 @@ def status_monitor(case_id):
             st.error(res['error'])
         else:
             st.success("✅ Ready!")
+            if res.get('queue_wait', 0) >= 1:
+                st.caption(f"⏳ Waited {res['queue_wait']}s in the shared Gemini/Google quota queue")
+            if res.get('dropped'):
+                st.caption(f"🧹 Not sent to the AI: {preprocess.describe_dropped(res['dropped'])}")
+            if res.get('profile') and os.path.exists(res['profile']):
+                # This case was picked for profiling (PROFILE_EVERY / admin page)
+                with open(res['profile'], 'rb') as f:
+                    st.download_button("🔥 Download profile", f.read(), file_name=os.path.basename(res['profile']),
+                                       key=f"profile_{case_id}")
             
             c1, c2 = st.columns([1, 1])
             with c1:
                 st.markdown(f"📄 **[Preview]({res['link']})**")
             with c2:
-                if res['bytes']:
+                # Bytes come from the shared cache (prefetched), not from session state
+                file_bytes = export_cache.docx_cache.get((res['id'], res.get('revision')))
+                if file_bytes:
                     st.download_button(
                         label="⬇️ Download Doc",
-                        data=res['bytes'],
+                        data=file_bytes,
                         file_name=f"{res['name']}.docx",
                         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                         key=f"dl_{case_id}",
                         use_container_width=True
                     )
-                else:
-                    st.warning("Download unavailable")
+                elif st.button("📥 Prepare Download", key=f"prep_{case_id}", use_container_width=True):
+                    # Prefetch still running or evicted from the cache - export now
+                    with st.spinner("Exporting .docx..."):
+                        file_bytes = fetch_docx(res['id'], res.get('revision'))
+                    if file_bytes: st.rerun()
+                    else: st.warning("Download unavailable")
+
+            if res.get('notice'):
+                st.warning(res['notice'])
+            edit_panel(case_id, res)
 
         if st.button("🔄 Start Over", key=f"restart_{case_id}"):
             del st.session_state.results[case_id]
+            st.session_state.store.release(case_id)
             st.rerun()
 
+if DEBUG_MODE: debug_panel()
+
 # =========================================================
 # PAGE 1: HOME
 # =========================================================
@@ -210,6 +530,48 @@ if st.session_state.page == 'home':
             st.session_state.page = 'obgyn'
             st.rerun()
 
+    if ADMIN_PASSWORD:
+        st.write("---")
+        if st.button("📊 Admin: throughput & errors"):
+            st.session_state.page = 'admin'
+            st.rerun()
+
+# =========================================================
+# PAGE 5: ADMIN DASHBOARD (live load, latency, errors, spend)
+# =========================================================
+elif st.session_state.page == 'admin':
+    c1, c2 = st.columns([1, 6])
+    with c1:
+        if st.button("⬅️ Home"): go_home(); st.rerun()
+    with c2:
+        st.markdown("## 📊 System Dashboard")
+
+    if not admin_unlocked():
+        st.stop()
+
+    window = st.radio("Window", [1, 6, 24, 24 * 7], index=2, horizontal=True,
+                      format_func=lambda h: f"{h} h" if h < 48 else f"{h // 24} days")
+    admin_dashboard(window)
+
+    # Still behind the admin password (st.stop() above): this changes every session and department
+    with st.expander("🔥 Profiling"):
+        st.caption("Picked cases run under a profiler; the file is offered on the case card and kept in "
+                   f"`{profiling.profiler.folder}`. Mode: **{profiling.profiler.mode}** (PROFILE_MODE). "
+                   "Applies to every department and every user of this server.")
+        every = st.number_input("Profile every Nth case (0 = off)", min_value=0, step=1, value=profiling.profiler.every)
+        if every != profiling.profiler.every:
+            confirm = "Turn profiling off" if every == 0 else f"Profile every {every} case(s) for everyone"
+            if st.button(f"✅ {confirm}"):
+                profiling.profiler.set_every(every)
+                log.info("Profiling changed", every=every)
+                st.toast("🔥 Profiling off" if every == 0 else f"🔥 Profiling every {every} case(s)")
+        for path in profiling.profiler.recent():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue  # Pruned since recent() listed it
+            st.write(f"`{os.path.basename(path)}` ({size / 1024:.0f} KB)")
+
 # =========================================================
 # PAGE 2: MEDICINE DASHBOARD
 # =========================================================
@@ -232,21 +594,20 @@ elif st.session_state.page == 'medicine':
             status_monitor(case_id)
 
             if case_id not in st.session_state.results and case_id not in st.session_state.active_jobs:
-                uploaded_files = st.file_uploader(f"Upload Notes", type=["jpg","png","jpeg"], key=f"up_{case_id}", accept_multiple_files=True)
+                uploaded_files = st.file_uploader(f"Upload Notes", type=preprocess.UPLOAD_TYPES, key=f"up_{case_id}", accept_multiple_files=True)
                 
                 st.write("") 
                 model = st.radio("Select Intelligence:", ("Gemini 2.5 Flash (Fast)", "Gemini 2.5 Pro (Best)"), index=1, key=f"mod_{case_id}")
                 model_clean = "Gemini 2.5 Flash" if "Flash" in model else "Gemini 2.5 Pro"
+                two_stage = st.checkbox("🧩 Two-stage (read pages in parallel)", value=transcribe.enabled(), key=f"ts_{case_id}", help=TWO_STAGE_HELP)
+                auto_crop = st.checkbox("✂️ Auto-crop pages", value=preprocess.crop_enabled(), key=f"crop_{case_id}", help=AUTO_CROP_HELP)
 
                 if st.button(f"⚡ Process Medicine", key=f"btn_{case_id}", type="primary"):
                     if uploaded_files:
-                        pil_images = [Image.open(f) for f in uploaded_files]
                         # CALLS 'j' (MEDICINE BACKEND)
-                        future = st.session_state.executor.submit(background_task, pil_images, model_clean, j)
-                        st.session_state.active_jobs[case_id] = future
-                        st.rerun()
+                        submit_case(case_id, uploaded_files, model_clean, j, two_stage, auto_crop)
                     else:
-                        st.warning("⚠️ Upload images first")
+                        st.warning("⚠️ Upload the notes first (photos, PDF or TIFF)")
 
             st.markdown("</div>", unsafe_allow_html=True)
 
@@ -288,25 +649,22 @@ elif st.session_state.page == 'surgery':
 
             if case_id not in st.session_state.results and case_id not in st.session_state.active_jobs:
                 # Unique key 'up_s_'
-                uploaded_files = st.file_uploader(f"Upload Surgery Notes", type=["jpg","png","jpeg"], key=f"up_s_{case_id}", accept_multiple_files=True)
+                uploaded_files = st.file_uploader(f"Upload Surgery Notes", type=preprocess.UPLOAD_TYPES, key=f"up_s_{case_id}", accept_multiple_files=True)
                 
                 st.write("") 
                 # Unique key 'mod_s_'
                 model = st.radio("Select Intelligence:", ("Gemini 2.5 Flash", "Gemini 2.5 Pro"), index=1, key=f"mod_s_{case_id}")
                 model_clean = "Gemini 2.5 Flash" if "Flash" in model else "Gemini 2.5 Pro"
+                two_stage = st.checkbox("🧩 Two-stage (read pages in parallel)", value=transcribe.enabled(), key=f"ts_s_{case_id}", help=TWO_STAGE_HELP)
+                auto_crop = st.checkbox("✂️ Auto-crop pages", value=preprocess.crop_enabled(), key=f"crop_s_{case_id}", help=AUTO_CROP_HELP)
 
                 # Unique key 'btn_s_'
                 if st.button(f"⚡ Generate Surgery Discharge", key=f"btn_s_{case_id}", type="primary"):
                     if uploaded_files:
-                        pil_images = [Image.open(f) for f in uploaded_files]
-                        
                         # --- CRITICAL CHANGE: CALLS 'j_surgery' BACKEND ---
-                        future = st.session_state.executor.submit(background_task, pil_images, model_clean, j_surgery)
-                        
-                        st.session_state.active_jobs[case_id] = future
-                        st.rerun()
+                        submit_case(case_id, uploaded_files, model_clean, j_surgery, two_stage, auto_crop)
                     else:
-                        st.warning("⚠️ Upload images first")
+                        st.warning("⚠️ Upload the notes first (photos, PDF or TIFF)")
 
             st.markdown("</div>", unsafe_allow_html=True)
 
@@ -364,23 +722,20 @@ elif st.session_state.page == 'obgyn':
 
             if case_id not in st.session_state.results and case_id not in st.session_state.active_jobs:
                 # Unique key 'up_o_'
-                uploaded_files = st.file_uploader(f"Upload OBGYN Notes", type=["jpg","png","jpeg"], key=f"up_o_{case_id}", accept_multiple_files=True)
+                uploaded_files = st.file_uploader(f"Upload OBGYN Notes", type=preprocess.UPLOAD_TYPES, key=f"up_o_{case_id}", accept_multiple_files=True)
                 
                 st.write("") 
                 model = st.radio("Select Intelligence:", ("Gemini 2.5 Flash", "Gemini 2.5 Pro"), index=1, key=f"mod_o_{case_id}")
                 model_clean = "Gemini 2.5 Flash" if "Flash" in model else "Gemini 2.5 Pro"
+                two_stage = st.checkbox("🧩 Two-stage (read pages in parallel)", value=transcribe.enabled(), key=f"ts_o_{case_id}", help=TWO_STAGE_HELP)
+                auto_crop = st.checkbox("✂️ Auto-crop pages", value=preprocess.crop_enabled(), key=f"crop_o_{case_id}", help=AUTO_CROP_HELP)
 
                 if st.button(f"⚡ Generate OBGYN Discharge", key=f"btn_o_{case_id}", type="primary"):
                     if uploaded_files:
-                        pil_images = [Image.open(f) for f in uploaded_files]
-                        
                         # --- CALLS 'obs' BACKEND HERE ---
-                        future = st.session_state.executor.submit(background_task, pil_images, model_clean, obs)
-                        
-                        st.session_state.active_jobs[case_id] = future
-                        st.rerun()
+                        submit_case(case_id, uploaded_files, model_clean, obs, two_stage, auto_crop)
                     else:
-                        st.warning("⚠️ Upload images first")
+                        st.warning("⚠️ Upload the notes first (photos, PDF or TIFF)")
 
             st.markdown("</div>", unsafe_allow_html=True)
 
@@ -0,0 +1 @@
+# Offline benchmarks for the discharge pipelines (see bench_pipeline.py).
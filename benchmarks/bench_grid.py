@@ -0,0 +1,142 @@
+import sys
+import random
+import timeit
+import argparse
+
+import grid_fill
+from benchmarks import fakes
+from benchmarks import fixtures
+
+# ==============================================================================
+# LAB GRID MICRO-BENCHMARK (fill_smart_grid planning only, no I/O)
+# ==============================================================================
+# Builds a synthetic template with many tables (the lab grid last, so the
+# anchor search has to walk past all of them) and times the pre-CellIndex
+# planner against grid_fill. Both must produce identical requests.
+#
+#   python -m benchmarks.bench_grid
+#   python -m benchmarks.bench_grid --tables 40 --dates 45 --rows 26 --grids 3
+#   python -m benchmarks.bench_grid --dates 31 --columns 8    # month-long ICU stay
+
+TEST_ORDER = [f"test_{i}" for i in range(26)]
+
+
+def legacy_plan(doc, labs_data, test_order, anchor_name):
+    """fill_smart_grid() as it was before grid_fill (kept here as the reference)."""
+    def normalize_key(text):
+        if not text: return ""
+        return str(text).lower().replace("_", "").replace(" ", "").replace("-", "").strip()
+
+    content = doc.get('body').get('content')
+    anchor_found = False
+    table_index = anchor_row = anchor_col = -1
+    clean_anchor_text = anchor_name.replace("{{", "").replace("}}", "").strip()
+
+    for i, element in enumerate(content):
+        if 'table' in element:
+            for r_idx, row in enumerate(element['table']['tableRows']):
+                for c_idx, cell in enumerate(row['tableCells']):
+                    full_cell_text = ""
+                    if 'content' in cell:
+                        for content_item in cell['content']:
+                            if 'paragraph' in content_item:
+                                for elem in content_item['paragraph']['elements']:
+                                    if 'textRun' in elem:
+                                        full_cell_text += elem['textRun']['content']
+                    if clean_anchor_text in full_cell_text:
+                        anchor_found = True
+                        table_index, anchor_row, anchor_col = i, r_idx, c_idx
+                        break
+                if anchor_found: break
+        if anchor_found: break
+    if not anchor_found:
+        return []
+
+    requests = [{'replaceAllText': {'containsText': {'text': anchor_name, 'matchCase': True}, 'replaceText': ' '}}]
+    sorted_dates = sorted(labs_data.keys(), key=grid_fill.date_order)  # Calendar order (the old string sort put 01/02 before 25/01)
+    table = content[table_index]['table']
+    for i, date in enumerate(sorted_dates):
+        target_col = anchor_col + i
+        if target_col >= len(table['tableRows'][0]['tableCells']): break
+        try:
+            cell = table['tableRows'][anchor_row]['tableCells'][target_col]
+            requests.append({'insertText': {'location': {'index': cell['endIndex'] - 1}, 'text': str(date)}})
+            day_map = {normalize_key(k): v for k, v in labs_data[date].items()}
+            for test_idx, python_key in enumerate(test_order):
+                target_row = anchor_row + 1 + test_idx
+                if target_row >= len(table['tableRows']): break
+                val = str(day_map.get(normalize_key(python_key), ""))
+                val = val.replace("{", "").replace("}", "").replace("[", "").replace("]", "").strip()
+                if val and val != "":
+                    try:
+                        cell = table['tableRows'][target_row]['tableCells'][target_col]
+                        requests.append({'insertText': {'location': {'index': cell['endIndex'] - 1}, 'text': val}})
+                    except: pass
+        except: continue
+    requests.sort(key=lambda x: x.get('insertText', {}).get('location', {}).get('index', 0), reverse=True)
+    return requests
+
+
+def synthetic_document(tables, columns, rows, grids):
+    """A template with 'tables' filler tables, then 'grids' lab grids (anchor in row 0, col 1)."""
+    blocks = ["DISCHARGE SUMMARY"]
+    for t in range(tables):
+        blocks.append(f"Section {t}")
+        blocks.append([[f"Label {t}.{r}", f"Value {{{{field_{t}_{r}}}}}", "Notes"] for r in range(6)])
+    anchors = []
+    for g in range(grids):
+        anchor = f"{{{{GRID{g}_ANCHOR}}}}"
+        anchors.append(anchor)
+        blocks.append(f"Grid {g}")
+        header = ["Test", anchor] + [""] * (columns - 1)
+        blocks.append([header] + [[key.upper()] + [""] * columns for key in TEST_ORDER[:rows]])
+    return fakes.FakeDocument("bench", "bench", fakes.build_units(blocks)).to_json(), anchors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark of lab grid planning.")
+    parser.add_argument("--tables", type=int, default=20, help="Filler tables before the grids")
+    parser.add_argument("--dates", type=int, default=35)
+    parser.add_argument("--rows", type=int, default=26)
+    parser.add_argument("--grids", type=int, default=3, help="Grids planned per case (Medicine has 3)")
+    parser.add_argument("--columns", type=int, help="Date columns in each grid (default: one per date; fewer = overflow tables)")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(0)
+    columns = args.columns or args.dates
+    doc, anchors = synthetic_document(args.tables, columns, args.rows, args.grids)
+    labs = fixtures.synthetic_grid(TEST_ORDER[:args.rows], args.dates, rng)
+    order = TEST_ORDER[:args.rows]
+
+    def legacy_case():
+        return [legacy_plan(doc, labs, order, anchor) for anchor in anchors]
+
+    def new_case():
+        index = grid_fill.CellIndex(doc)  # Built once per case, shared by every grid
+        return [grid_fill.plan_grid(index, index.find(anchor), labs, order, anchor) for anchor in anchors]
+
+    if columns >= args.dates and legacy_case() != new_case():
+        print("❌ grid_fill output differs from the legacy planner")
+        return 1
+
+    # Interleaved, best of N - a busy laptop slows both sides equally
+    legacy_runs, new_runs = [], []
+    for _ in range(args.repeat):
+        legacy_runs.append(timeit.timeit(legacy_case, number=1))
+        new_runs.append(timeit.timeit(new_case, number=1))
+    legacy = min(legacy_runs) * 1000
+    new = min(new_runs) * 1000
+    cells = sum(len(row['tableCells']) for e in doc['body']['content'] if 'table' in e for row in e['table']['tableRows'])
+    print(f"{args.tables} filler tables + {args.grids} grids ({args.rows} rows x {args.dates} dates), {cells} cells")
+    print(f"  legacy fill_smart_grid : {legacy:8.2f} ms per case")
+    print(f"  grid_fill              : {new:8.2f} ms per case  ({legacy / new:.1f}x)")
+    if columns < args.dates:
+        # The legacy planner silently dropped these dates
+        continuation = sum(isinstance(req, list) for grid in new_case() for req in grid)
+        print(f"  {args.dates - columns} dates per grid overflow: legacy drops them, grid_fill adds {continuation} continuation table(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
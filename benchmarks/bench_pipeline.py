@@ -0,0 +1,109 @@
+import sys
+import json
+import argparse
+
+from benchmarks import fakes
+from benchmarks import fixtures
+from benchmarks import harness
+
+# ==============================================================================
+# END-TO-END PIPELINE BENCHMARK (No network needed)
+# ==============================================================================
+# Usage (from the repo root):
+#   python -m benchmarks.bench_pipeline                       # all departments, no latency
+#   python -m benchmarks.bench_pipeline --dept medicine --cases 40 --workers 4 --latency-scale 0.05
+#   python -m benchmarks.bench_pipeline --latency gemini.generate=2 --latency docs.batchUpdate=0.3
+#   python -m benchmarks.bench_pipeline --dates 30            # synthetic long admission instead of the fixture
+#   python -m benchmarks.bench_pipeline --json results.json
+#   python -m benchmarks.bench_pipeline --two-stage --pages 12 --latency-scale 0.05           # parallel pages vs one call
+#   python -m benchmarks.bench_pipeline --two-stage --incremental 2 --workers 1 --pages 10    # day-by-day uploads
+#   python -m benchmarks.bench_pipeline --async --cases 40 --latency-scale 0.05               # all cases on one event loop
+#   python -m benchmarks.bench_pipeline --warm-pool 10 --latency-scale 0.05                   # ready template copies
+
+
+def parse_latency(values):
+    overrides = {}
+    for item in values or []:
+        stage, _, seconds = item.partition("=")
+        if stage not in fakes.TYPICAL_LATENCY:
+            raise SystemExit(f"Unknown stage '{stage}'. Choose from: {', '.join(fakes.TYPICAL_LATENCY)}")
+        overrides[stage] = float(seconds)
+    return overrides
+
+
+def print_report(report):
+    print(f"\n=== {report['department'].upper()} ===")
+    print(f"cases: {report['succeeded']}/{report['cases']} ok on {report['workers']} workers in {report['elapsed_s']:.2f}s "
+          f"-> {report['throughput_per_min']:.1f} cases/min")
+    case = report["case_ms"]
+    print(f"per case: mean {case['mean']:.1f} ms | p50 {case['p50']:.1f} ms | p95 {case['p95']:.1f} ms")
+    print(f"  {'stage':<20}{'calls/case':>12}{'ms/case':>12}")
+    for stage, values in report["stages"].items():
+        print(f"  {stage:<20}{values['calls_per_case']:>12.1f}{values['ms_per_case']:>12.1f}")
+    print(f"  {'quota queue':<20}{'':>12}{report['queue_wait_ms_per_case']:>12.1f}")
+    print(f"  {'local (cpu)':<20}{'':>12}{report['local_ms_per_case']:>12.1f}")
+    for error in report["errors"]:
+        print(f"  ⚠️ {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the discharge pipelines.")
+    parser.add_argument("--dept", choices=list(fixtures.DEPARTMENTS) + ["all"], default="all")
+    parser.add_argument("--cases", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4, help="Thread pool size (app.py uses 4 per session)")
+    parser.add_argument("--pages", type=int, default=3, help="Note pages per case")
+    parser.add_argument("--model", default="Gemini 2.5 Pro")
+    parser.add_argument("--latency-scale", type=float, default=0.0,
+                        help="Multiplier on typical latencies (0 = pure CPU, 1 = production-like)")
+    parser.add_argument("--latency", action="append", metavar="STAGE=SECONDS", help="Override one stage's mean latency")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- fraction of random jitter on each latency")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dates", type=int, help="Use a synthetic response with this many lab dates per grid")
+    parser.add_argument("--date-columns", type=int, default=fixtures.GRID_DATE_COLUMNS, help="Date columns in the template grids")
+    parser.add_argument("--no-export", action="store_true", help="Skip the .docx export after each case")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Bypass the shared quota buckets")
+    parser.add_argument("--verbose", action="store_true", help="Show the backends' own log output")
+    parser.add_argument("--two-stage", "--page-cache", dest="two_stage", action="store_true",
+                        help="Parallel per-page transcripts + page cache, then a text-only call")
+    parser.add_argument("--incremental", type=int, default=0, metavar="N",
+                        help="Each case re-uploads the previous pages plus N new ones")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run_pipeline_async() for every case at once on one event loop (ignores --workers)")
+    parser.add_argument("--warm-pool", type=int, default=0, metavar="N",
+                        help="Fill a template warm pool with N ready copies before the first case")
+    parser.add_argument("--json", help="Also write the reports to this file")
+    args = parser.parse_args(argv)
+
+    # Explicit --latency overrides apply as given, even when the global scale is 0
+    overrides = parse_latency(args.latency)
+    means = {stage: overrides.get(stage, seconds * args.latency_scale) for stage, seconds in fakes.TYPICAL_LATENCY.items()}
+    departments = list(fixtures.DEPARTMENTS) if args.dept == "all" else [args.dept]
+
+    reports = []
+    for department in departments:
+        fixture = None
+        if args.dates:
+            backend = harness.load_backend(department)
+            fixture = fixtures.synthetic_fixture(department, backend, dates=args.dates, seed=args.seed)
+        latency = fakes.Latency(means=means, jitter=args.jitter, seed=args.seed)
+
+        with harness.page_transcripts(args.two_stage):
+            report = harness.run_benchmark(
+                department, cases=args.cases, workers=args.workers, pages=args.pages, latency=latency,
+                fixture=fixture, model_choice=args.model, export=not args.no_export,
+                rate_limits=not args.no_rate_limit, quiet=not args.verbose, date_columns=args.date_columns,
+                incremental=args.incremental, use_async=args.use_async, pool_size=args.warm_pool,
+            )
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+        print(f"\nReports written to {args.json}")
+
+    return 0 if all(r["succeeded"] == r["cases"] for r in reports) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import io
+import re
+import sys
+import json
+import contextlib
+import random
+import timeit
+import argparse
+
+import structured_log
+
+from benchmarks import harness
+from benchmarks import fixtures
+
+# ==============================================================================
+# POST-PROCESSING MICRO-BENCHMARK (postprocess.Profile.run per department, no I/O)
+# ==============================================================================
+# Times each department's POSTPROCESS profile against the cleaning code the
+# backends ran before postprocess.py (kept here as the reference). Both must
+# produce the same text values (same order), grids and filename - on the
+# synthetic fixture and on the shapes the AI gets wrong (stringified grids,
+# NOT_FOUND spellings, brackets, lists, OBGYN report series as strings).
+#
+#   python -m benchmarks.bench_postprocess
+#   python -m benchmarks.bench_postprocess --department obgyn --dates 30 --repeat 500
+
+
+def _robust_fix(extracted_data):
+    grid_keys = ["{{labs_json}}", "{{cardiac_json}}", "{{csf_json}}"]
+    for key in grid_keys:
+        if key in extracted_data:
+            val = extracted_data[key]
+            if isinstance(val, str):
+                clean_val = val.replace("```json", "").replace("```", "").strip()
+                if clean_val.startswith("{") and "'" in clean_val:
+                    clean_val = clean_val.replace("'", '"')
+                try:
+                    print(f"   -> Auto-Correcting stringified JSON for {key}...")
+                    extracted_data[key] = json.loads(clean_val)
+                except:
+                    extracted_data[key] = {}
+
+
+def _unpack_obs_slots(extracted_data):
+    safe_hplc_data = {}
+    if "{{hplc_smear_json}}" in extracted_data:
+        val = extracted_data["{{hplc_smear_json}}"]
+        if isinstance(val, str):
+            try: safe_hplc_data = json.loads(val)
+            except: safe_hplc_data = {}
+        elif isinstance(val, dict):
+            safe_hplc_data = val
+        del extracted_data["{{hplc_smear_json}}"]
+
+    for prefix, label, items in (("hplc", "HPLC", safe_hplc_data.get("hplc", [])),
+                                 ("ps", "Peripheral Smear", safe_hplc_data.get("ps", []))):
+        for i in range(1, 5):
+            key_date = f"{{{{{prefix}_date_{i}}}}}"
+            key_res = f"{{{{{prefix}_res_{i}}}}}"
+            if i <= len(items):
+                item = items[i-1]
+                raw_date = item.get("date", "").strip()
+                extracted_data[key_date] = f"{label} ({raw_date})" if raw_date else label
+                extracted_data[key_res] = item.get("result", "")
+            else:
+                extracted_data[key_date] = ""
+                extracted_data[key_res] = ""
+
+    safe_usg_list = []
+    if "{{usg_series_json}}" in extracted_data:
+        val = extracted_data["{{usg_series_json}}"]
+        if isinstance(val, str):
+            try: safe_usg_list = json.loads(val)
+            except: safe_usg_list = []
+        elif isinstance(val, list):
+            safe_usg_list = val
+        del extracted_data["{{usg_series_json}}"]
+    for i in range(1, 8):
+        key_date = f"{{{{usg_date_{i}}}}}"
+        key_res = f"{{{{usg_res_{i}}}}}"
+        if i <= len(safe_usg_list):
+            item = safe_usg_list[i-1]
+            raw_date = item.get("date", "").strip()
+            extracted_data[key_date] = f"USG OBS ({raw_date})" if raw_date else "USG OBS"
+            extracted_data[key_res] = item.get("result", "")
+        else:
+            extracted_data[key_date] = ""
+            extracted_data[key_res] = ""
+
+
+def legacy_clean(department, backend, extracted_data):
+    """run_pipeline()'s cleaning as it was before postprocess.py. Returns (text values, grids, filename)."""
+    extracted_data = dict(extracted_data)  # The old code replaced top-level keys in place
+    if department == "obgyn":
+        _unpack_obs_slots(extracted_data)
+    _robust_fix(extracted_data)
+    patient_name = re.sub(r'[\\/*?:"<>|]', "", extracted_data.get("{{patient_name}}", "Unknown"))
+
+    grids = {}
+    for data_key, _, _, _ in backend.GRIDS:
+        if data_key in extracted_data:
+            grids[data_key] = extracted_data.pop(data_key)
+
+    final_data = extracted_data.copy()
+    if department == "medicine":
+        for key in backend.placeholder_rules.keys():
+            extracted_val = str(extracted_data.get(key, "")).strip()
+            if extracted_val.upper() in ["NOT_FOUND", "NONE", "NULL", "NOT MENTIONED"]:
+                final_data[key] = ""
+            else:
+                final_data[key] = extracted_val
+
+    text_values = {}
+    for placeholder, value in final_data.items():
+        if isinstance(value, dict) or isinstance(value, list): continue
+        text_value = str(value).replace("{", "").replace("}", "").replace("[", "").replace("]", "").strip()
+        if text_value.lower() in ["none", "null", "not_found", "not found"]:
+            text_value = ""
+        text_values[placeholder] = text_value
+    return text_values, grids, patient_name
+
+
+def new_clean(backend, extracted_data):
+    processed = backend.POSTPROCESS.run(extracted_data)
+    return processed.text_values, processed.grids, processed.patient_name
+
+
+def adversarial(extracted_data, backend, rng):
+    """The same case with the mistakes the AI really makes."""
+    data = dict(extracted_data)
+    text_keys = [k for k, v in data.items() if isinstance(v, str)]
+    for key in rng.sample(text_keys, min(len(text_keys), 12)):
+        data[key] = rng.choice(["NOT_FOUND", "not found", " None ", "null", "Not Mentioned", "[Tab PCM 650mg]",
+                                "{{bp}} 120/80", "  padded value  ", "NOT_FOUND\n", 42, None])
+    for key in rng.sample(text_keys, min(len(text_keys), 2)):
+        data[key] = ["Tab A 1-0-1", "Tab B 0-0-1"]
+    data["{{patient_name}}"] = 'Ram "Kumar" / ICU?'
+    for i, (data_key, _, _, _) in enumerate(backend.GRIDS):
+        grid = json.dumps(data.get(data_key, {}))
+        # Fenced, single-quoted, or plain broken
+        data[data_key] = [f"```json\n{grid}\n```", grid.replace('"', "'"), "{not json"][i % 3]
+    if "{{hplc_smear_json}}" in backend.placeholder_rules:
+        data["{{hplc_smear_json}}"] = json.dumps({
+            "hplc": [{"date": "02/01/25", "result": "HbA2 2.9% [normal]"}, {"date": "", "result": "Repeat"}],
+            "ps": [{"date": f"0{d}/01/25 ", "result": f"Smear {d}"} for d in range(1, 7)],
+        })
+        data["{{usg_series_json}}"] = [{"date": f"{d:02d}/02/25", "result": f"SLIUF, FHR {130 + d}"} for d in range(1, 4)]
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the post-processing stage.")
+    parser.add_argument("--department", choices=sorted(fixtures.DEPARTMENTS), action="append",
+                        help="Repeat for several (default: all)")
+    parser.add_argument("--dates", type=int, default=12, help="Date columns per grid in the synthetic case")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for department in args.department or sorted(fixtures.DEPARTMENTS):
+        backend = harness.load_backend(department)
+        fixture = fixtures.synthetic_fixture(department, backend, dates=args.dates)
+        text = fixture["text"]
+        case = json.loads(text[text.find("{"):text.rfind("}") + 1])
+        cases = {"synthetic": case, "adversarial": adversarial(case, backend, random.Random(1))}
+
+        for name, data in cases.items():
+            with contextlib.redirect_stdout(io.StringIO()), structured_log.muted():
+                same = legacy_clean(department, backend, data) == new_clean(backend, data)
+            if not same:
+                print(f"❌ {department} ({name}): postprocess output differs from the legacy cleaning")
+                failed = True
+
+        # Interleaved, best of N - a busy laptop slows both sides equally
+        legacy_runs, new_runs = [], []
+        with contextlib.redirect_stdout(io.StringIO()), structured_log.muted():  # Both sides log the grid auto-correction
+            for _ in range(args.repeat):
+                legacy_runs.append(timeit.timeit(lambda: [legacy_clean(department, backend, d) for d in cases.values()], number=1))
+                new_runs.append(timeit.timeit(lambda: [new_clean(backend, d) for d in cases.values()], number=1))
+        legacy = min(legacy_runs) * 1000
+        new = min(new_runs) * 1000
+        print(f"{department}: {len(case)} keys, {args.dates} dates per grid (synthetic + adversarial case)")
+        print(f"  legacy cleaning : {legacy:8.3f} ms")
+        print(f"  postprocess     : {new:8.3f} ms  ({legacy / new:.1f}x)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
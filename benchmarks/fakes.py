@@ -0,0 +1,581 @@
+import io
+import time
+import random
+import asyncio
+import zipfile
+import itertools
+import threading
+import contextvars
+from xml.sax.saxutils import escape
+
+import rate_limit
+import transcribe
+
+# ==============================================================================
+# OFFLINE FAKES (In-memory Google Docs / Drive and a replaying Gemini)
+# ==============================================================================
+# The backends only ever talk to Google through resilience.build_service() and
+# resilience.execute(request, ...), and to Gemini through genai.GenerativeModel.
+# The fakes below plug in at exactly those two points, so run_pipeline() runs
+# end-to-end - prompt, JSON repair, grid planning, batchUpdate, export - with
+# no network and no credentials.
+#
+# Every fake call sleeps for its configured latency and is timed per stage, so
+# the harness can report where a case spends its time. generate_content_async()
+# sleeps with asyncio.sleep(), like the real async client waits on the wire.
+
+# --- DOCUMENT MODEL MARKERS (each takes exactly one index, like in Docs) ---
+TABLE = "\x00table"
+ROW = "\x00row"
+CELL = "\x00cell"
+TABLE_END = "\x00/table"
+MARKERS = (TABLE, ROW, CELL, TABLE_END)
+
+DOC_MIME = "application/vnd.google-apps.document"
+FOLDER_MIME = "application/vnd.google-apps.folder"
+
+# Typical latencies (seconds) seen from Streamlit Cloud. Scale them with --latency-scale.
+TYPICAL_LATENCY = {
+    "gemini.generate": 25.0,
+    "gemini.transcribe": 8.0,   # One page (two-stage mode)
+    "gemini.structure": 12.0,   # Text-only call on the stitched transcripts (two-stage mode)
+    "drive.copy": 1.5,
+    "drive.create": 0.6,
+    "drive.upload": 0.8,
+    "drive.get": 0.2,
+    "drive.update": 0.3,        # Rename of a template copy (metadata only)
+    "drive.delete": 0.3,
+    "drive.export": 1.2,
+    "docs.get": 0.4,
+    "docs.batchUpdate": 1.0,
+}
+
+
+class FakeApiError(Exception):
+    """A 400-style API error (not retryable, like a real bad request)."""
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.code = code
+
+
+class Latency:
+    """Injected latency per stage, with optional +/- jitter (fraction of the mean)."""
+
+    def __init__(self, means=None, scale=1.0, jitter=0.0, seed=None):
+        self.means = dict(TYPICAL_LATENCY if means is None else means)
+        self.scale = scale
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, stage):
+        mean = self.means.get(stage, 0.0) * self.scale
+        if mean <= 0:
+            return 0.0
+        if not self.jitter:
+            return mean
+        with self._lock:
+            return max(0.0, self._random.uniform(mean * (1 - self.jitter), mean * (1 + self.jitter)))
+
+
+class StageRecorder:
+    """Collects (stage -> [seconds]) for whatever case is running in the current context.
+
+    A context variable rather than a thread-local, so calls a case hands to a
+    helper pool (two-stage page transcription) are still counted for it.
+    """
+
+    def __init__(self):
+        self._stages = contextvars.ContextVar(f"stages_{id(self)}", default=None)
+        self._lock = threading.Lock()
+
+    def start_case(self):
+        self._stages.set({})
+
+    def finish_case(self):
+        stages = self._stages.get() or {}
+        self._stages.set({})
+        return stages
+
+    def record(self, stage, seconds):
+        stages = self._stages.get()
+        if stages is None:
+            return  # Call made outside a case (e.g. warm-up)
+        with self._lock:
+            stages.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage, latency, fn):
+        start = time.perf_counter()
+        delay = latency.sample(stage)
+        if delay:
+            time.sleep(delay)
+        try:
+            return fn()
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    async def timed_async(self, stage, latency, fn):
+        start = time.perf_counter()
+        delay = latency.sample(stage)
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            return fn()
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+
+# ==============================================================================
+# IN-MEMORY DOCS MODEL
+# ==============================================================================
+class FakeDocument:
+    """A Docs body as a flat list of units: one character or one structural marker per index."""
+
+    def __init__(self, doc_id, title, units=None):
+        self.doc_id = doc_id
+        self.title = title
+        self.units = units if units is not None else ["\n"]
+        self.revision = 1
+
+    # --- READ ---
+    def to_json(self):
+        content = [{"endIndex": 1, "sectionBreak": {"sectionStyle": {}}}]
+        pos = 0
+        while pos < len(self.units):
+            element, pos = self._element(pos)
+            content.append(element)
+        return {
+            "documentId": self.doc_id,
+            "title": self.title,
+            "revisionId": str(self.revision),
+            "body": {"content": content},
+        }
+
+    def _element(self, pos):
+        if self.units[pos] == TABLE:
+            return self._table(pos)
+        return self._paragraph(pos)
+
+    def _paragraph(self, pos):
+        start = pos
+        while pos < len(self.units) and self.units[pos] not in MARKERS:
+            pos += 1
+            if self.units[pos - 1] == "\n":
+                break
+        text = "".join(self.units[start:pos])
+        element = {
+            "startIndex": start + 1,
+            "endIndex": pos + 1,
+            "paragraph": {"elements": [{"startIndex": start + 1, "endIndex": pos + 1, "textRun": {"content": text}}]},
+        }
+        return element, pos
+
+    def _table(self, pos):
+        start = pos
+        pos += 1
+        rows = []
+        while self.units[pos] == ROW:
+            row_start = pos
+            pos += 1
+            cells = []
+            while self.units[pos] == CELL:
+                cell_start = pos
+                pos += 1
+                content = []
+                while self.units[pos] not in MARKERS:
+                    paragraph, pos = self._paragraph(pos)
+                    content.append(paragraph)
+                cells.append({"startIndex": cell_start + 1, "endIndex": pos + 1, "content": content})
+            rows.append({"startIndex": row_start + 1, "endIndex": pos + 1, "tableCells": cells})
+        pos += 1  # TABLE_END
+        columns = len(rows[0]["tableCells"]) if rows else 0
+        element = {
+            "startIndex": start + 1,
+            "endIndex": pos + 1,
+            "table": {"rows": len(rows), "columns": columns, "tableRows": rows},
+        }
+        return element, pos
+
+    def plain_text(self):
+        """Document text with table rows as tab-separated lines."""
+        out = []
+        units = self.units
+        for i, unit in enumerate(units):
+            following = units[i + 1] if i + 1 < len(units) else None
+            if unit == "\n" and following in (CELL, ROW, TABLE_END):
+                continue  # A cell's closing newline
+            if unit == CELL:
+                if units[i - 1] != ROW:
+                    out.append("\t")
+            elif unit == ROW:
+                if units[i - 1] != TABLE:
+                    out.append("\n")
+            elif unit == TABLE_END:
+                out.append("\n")
+            elif unit != TABLE:
+                out.append(unit)
+        return "".join(out)
+
+    # --- WRITE ---
+    def apply(self, requests):
+        """Applies a batchUpdate. Like the real API, one bad request rolls back the whole batch."""
+        backup = list(self.units)
+        replies = []
+        try:
+            for request in requests:
+                if "insertText" in request:
+                    replies.append(self._insert_text(request["insertText"]))
+                elif "replaceAllText" in request:
+                    replies.append(self._replace_all_text(request["replaceAllText"]))
+                elif "insertTable" in request:
+                    replies.append(self._insert_table(request["insertTable"]))
+                elif "deleteContentRange" in request:
+                    replies.append(self._delete_content_range(request["deleteContentRange"]))
+                else:
+                    raise FakeApiError(f"Unsupported request in fake Docs model: {list(request)}")
+        except Exception:
+            self.units = backup
+            raise
+        self.revision += 1
+        return replies
+
+    def _insert_text(self, body):
+        index = body["location"]["index"]
+        pos = index - 1
+        if pos < 0 or pos >= len(self.units) or self.units[pos] in (TABLE, ROW, TABLE_END):
+            raise FakeApiError(f"Invalid insertText index {index}")
+        self.units[pos:pos] = list(body["text"])
+        return {}
+
+    def _delete_content_range(self, body):
+        start, end = body["range"]["startIndex"] - 1, body["range"]["endIndex"] - 1
+        if start < 0 or end > len(self.units) or start >= end or any(u in MARKERS for u in self.units[start:end]):
+            raise FakeApiError(f"Invalid deleteContentRange {start + 1}-{end + 1}")
+        del self.units[start:end]
+        return {}
+
+    def _insert_table(self, body):
+        # Like Docs: a newline at the location, then an empty rows x columns table
+        index = body["location"]["index"]
+        pos = index - 1
+        if pos < 0 or pos >= len(self.units) or self.units[pos] in (TABLE, ROW, CELL, TABLE_END):
+            raise FakeApiError(f"Invalid insertTable index {index}")
+        table = ["\n", TABLE]
+        for _ in range(body["rows"]):
+            table.append(ROW)
+            for _ in range(body["columns"]):
+                table.extend((CELL, "\n"))
+        table.append(TABLE_END)
+        self.units[pos:pos] = table
+        return {}
+
+    def _replace_all_text(self, body):
+        needle = body["containsText"]["text"]
+        match_case = body["containsText"].get("matchCase", False)
+        flat = "".join(u if len(u) == 1 else "\x00" for u in self.units)
+        haystack = flat if match_case else flat.lower()
+        target = needle if match_case else needle.lower()
+
+        hits = []
+        pos = haystack.find(target)
+        while pos != -1 and target:
+            hits.append(pos)
+            pos = haystack.find(target, pos + len(target))
+
+        replacement = list(body.get("replaceText", ""))
+        for pos in reversed(hits):
+            self.units[pos:pos + len(needle)] = replacement
+        return {"replaceAllText": {"occurrencesChanged": len(hits)}}
+
+    def to_docx(self):
+        """A minimal, valid .docx holding the document text (enough for export benchmarks)."""
+        paragraphs = "".join(
+            f"<w:p><w:r><w:t xml:space=\"preserve\">{escape(line)}</w:t></w:r></w:p>"
+            for line in self.plain_text().split("\n")
+        )
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as docx:
+            docx.writestr("[Content_Types].xml", (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                '</Types>'))
+            docx.writestr("_rels/.rels", (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+                '</Relationships>'))
+            docx.writestr("word/document.xml", (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f'<w:body>{paragraphs}</w:body></w:document>'))
+        return buffer.getvalue()
+
+
+def build_units(blocks):
+    """Turns [str | [[cell text, ...], ...]] into document units (strings are paragraphs, lists are tables)."""
+    units = []
+    for block in blocks:
+        if isinstance(block, str):
+            units.extend(block if block.endswith("\n") else block + "\n")
+            continue
+        units.append(TABLE)
+        for row in block:
+            units.append(ROW)
+            for cell_text in row:
+                units.append(CELL)
+                units.extend(cell_text + "\n")
+        units.append(TABLE_END)
+    # Docs always ends the body with a paragraph after a table
+    if units and units[-1] == TABLE_END:
+        units.append("\n")
+    return units
+
+
+class FakeWorkspace:
+    """Shared state behind the fake Drive and Docs services (one per benchmark run)."""
+
+    def __init__(self, latency=None, recorder=None):
+        self.latency = latency or Latency(means={})
+        self.recorder = recorder or StageRecorder()
+        self.docs = {}
+        self.files = {}  # file_id -> metadata (folders, uploads, docs)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_id(self, prefix):
+        with self._lock:
+            return f"{prefix}-{next(self._ids):06d}"
+
+    def add_document(self, doc_id, title, units):
+        with self._lock:
+            self.docs[doc_id] = FakeDocument(doc_id, title, list(units))
+            self.files[doc_id] = {"id": doc_id, "name": title, "mimeType": DOC_MIME}
+        return self.docs[doc_id]
+
+    def document(self, doc_id):
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            raise FakeApiError(f"File not found: {doc_id}", code=404)
+        return doc
+
+    def service(self, name, version=None, credentials=None):
+        """Drop-in replacement for resilience.build_service()."""
+        if name == "drive":
+            return FakeDrive(self)
+        if name == "docs":
+            return FakeDocs(self)
+        raise ValueError(f"No fake for Google service '{name}'")
+
+
+class FakeRequest:
+    """Mimics googleapiclient's HttpRequest: .method, .uri, .methodId and .execute()."""
+
+    def __init__(self, workspace, stage, method, uri, fn):
+        self.workspace = workspace
+        self.stage = stage
+        self.methodId = stage  # e.g. "drive.copy" (the real one is "drive.files.copy")
+        self.method = method
+        self.uri = uri
+        self._fn = fn
+
+    def execute(self, num_retries=0):
+        return self.workspace.recorder.timed(self.stage, self.workspace.latency, self._fn)
+
+
+# ==============================================================================
+# FAKE DRIVE (files().copy / create / get / list / update / delete / export_media)
+# ==============================================================================
+class FakeDrive:
+    def __init__(self, workspace):
+        self.workspace = workspace
+
+    def files(self):
+        return self
+
+    def copy(self, fileId, body=None, supportsAllDrives=False, fields=None):
+        ws = self.workspace
+
+        def run():
+            source = ws.document(fileId)
+            new_id = ws.new_id("doc")
+            ws.add_document(new_id, (body or {}).get("name", f"Copy of {source.title}"), source.units)
+            with ws._lock:
+                ws.files[new_id]["parents"] = list((body or {}).get("parents", []))
+                ws.files[new_id]["appProperties"] = dict((body or {}).get("appProperties", {}))
+            return {"id": new_id}
+        return FakeRequest(ws, "drive.copy", "POST", f"drive/v3/files/{fileId}/copy", run)
+
+    def create(self, body=None, media_body=None, fields=None, supportsAllDrives=False):
+        ws = self.workspace
+        body = body or {}
+
+        def run():
+            if body.get("mimeType") == DOC_MIME:
+                new_id = ws.new_id("doc")
+                ws.add_document(new_id, body.get("name", "Untitled"), ["\n"])
+                return {"id": new_id}
+            new_id = ws.new_id("file")
+            size = 0
+            if media_body is not None:
+                size = media_body.size()
+                media_body.getbytes(0, size)  # Read it like a real upload would
+            with ws._lock:
+                ws.files[new_id] = {"id": new_id, "name": body.get("name"), "mimeType": body.get("mimeType"), "size": size}
+            return {"id": new_id}
+        stage = "drive.upload" if media_body is not None else "drive.create"
+        return FakeRequest(ws, stage, "POST", "drive/v3/files", run)
+
+    def get(self, fileId, fields=None, supportsAllDrives=False):
+        ws = self.workspace
+
+        def run():
+            doc = ws.document(fileId)
+            return {"id": fileId, "name": doc.title, "version": str(doc.revision)}
+        return FakeRequest(ws, "drive.get", "GET", f"drive/v3/files/{fileId}", run)
+
+    def list(self, q="", fields=None, pageToken=None, pageSize=None, supportsAllDrives=False, includeItemsFromAllDrives=False):
+        """Only the "'<folder>' in parents" part of the query is understood."""
+        ws = self.workspace
+        folder = q.split("'")[1] if "in parents" in q else None
+
+        def run():
+            with ws._lock:
+                found = [dict(meta) for meta in ws.files.values() if folder is None or folder in meta.get("parents", [])]
+            return {"files": found}
+        return FakeRequest(ws, "drive.get", "GET", "drive/v3/files", run)
+
+    def update(self, fileId, body=None, addParents=None, removeParents=None, fields=None, supportsAllDrives=False):
+        ws = self.workspace
+        body = body or {}
+
+        def run():
+            doc = ws.document(fileId)
+            with ws._lock:
+                meta = ws.files[fileId]
+                if "name" in body:
+                    doc.title = meta["name"] = body["name"]
+                if addParents or removeParents:
+                    parents = [p for p in meta.get("parents", []) if p not in (removeParents or "").split(",")]
+                    meta["parents"] = parents + [p for p in (addParents or "").split(",") if p]
+            return {"id": fileId, "name": doc.title}
+        return FakeRequest(ws, "drive.update", "PATCH", f"drive/v3/files/{fileId}", run)
+
+    def delete(self, fileId, supportsAllDrives=False):
+        ws = self.workspace
+
+        def run():
+            ws.document(fileId)
+            with ws._lock:
+                del ws.docs[fileId]
+                del ws.files[fileId]
+            return ""
+        return FakeRequest(ws, "drive.delete", "DELETE", f"drive/v3/files/{fileId}", run)
+
+    def export_media(self, fileId, mimeType=None):
+        ws = self.workspace
+        return FakeRequest(ws, "drive.export", "GET", f"drive/v3/files/{fileId}/export", lambda: ws.document(fileId).to_docx())
+
+
+# ==============================================================================
+# FAKE DOCS (documents().get / batchUpdate)
+# ==============================================================================
+class FakeDocs:
+    def __init__(self, workspace):
+        self.workspace = workspace
+
+    def documents(self):
+        return self
+
+    def get(self, documentId, **kwargs):
+        ws = self.workspace
+
+        def run():
+            doc = ws.document(documentId)
+            with ws._lock:
+                return doc.to_json()
+        return FakeRequest(ws, "docs.get", "GET", f"docs/v1/documents/{documentId}", run)
+
+    def batchUpdate(self, documentId, body):
+        ws = self.workspace
+
+        def run():
+            doc = ws.document(documentId)
+            with ws._lock:
+                required = body.get("writeControl", {}).get("requiredRevisionId")
+                if required and required != str(doc.revision):
+                    raise FakeApiError("The document was modified since requiredRevisionId", code=400)
+                replies = doc.apply(body.get("requests", []))
+                revision = str(doc.revision)
+            return {"documentId": documentId, "replies": replies, "writeControl": {"requiredRevisionId": revision}}
+        return FakeRequest(ws, "docs.batchUpdate", "POST", f"docs/v1/documents/{documentId}:batchUpdate", run)
+
+
+# ==============================================================================
+# FAKE GEMINI (replays a recorded response)
+# ==============================================================================
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens, output_tokens):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt_tokens, output_tokens)
+
+
+class FakeGenAI:
+    """Stands in for the google.generativeai module inside a backend."""
+
+    def __init__(self, fixture, latency, recorder):
+        self.fixture = fixture
+        self.latency = latency
+        self.recorder = recorder
+
+    def configure(self, **kwargs):
+        pass
+
+    def GenerativeModel(self, model_name, safety_settings=None, **kwargs):
+        return FakeGenerativeModel(self, model_name)
+
+
+class FakeGenerativeModel:
+    def __init__(self, genai, model_name):
+        self.genai = genai
+        self.model_name = model_name
+
+    def _reply(self, contents):
+        """(stage, fn building the response) for one call."""
+        fixture = self.genai.fixture
+        usage = fixture.get("usage", {})
+
+        if contents and contents[0] == transcribe.PAGE_PROMPT:
+            # A per-page transcription call: one page in, a page of text out
+            def transcript():
+                text = "\n".join(f"Day note line {i + 1}: vitals stable, continue same treatment." for i in range(30))
+                return FakeResponse(text, rate_limit.estimate_input_tokens(contents), len(text) // 4)
+            return "gemini.transcribe", transcript
+
+        def run():
+            return FakeResponse(
+                fixture["text"],
+                usage.get("prompt_token_count", 0),
+                usage.get("candidates_token_count", len(fixture["text"]) // 4),
+            )
+        # Two-stage mode: the department prompt on transcripts only, no images
+        stage = "gemini.generate" if any(not isinstance(part, str) for part in contents) else "gemini.structure"
+        return stage, run
+
+    def generate_content(self, contents, request_options=None, **kwargs):
+        stage, fn = self._reply(contents)
+        return self.genai.recorder.timed(stage, self.genai.latency, fn)
+
+    async def generate_content_async(self, contents, request_options=None, **kwargs):
+        stage, fn = self._reply(contents)
+        return await self.genai.recorder.timed_async(stage, self.genai.latency, fn)
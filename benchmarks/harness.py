@@ -0,0 +1,259 @@
+import os
+import sys
+import time
+import contextlib
+import importlib
+import statistics
+import concurrent.futures
+
+import structured_log
+
+from benchmarks import fakes
+from benchmarks import fixtures
+
+# ==============================================================================
+# OFFLINE PIPELINE HARNESS
+# ==============================================================================
+# Imports a department backend with fake IDs, swaps its Google / Gemini access
+# for the fakes, and runs whole cases through run_pipeline() (+ export_docx)
+# on a thread pool, the same way app.py does - or, with use_async, every case
+# as a coroutine on pipeline_async's shared event loop (ASYNC_PIPELINE=1).
+
+# The backends exit() at import without these. Benchmarks must never see real IDs.
+OFFLINE_ENV = {
+    "GENAI_API_KEY": "offline-benchmark",
+    "MASTER_TEMPLATE_ID": "template-medicine",
+    "SURGERY_TEMPLATE_ID": "template-surgery",
+    "OBS_TEMPLATE_ID": "template-obgyn",
+    "OUTPUT_FOLDER_ID": "folder-output",
+    "SURGERY_OUTPUT_FOLDER_ID": "folder-output",
+    "OBS_OUTPUT_FOLDER_ID": "folder-output",
+    "IMAGES_FOLDER_ID": "folder-images",
+    "SURGERY_IMAGES_FOLDER_ID": "folder-images",
+    "OBS_IMAGES_FOLDER_ID": "folder-images",
+    "COST_FOLDER_ID": "folder-costs",
+    "FEEDBACK_FOLDER_ID": "folder-feedback",
+}
+
+
+def load_backend(department):
+    module_name, _ = fixtures.DEPARTMENTS[department]
+    if module_name not in sys.modules:
+        os.environ.update(OFFLINE_ENV)
+    return importlib.import_module(module_name)
+
+
+def sample_images(pages, size=(1654, 2339), seed=0):
+    """A4-at-200dpi pages with random "ink" strokes, so each page has its own perceptual hash."""
+    import random
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    images = []
+    for _ in range(pages):
+        img = Image.new("RGB", size, "white")
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x, y = rng.randrange(size[0] - 400), rng.randrange(size[1] - 60)
+            draw.rectangle((x, y, x + rng.randrange(100, 400), y + rng.randrange(10, 60)), fill="black")
+        images.append(img)
+    return images
+
+
+async def _no_wait(service, request):
+    return 0.0
+
+
+@contextlib.contextmanager
+def offline(backend, workspace, genai, rate_limits=True):
+    """Routes one backend's Google and Gemini calls to the fakes for the duration of the block."""
+    import resilience
+    import rate_limit
+    import docs_batch
+
+    saved = [
+        (resilience, "build_service", resilience.build_service),
+        (backend, "get_user_credentials", backend.get_user_credentials),
+        (backend, "genai", backend.genai),
+        (backend, "RATE_LIMITS", backend.RATE_LIMITS),
+        (rate_limit, "wait_for_google", rate_limit.wait_for_google),
+        (rate_limit, "wait_for_google_async", rate_limit.wait_for_google_async),
+    ]
+    resilience.build_service = workspace.service
+    backend.get_user_credentials = lambda: None
+    backend.genai = genai
+    if not rate_limits:
+        backend.RATE_LIMITS = {}
+        rate_limit.wait_for_google = lambda service, request: 0.0
+        rate_limit.wait_for_google_async = _no_wait
+    # Start every run with a cold template scan, like a fresh process
+    docs_batch._template_cache.clear()
+    docs_batch._template_checked.clear()
+    try:
+        yield
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+
+
+def run_case(backend, recorder, images, model_choice, export=True):
+    """One end-to-end case on the current thread. Returns (result, {stage: [seconds]}, wall)."""
+    recorder.start_case()
+    start = time.perf_counter()
+    result = backend.run_pipeline(list(images), model_choice=model_choice)
+    if export and isinstance(result, dict) and "id" in result:
+        # What app.py prefetches right after a case finishes
+        if not backend.export_docx(result["id"]):
+            result = {"error": "export returned no bytes"}
+    wall = time.perf_counter() - start
+    return result, recorder.finish_case(), wall
+
+
+async def run_case_async(backend, recorder, images, model_choice, export=True):
+    """run_case() on the event loop: run_pipeline_async(), then the export on the Google I/O pool."""
+    import resilience
+    recorder.start_case()  # This task's own context
+    start = time.perf_counter()
+    result = await backend.run_pipeline_async(list(images), model_choice=model_choice)
+    if export and isinstance(result, dict) and "id" in result:
+        if not await resilience.run_io(backend.export_docx, result["id"]):
+            result = {"error": "export returned no bytes"}
+    wall = time.perf_counter() - start
+    return result, recorder.finish_case(), wall
+
+
+@contextlib.contextmanager
+def warm_pool(templates, size):
+    """A template warm pool of 'size' ready copies per template (staged in a fake folder), filled before the block."""
+    import template_pool
+    saved = template_pool.pool
+    if not size:
+        yield saved
+        return
+    fresh = template_pool.WarmPool(size=size, staging_folder_id="folder-staging")
+    template_pool.pool = fresh
+    fresh.start(templates, lambda: None)
+    try:
+        deadline = time.monotonic() + 60
+        while sum(fresh.stats()["ready"].values()) < size * len(templates) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        yield fresh
+    finally:
+        fresh.stop()
+        template_pool.pool = saved
+
+
+@contextlib.contextmanager
+def page_transcripts(enabled=True):
+    """PAGE_CACHE=1 mode for the duration of the block, with a fresh page cache."""
+    import transcribe
+    import page_cache
+
+    saved = (transcribe.ENABLED, page_cache.page_cache)
+    transcribe.ENABLED = enabled
+    fresh = page_cache.PageCache()
+    page_cache.page_cache = transcribe.page_cache = fresh
+    try:
+        yield fresh
+    finally:
+        transcribe.ENABLED, page_cache.page_cache = saved
+        transcribe.page_cache = saved[1]
+
+
+def run_benchmark(department, cases=10, workers=4, pages=3, latency=None, fixture=None,
+                  model_choice="Gemini 2.5 Pro", export=True, rate_limits=True, quiet=True,
+                  date_columns=fixtures.GRID_DATE_COLUMNS, incremental=0, use_async=False, pool_size=0):
+    """Runs 'cases' cases for one department on 'workers' threads and returns a report dict.
+
+    incremental=N makes every case re-upload the previous case's pages plus N
+    new ones (day-by-day notes); run it with workers=1 to see the page cache.
+    use_async=True runs every case at once on the shared event loop ('workers' is ignored).
+    pool_size=N fills a template warm pool with N ready copies before the first case.
+    """
+    backend = load_backend(department)
+    recorder = fakes.StageRecorder()
+    latency = latency or fakes.Latency(means={})
+    workspace = fakes.FakeWorkspace(latency=latency, recorder=recorder)
+
+    _, template_env = fixtures.DEPARTMENTS[department]
+    workspace.add_document(OFFLINE_ENV[template_env], f"{department} template",
+                           fakes.build_units(fixtures.template_blocks(backend, date_columns)))
+
+    if fixture is None:
+        fixture = fixtures.load_fixture(department)
+    genai = fakes.FakeGenAI(fixture, latency, recorder)
+    images = sample_images(pages + incremental * (cases - 1))
+    uploads = [images[:pages + incremental * i] if incremental else images[:pages] for i in range(cases)]
+
+    results = []
+    output = open(os.devnull, "w") if quiet else None
+    with offline(backend, workspace, genai, rate_limits=rate_limits), \
+            (contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext()), \
+            (structured_log.muted() if quiet else contextlib.nullcontext()), \
+            warm_pool([OFFLINE_ENV[template_env]], pool_size):
+        start = time.perf_counter()
+        if use_async:
+            import pipeline_async
+            futures = [pipeline_async.submit(run_case_async(backend, recorder, upload, model_choice, export)) for upload in uploads]
+            results.extend(future.result() for future in futures)
+            workers = "async"
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(run_case, backend, recorder, upload, model_choice, export) for upload in uploads]
+                for future in concurrent.futures.as_completed(futures):
+                    results.append(future.result())
+        elapsed = time.perf_counter() - start
+    if output:
+        output.close()
+
+    return summarize(department, results, elapsed, workers)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def summarize(department, results, elapsed, workers):
+    ok = []
+    errors = []
+    for res, stages, wall in results:
+        if isinstance(res, dict) and "error" not in res:
+            ok.append((res, stages, wall))
+        else:
+            # The backends return either an error string or {"error": ...}
+            errors.append(res if isinstance(res, str) else res.get("error"))
+    walls = [wall for _, _, wall in ok]
+
+    # Per-stage: calls and seconds per case (averaged over successful cases)
+    stage_totals = {}
+    for _, stages, _ in ok:
+        for stage, samples in stages.items():
+            total = stage_totals.setdefault(stage, {"calls": 0, "seconds": 0.0})
+            total["calls"] += len(samples)
+            total["seconds"] += sum(samples)
+    n = max(len(ok), 1)
+    stage_report = {
+        stage: {"calls_per_case": values["calls"] / n, "ms_per_case": values["seconds"] * 1000 / n}
+        for stage, values in sorted(stage_totals.items())
+    }
+    io_ms = sum(v["ms_per_case"] for v in stage_report.values())
+    mean_wall_ms = statistics.mean(walls) * 1000 if walls else 0.0
+    queue_ms = statistics.mean(res.get("queue_wait", 0) for res, _, _ in ok) * 1000 if ok else 0.0
+
+    return {
+        "department": department,
+        "cases": len(results),
+        "succeeded": len(ok),
+        "errors": errors[:5],
+        "workers": workers,
+        "elapsed_s": elapsed,
+        "throughput_per_min": len(ok) / elapsed * 60 if elapsed else 0.0,
+        "case_ms": {"mean": mean_wall_ms, "p50": _percentile(walls, 50) * 1000, "p95": _percentile(walls, 95) * 1000},
+        "stages": stage_report,
+        # Everything that isn't a fake service call: prompt building, JSON repair, grid planning, images
+        "local_ms_per_case": max(0.0, mean_wall_ms - io_ms - queue_ms),
+        "queue_wait_ms_per_case": queue_ms,
+    }
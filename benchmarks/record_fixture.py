@@ -0,0 +1,76 @@
+import sys
+import importlib
+import datetime
+import argparse
+
+from benchmarks import fakes
+from benchmarks import fixtures
+from benchmarks import harness
+
+# ==============================================================================
+# RECORD A GEMINI FIXTURE (Live Gemini, fake Drive / Docs)
+# ==============================================================================
+# Runs ONE real Gemini extraction on the given note photos and saves the raw
+# response as fixtures/<department>.json. Drive and Docs are the in-memory
+# fakes, so nothing is created in Google Drive.
+#
+#   python -m benchmarks.record_fixture medicine page1.jpg page2.jpg --model "Gemini 2.5 Flash"
+#
+# Use de-identified notes only - the response text is committed with the repo.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record a live Gemini response as a benchmark fixture.")
+    parser.add_argument("department", choices=list(fixtures.DEPARTMENTS))
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--model", default="Gemini 2.5 Pro")
+    args = parser.parse_args(argv)
+
+    import resilience
+    from PIL import Image
+
+    # Import with the REAL environment (the Gemini key must be valid)
+    module_name, _ = fixtures.DEPARTMENTS[args.department]
+    backend = importlib.import_module(module_name)
+
+    workspace = fakes.FakeWorkspace()
+    workspace.add_document(getattr(backend, "MASTER_TEMPLATE_ID"), f"{args.department} template",
+                           fakes.build_units(fixtures.template_blocks(backend)))
+
+    captured = {}
+    real_call = resilience.call
+
+    def capturing_call(fn, service, *call_args, **call_kwargs):
+        result = real_call(fn, service, *call_args, **call_kwargs)
+        if service == "gemini":
+            captured["response"] = result
+        return result
+
+    images = [Image.open(path) for path in args.images]
+    resilience.call = capturing_call
+    try:
+        with harness.offline(backend, workspace, backend.genai):
+            result = backend.run_pipeline(images, model_choice=args.model)
+    finally:
+        resilience.call = real_call
+
+    response = captured.get("response")
+    if response is None:
+        print(f"No Gemini response captured: {result}")
+        return 1
+
+    usage = response.usage_metadata
+    fixtures.save_fixture(args.department, {
+        "department": args.department,
+        "model": args.model,
+        "synthetic": False,
+        "text": response.text,
+        "usage": {"prompt_token_count": usage.prompt_token_count, "candidates_token_count": usage.candidates_token_count},
+        "recorded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    })
+    print(f"Saved {fixtures.fixture_path(args.department)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
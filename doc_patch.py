@@ -0,0 +1,267 @@
+import re
+import json
+import bisect
+from collections import Counter
+
+import resilience   # Shared timeouts, retry/backoff and circuit breaker for Google calls
+import rate_limit   # Process-wide token buckets for Gemini / Drive / Docs quotas
+import docs_batch   # Template scan cache + request ordering
+import postprocess  # Safe filenames
+import structured_log  # JSON-lines logging with case context
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# INCREMENTAL RE-GENERATION (Fix one field without "Start Over")
+# ==============================================================================
+# Correcting one field (say the discharge medication list) used to mean Start
+# Over: a new Gemini extraction, a new template copy, every grid and a new
+# export. Now each case keeps the text values its document was filled with,
+# and a correction goes into the EXISTING document as one small batchUpdate
+# that only touches the changed fields. A section can also be re-read from
+# the notes on its own (a short prompt with just that group's rules).
+#
+# Once filled, the {{placeholders}} are gone from the document, so a field is
+# found again through its template paragraph: "Pallor: {{pallor}} Icterus:
+# {{icterus}}" filled with the values we wrote is the exact text to look for,
+# and the field's offset inside it is known. A paragraph that isn't in the
+# document exactly as written (edited by hand in Docs, or too generic to be
+# unique) is skipped and reported - never guessed.
+#
+# Lab grids are not patched: their anchors are gone and long admissions spill
+# into continuation tables. Wrong grid values still need Start Over.
+
+_PLACEHOLDER_SPLIT = re.compile(f"({docs_batch.PLACEHOLDER_PATTERN.pattern})")
+
+MODEL_MAP = {
+    "Gemini 2.5 Flash": "models/gemini-2.5-flash",
+    "Gemini 2.5 Pro": "models/gemini-2.5-pro",
+    "Gemini 3.0 Pro": "models/gemini-3-pro-preview"
+}
+
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+SECTION_PROMPT = """
+    You are an expert Medical Scribe.
+    I have provided {pages} images of handwritten patient notes.
+
+    A discharge summary was already written from these notes. The clinician wants
+    ONE section read again. Re-read every page carefully and extract ONLY the
+    placeholders listed below, following each placeholder's rule exactly.
+
+    - Return ONLY valid JSON. Keys must match the placeholders exactly (e.g. "{{{{pallor}}}}").
+    - Values must be PLAIN TEXT. Do NOT include brackets {{{{ }}}} in the values.
+    - Keep lists Line-by-Line (one item per line).
+    - If something is not in the notes, return "NOT_FOUND" for it.
+
+    PLACEHOLDERS: {rules}
+    """
+
+
+class _Segment:
+    """Stitched text of one body / header / footer, with a map back to document indices."""
+
+    def __init__(self, segment_id, content):
+        self.segment_id = segment_id
+        self.paragraph_starts = set()
+        self._offsets = []   # Text offset where each run starts
+        self._indices = []   # Document index of that run's first character
+        parts = []
+        length = 0
+        for element in docs_batch.iter_paragraphs(content):
+            self.paragraph_starts.add(length)
+            for run in element['paragraph'].get('elements', []):
+                text = run.get('textRun', {}).get('content', '')
+                if not text or 'startIndex' not in run:
+                    continue
+                self._offsets.append(length)
+                self._indices.append(run['startIndex'])
+                parts.append(text)
+                length += len(text)
+        self.text = "".join(parts)
+
+    def find_paragraphs(self, text):
+        """Text offsets where 'text' occurs starting at a paragraph boundary."""
+        hits = []
+        pos = self.text.find(text)
+        while pos != -1:
+            if pos in self.paragraph_starts:
+                hits.append(pos)
+            pos = self.text.find(text, pos + 1)
+        return hits
+
+    def index_of(self, offset):
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        return self._indices[i] + (offset - self._offsets[i])
+
+    def doc_range(self, start, end):
+        """(startIndex, endIndex) of text[start:end], or None if it isn't one unbroken run of text."""
+        if end == start:
+            return self.index_of(start), self.index_of(start)
+        first, last = self.index_of(start), self.index_of(end - 1)
+        if last - first != end - 1 - start:
+            return None  # Crosses a cell boundary, an image, ...
+        return first, last + 1
+
+
+def _replace_range(segment_id, doc_range, text):
+    """delete + insert for one field occurrence, as an atomic group for plan_batch()."""
+    start, end = doc_range
+    segment = {'segmentId': segment_id} if segment_id else {}
+    group = []
+    if end > start:
+        group.append({'deleteContentRange': {'range': dict(segment, startIndex=start, endIndex=end)}})
+    if text:
+        group.append({'insertText': {'location': dict(segment, index=start), 'text': text}})
+    return group
+
+
+def plan_patch(doc, paragraphs, written, changes):
+    """Requests that turn the 'written' values of the changed fields into 'changes'.
+
+    'paragraphs' are the template paragraphs holding placeholders, 'written' is
+    {placeholder: text} as the document was filled (anything missing was
+    blanked). Returns (requests, patched placeholders, skipped placeholders).
+    """
+    changed = {p: text for p, text in changes.items() if text != written.get(p, "")}
+    if not changed:
+        return [], set(), set()
+
+    doc_segments = [_Segment(segment_id, content) for segment_id, content in docs_batch.segments(doc)]
+    requests = []
+    skipped = set()
+
+    # A paragraph repeated in the template must be found exactly as often in the document
+    for template_text, expected in Counter(paragraphs).items():
+        pieces = _PLACEHOLDER_SPLIT.split(template_text)
+        if not any(piece in changed for piece in pieces[1::2]):
+            continue
+
+        filled = []
+        spans = []   # (placeholder, start, end) inside the filled paragraph
+        offset = 0
+        for i, piece in enumerate(pieces):
+            text = written.get(piece, "") if i % 2 else piece
+            if i % 2 and piece in changed:
+                spans.append((piece, offset, offset + len(text)))
+            filled.append(text)
+            offset += len(text)
+        filled = "".join(filled)
+
+        hits = [(segment, pos) for segment in doc_segments for pos in segment.find_paragraphs(filled)]
+        if len(hits) != expected:
+            skipped.update(placeholder for placeholder, _, _ in spans)
+            continue
+
+        for segment, pos in hits:
+            for placeholder, start, end in spans:
+                doc_range = segment.doc_range(pos + start, pos + end)
+                if doc_range is None:
+                    skipped.add(placeholder)
+                    continue
+                requests.append(_replace_range(segment.segment_id, doc_range, changed[placeholder]))
+
+    # Fields the template never had are only updated in the cache
+    patched = set(changed) - skipped
+    return requests, patched, skipped
+
+
+def apply_patch(backend, doc_id, written, changes):
+    """Writes changed field values into an existing summary with ONE batchUpdate.
+
+    Returns a run_pipeline()-shaped result (link, id, revision, fields) plus
+    the placeholders that were patched and the ones that couldn't be found.
+    """
+    rate_limit.reset_wait()  # Quota wait time is reported per job
+    return _patch(backend, doc_id, written, changes)
+
+
+def _patch(backend, doc_id, written, changes):
+    creds = backend.get_user_credentials()
+    drive_service = resilience.build_service('drive', 'v3', creds)
+    docs_service = resilience.build_service('docs', 'v1', creds)
+
+    paragraphs = docs_batch.template_paragraphs(drive_service, docs_service, backend.MASTER_TEMPLATE_ID)
+    if paragraphs is None:
+        return {"error": "Could not read the department template. Try again in a minute."}
+
+    log.stage("patch", "Patching", document_id=doc_id)
+    doc = resilience.execute(docs_service.documents().get(documentId=doc_id), "docs")
+    requests, patched, skipped = plan_patch(doc, paragraphs, written, changes)
+
+    revision_id = doc.get('revisionId')
+    if requests:
+        body = {'requests': docs_batch.plan_batch(requests)}
+        if revision_id:
+            # Indices come from this exact snapshot - fail rather than write into a doc edited meanwhile
+            body['writeControl'] = {'requiredRevisionId': revision_id}
+        update_response = resilience.execute(docs_service.documents().batchUpdate(documentId=doc_id, body=body), "docs")
+        revision_id = update_response.get('writeControl', {}).get('requiredRevisionId')
+        log.info("Fields patched", fields=len(patched), requests=len(body['requests']))
+    if skipped:
+        log.warning("Fields not found as written (left unchanged)", placeholders=sorted(skipped))
+
+    fields = dict(written)
+    fields.update({placeholder: changes[placeholder] for placeholder in patched})
+    return {
+        "link": f"https://docs.google.com/document/d/{doc_id}",
+        "id": doc_id,
+        "revision": revision_id,
+        "fields": fields,
+        "patched": sorted(patched),
+        "skipped": sorted(skipped),
+        "cost": "N/A",
+        "queue_wait": round(rate_limit.waited(), 1)
+    }
+
+
+def extract_fields(backend, image_list, placeholders, model_choice="Gemini 2.5 Pro"):
+    """Re-reads the notes for just these placeholders.
+
+    Returns ({placeholder: clean text}, cost display, cost log text).
+    """
+    rules = {p: backend.placeholder_rules[p] for p in placeholders if p in backend.placeholder_rules}
+    selected_model_id = MODEL_MAP.get(model_choice, "models/gemini-2.5-pro")
+    clean_model_name = selected_model_id.replace("models/", "")
+    log.stage("reextract", "Re-extracting", fields=len(rules), model=selected_model_id)
+
+    backend.genai.configure(api_key=backend.GENAI_API_KEY)
+    model = backend.genai.GenerativeModel(selected_model_id, safety_settings=SAFETY_SETTINGS)
+
+    prompt_content = [SECTION_PROMPT.format(pages=len(image_list), rules=json.dumps(rules))]
+    prompt_content.extend(image_list)
+
+    est_tokens = rate_limit.estimate_input_tokens(prompt_content)
+    response = resilience.call(model.generate_content, "gemini", prompt_content, request_options=resilience.gemini_request_options(),
+                               before_attempt=lambda: rate_limit.wait_for_gemini(clean_model_name, est_tokens, backend.RATE_LIMITS))
+    rate_limit.settle_gemini_tokens(clean_model_name, est_tokens, getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None), backend.RATE_LIMITS)
+
+    cost_display, log_content = backend.log_usage(response, clean_model_name, note=f"Section Re-extraction ({model_choice})")
+
+    raw_text = response.text
+    start_index = raw_text.find('{')
+    end_index = raw_text.rfind('}') + 1
+    if start_index == -1 or end_index == 0:
+        raise ValueError("AI failed to generate JSON. Try again.")
+    extracted_data = json.loads(raw_text[start_index:end_index])
+    # The department's own post-processing rules, exactly as run_pipeline() cleans a text field
+    return {p: backend.POSTPROCESS.clean(p, extracted_data.get(p, "")) for p in rules}, cost_display, log_content
+
+
+def reextract_section(backend, image_list, doc_id, written, placeholders, model_choice="Gemini 2.5 Pro"):
+    """Re-reads one placeholder group from the notes and patches only what changed."""
+    rate_limit.reset_wait()
+    values, cost_display, log_content = extract_fields(backend, image_list, placeholders, model_choice)
+    if log_content:
+        patient_name = postprocess.safe_filename(written.get("{{patient_name}}") or "Unknown")
+        backend.log_cost_to_drive(log_content, patient_name)
+
+    result = _patch(backend, doc_id, written, values)
+    if "error" not in result:
+        result["cost"] = cost_display
+    return result
@@ -0,0 +1,219 @@
+import re
+import time
+import threading
+
+import resilience
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# DOCS REQUEST PLANNER (One atomic batchUpdate per case)
+# ==============================================================================
+# Grid cells are filled with index-based insertText requests that were
+# computed from ONE documents().get() snapshot. Text placeholders are filled
+# with replaceAllText, which changes the length of the document and would
+# shift every index after it. Inside a single batchUpdate the requests run in
+# order, so the plan is:
+#   1. every index-based request, highest index first (an insert never moves
+#      the text in front of it, so the remaining indices stay valid)
+#   2. then every replaceAllText (these search by text, not by index), which
+#      also removes the grid anchors like {{LAB_ANCHOR}}
+# Overflow tables for long admissions (insertTable + its cell inserts) travel
+# as atomic groups placed at the index where the table goes in.
+#
+# Only placeholders that actually exist in the department template are sent.
+# The template is scanned once per Drive revision and the result is cached
+# (the placeholders, plus the template paragraphs that hold them - doc_patch
+# uses those to find a filled field again later).
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{[^{}]+\}\}")
+TEMPLATE_CHECK_SECONDS = 300  # How often to ask Drive whether the template changed
+
+_template_cache = {}     # (template_id, version) -> (frozenset of placeholders, paragraphs holding them)
+_template_checked = {}   # template_id -> (checked_at, version)
+_template_lock = threading.Lock()
+
+
+def request_index(request):
+    """The document index a request writes at (0 for requests that don't use one)."""
+    for body in request.values():
+        if not isinstance(body, dict):
+            continue
+        if 'location' in body:
+            return body['location'].get('index', 0)
+        if 'range' in body:
+            return body['range'].get('startIndex', 0)
+    return 0
+
+
+def plan_batch(requests):
+    """Orders grid inserts and text replacements so they can be sent in ONE batchUpdate.
+
+    An item may also be a LIST of requests - an atomic group (e.g. insertTable
+    followed by the inserts that fill the new table). A group is placed by the
+    index of its first request and its own order is kept.
+    """
+    index_requests = []
+    replace_requests = []
+    seen_placeholders = set()
+
+    for req in requests:
+        if isinstance(req, list):
+            index_requests.append(req)
+        elif 'replaceAllText' in req:
+            placeholder = req['replaceAllText']['containsText']['text']
+            # After the first replace the placeholder is gone - a second one can never match
+            if placeholder in seen_placeholders:
+                continue
+            seen_placeholders.add(placeholder)
+            replace_requests.append(req)
+        else:
+            index_requests.append(req)
+
+    # Stable sort: requests at the same index keep the order they were planned in
+    index_requests.sort(key=lambda item: request_index(item[0] if isinstance(item, list) else item), reverse=True)
+
+    planned = []
+    for item in index_requests:
+        if isinstance(item, list):
+            planned.extend(item)
+        else:
+            planned.append(item)
+    return planned + replace_requests
+
+
+def replace_request(placeholder, text):
+    return {
+        'replaceAllText': {
+            'containsText': {'text': placeholder, 'matchCase': True},
+            'replaceText': text
+        }
+    }
+
+
+def iter_paragraphs(elements):
+    """Yields every paragraph element, including paragraphs inside tables."""
+    for element in elements:
+        if 'paragraph' in element:
+            yield element
+        elif 'table' in element:
+            for row in element['table'].get('tableRows', []):
+                for cell in row.get('tableCells', []):
+                    yield from iter_paragraphs(cell.get('content', []))
+        elif 'tableOfContents' in element:
+            yield from iter_paragraphs(element['tableOfContents'].get('content', []))
+
+
+def _paragraph_texts(elements):
+    """Yields the stitched text of every paragraph, including paragraphs inside tables."""
+    for element in iter_paragraphs(elements):
+        yield "".join(
+            run['textRun'].get('content', '')
+            for run in element['paragraph'].get('elements', [])
+            if 'textRun' in run
+        )
+
+
+def segments(doc):
+    """(segmentId, content) of the body ("") and of every header, footer and footnote."""
+    yield "", doc.get('body', {}).get('content', [])
+    for section in ('headers', 'footers', 'footnotes'):
+        for segment_id, part in doc.get(section, {}).items():
+            yield segment_id, part.get('content', [])
+
+
+def scan_placeholders(doc):
+    """Every {{placeholder}} in a Docs document (body, headers, footers and footnotes)."""
+    found = set()
+    for _, content in segments(doc):
+        for text in _paragraph_texts(content):
+            if '{{' in text:
+                found.update(PLACEHOLDER_PATTERN.findall(text))
+    return frozenset(found)
+
+
+def placeholder_paragraphs(doc):
+    """The full text of every paragraph that holds at least one {{placeholder}}."""
+    return tuple(
+        text
+        for _, content in segments(doc)
+        for text in _paragraph_texts(content)
+        if PLACEHOLDER_PATTERN.search(text)
+    )
+
+
+def _scan_template(drive_service, docs_service, template_id):
+    """(placeholders, paragraphs) of the master template, scanned once per template revision."""
+    now = time.monotonic()
+    with _template_lock:
+        checked = _template_checked.get(template_id)
+
+    if checked and now - checked[0] < TEMPLATE_CHECK_SECONDS:
+        version = checked[1]
+    else:
+        meta = resilience.execute(drive_service.files().get(fileId=template_id, fields='version', supportsAllDrives=True), "drive")
+        version = meta.get('version')
+        with _template_lock:
+            _template_checked[template_id] = (now, version)
+
+    key = (template_id, version)
+    with _template_lock:
+        cached = _template_cache.get(key)
+    if cached is not None:
+        return cached
+
+    log.info("Scanning template placeholders", revision=version)
+    template_doc = resilience.execute(docs_service.documents().get(documentId=template_id), "docs")
+    scanned = (scan_placeholders(template_doc), placeholder_paragraphs(template_doc))
+    with _template_lock:
+        # Older revisions of this template are never needed again
+        for old_key in [k for k in _template_cache if k[0] == template_id]:
+            del _template_cache[old_key]
+        _template_cache[key] = scanned
+    return scanned
+
+
+def template_placeholders(drive_service, docs_service, template_id):
+    """Placeholders in the master template, scanned once per template revision.
+
+    Returns None if the template can't be read, so callers can fall back to
+    sending every placeholder like before.
+    """
+    try:
+        return _scan_template(drive_service, docs_service, template_id)[0]
+    except Exception as e:
+        log.warning("Template scan failed - sending every placeholder", error=e)
+        return None
+
+
+def template_paragraphs(drive_service, docs_service, template_id):
+    """Template paragraphs holding placeholders (same cache as template_placeholders), or None."""
+    try:
+        return _scan_template(drive_service, docs_service, template_id)[1]
+    except Exception as e:
+        log.warning("Template scan failed", error=e)
+        return None
+
+
+def build_text_requests(values, placeholders=None):
+    """replaceAllText requests for {placeholder: text}, limited to what the template contains.
+
+    Filled placeholders come first. Every placeholder that ends up empty -
+    including template placeholders the AI never returned - is blanked in one
+    consolidated block at the end, so no raw {{...}} is left in the document.
+    """
+    filled = []
+    empty = []
+    for placeholder, text in values.items():
+        if placeholders is not None and placeholder not in placeholders:
+            continue  # Not in this template - the request could never match
+        if text:
+            filled.append(replace_request(placeholder, text))
+        else:
+            empty.append(placeholder)
+
+    if placeholders is not None:
+        empty.extend(sorted(p for p in placeholders if p not in values))
+
+    return filled + [replace_request(placeholder, "") for placeholder in empty]
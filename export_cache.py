@@ -0,0 +1,209 @@
+import os
+import time
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# SHARED .DOCX EXPORT CACHE (Lazy / prefetched downloads)
+# ==============================================================================
+# The Word export used to run on the Streamlit script thread the moment a case
+# finished, and the bytes were kept in every session's state whether or not
+# anybody downloaded them. Now the export happens in the background (or when
+# Download is clicked) and the bytes live in ONE process-wide LRU cache keyed
+# by (document ID, revision), bounded by total size in bytes.
+#
+# Exports pushed out of memory are spilled to a temp folder (also bounded), so
+# a resident who comes back to an old case still gets an instant download.
+# These are full discharge summaries, so the folder is private to the process
+# (mode 0700, one per process under SPILL_ROOT), deleted when the process
+# exits, and a spilled export is only kept for EXPORT_SPILL_HOURS. Folders
+# left behind by a crashed process are purged when the next one starts.
+
+EXPORT_CACHE_MB = int(os.getenv("EXPORT_CACHE_MB", "64"))
+EXPORT_SPILL_MB = int(os.getenv("EXPORT_SPILL_MB", "256"))
+EXPORT_SPILL_HOURS = float(os.getenv("EXPORT_SPILL_HOURS", "12"))
+
+SPILL_ROOT = os.path.join(tempfile.gettempdir(), "scribe_exports")
+
+
+class DocxCache:
+    """Size-aware LRU cache: (doc_id, revision) -> .docx bytes."""
+
+    def __init__(self, max_bytes=EXPORT_CACHE_MB * 1024 * 1024, spill_bytes=EXPORT_SPILL_MB * 1024 * 1024,
+                 spill_root=SPILL_ROOT, spill_ttl=EXPORT_SPILL_HOURS * 3600):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Second tier on disk: key -> (size, spilled at), oldest first
+        self.spill_bytes = spill_bytes
+        self.spill_root = spill_root
+        self.spill_ttl = spill_ttl
+        self.spill_dir = None  # Private folder, made on the first spill
+        self.spill_size = 0
+        self._spilled = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return data
+            data = self._read_spilled(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Back into memory - it's being downloaded again
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        if not data or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            self._items[key] = data
+            self.size += len(data)
+            # Evict least recently used exports until we're back under budget
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                self._spill(evicted_key, evicted)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._expire_spilled()
+            return key in self._items or key in self._spilled
+
+    def stats(self):
+        with self._lock:
+            self._expire_spilled()
+            return {
+                "items": len(self._items), "bytes": self.size, "max_bytes": self.max_bytes,
+                "spilled_items": len(self._spilled), "spilled_bytes": self.spill_size,
+                "hits": self.hits, "misses": self.misses,
+            }
+
+    # --- DISK TIER (caller holds self._lock) ---
+    def _spill_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, f"{name}.docx")
+
+    def _make_spill_dir(self):
+        os.makedirs(self.spill_root, mode=0o700, exist_ok=True)
+        # mkdtemp: mode 0700, readable by this user only
+        self.spill_dir = tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=self.spill_root)
+        atexit.register(shutil.rmtree, self.spill_dir, ignore_errors=True)
+
+    def _spill(self, key, data):
+        if not self.spill_bytes or len(data) > self.spill_bytes:
+            return
+        try:
+            if self.spill_dir is None:
+                self._make_spill_dir()
+            fd = os.open(self._spill_path(key), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            log.warning("Could not spill export to disk", error=e)
+            return
+        if key in self._spilled:
+            self.spill_size -= self._spilled.pop(key)[0]
+        self._spilled[key] = (len(data), time.time())
+        self.spill_size += len(data)
+        while self.spill_size > self.spill_bytes:
+            old_key, (old_size, _) = self._spilled.popitem(last=False)
+            self.spill_size -= old_size
+            self._remove_spilled_file(old_key)
+        self._expire_spilled()
+
+    def _expire_spilled(self):
+        cutoff = time.time() - self.spill_ttl
+        while self._spilled:
+            old_key, (old_size, spilled_at) = next(iter(self._spilled.items()))
+            if spilled_at >= cutoff:
+                break
+            del self._spilled[old_key]
+            self.spill_size -= old_size
+            self._remove_spilled_file(old_key)
+
+    def _read_spilled(self, key):
+        self._expire_spilled()
+        if key not in self._spilled:
+            return None
+        self.spill_size -= self._spilled.pop(key)[0]
+        try:
+            with open(self._spill_path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+        finally:
+            self._remove_spilled_file(key)
+
+    def _remove_spilled_file(self, key):
+        try:
+            os.remove(self._spill_path(key))
+        except OSError:
+            pass
+
+
+def purge_stale(root=SPILL_ROOT, max_age=EXPORT_SPILL_HOURS * 3600):
+    """Removes spill folders of processes that died without cleaning up (nothing in them is still valid)."""
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+
+purge_stale()
+docx_cache = DocxCache()
+
+# One export per document at a time (a prefetch and a click share the same result)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_docx(doc_id, revision, exporter):
+    """Returns the .docx bytes for this revision, calling exporter(doc_id) only on a cache miss."""
+    key = (doc_id, revision)
+    data = docx_cache.get(key)
+    if data is not None:
+        return data
+
+    with _inflight_lock:
+        lock = _inflight.setdefault(key, threading.Lock())
+
+    with lock:
+        # Somebody else may have finished the export while we waited
+        data = docx_cache.get(key)
+        if data is None:
+            data = exporter(doc_id)
+            docx_cache.put(key, data)
+
+    with _inflight_lock:
+        _inflight.pop(key, None)
+    return data
+
+
+def is_ready(doc_id, revision):
+    return (doc_id, revision) in docx_cache
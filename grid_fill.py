@@ -0,0 +1,243 @@
+import re
+import threading
+from operator import itemgetter
+
+# ==============================================================================
+# LAB GRID PLANNER (Shared by Medicine, Surgery and OBGYN)
+# ==============================================================================
+# fill_smart_grid() used to re-stitch the text of every run of every cell of
+# every table for EACH grid, and called normalize_key() on every test key for
+# every date. For a long admission (30+ dates x 26 rows, several grids) that
+# was a noticeable chunk of CPU per case.
+#
+# Now one documents().get() snapshot is flattened ONCE into a CellIndex (cell
+# text + endIndex for every top-level table cell), anchors are looked up in
+# that index, and the normalised test-order keys are computed once per list.
+# The requests produced are exactly the same as before.
+
+_STRIP_BRACKETS = str.maketrans("", "", "{}[]")
+_DATE = re.compile(r"\s*(\d{1,2})[/.-](\d{1,2})(?:[/.-](\d{2}|\d{4}))?\s*$")
+_MISSING = object()
+
+_order_cache = {}
+_order_lock = threading.Lock()
+
+# The AI repeats the same few dozen keys on every date - remember their normal form
+_key_cache = {}
+KEY_CACHE_SIZE = 4096
+
+
+def normalize_key(text):
+    """Turns 'EsR', 'esr', 'ESR', 'Es_r' into just 'esr' for easier matching."""
+    if not text: return ""
+    return str(text).lower().replace("_", "").replace(" ", "").replace("-", "").strip()
+
+
+def _normalized(key):
+    try:
+        return _key_cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        return normalize_key(key)  # Unhashable (shouldn't happen for dict keys)
+    value = normalize_key(key)
+    if len(_key_cache) < KEY_CACHE_SIZE:
+        _key_cache[key] = value
+    return value
+
+
+def date_order(date):
+    """Sort key for a grid date: 'DD/MM' or 'DD/MM/YY(YY)' by (year, month, day), so 25/01 comes
+    before 01/02. Keys that aren't dates go last, in string order."""
+    match = _DATE.match(str(date))
+    if not match:
+        return (1, 0, 0, 0, str(date))
+    day, month, year = match.groups()
+    year = int(year) if year else 0
+    if 0 < year < 100:
+        year += 2000
+    return (0, year, int(month), int(day), str(date))
+
+
+def normalized_order(test_order):
+    """normalize_key() of every row key, computed once per test-order list."""
+    key = tuple(test_order)
+    keys = _order_cache.get(key)
+    if keys is None:
+        keys = tuple(normalize_key(k) for k in test_order)
+        with _order_lock:
+            _order_cache[key] = keys
+    return keys
+
+
+class CellIndex:
+    """Flattened view of every top-level table cell in one documents().get() snapshot.
+
+    Cell texts are stitched lazily, in document order, only as far as an
+    anchor search needs - and never twice, however many grids are looked up.
+    Cell endIndex geometry is read only for the tables that hold a grid.
+    """
+
+    def __init__(self, doc):
+        self._content = doc.get('body', {}).get('content', [])
+        self.cells = []        # (content position, row, col, stitched text), filled as far as searched
+        self._scan = self._walk()
+        self._row_ends = {}
+        self._anchors = {}
+
+    def _walk(self):
+        for pos, element in enumerate(self._content):
+            if 'table' not in element:
+                continue
+            for r_idx, row in enumerate(element['table'].get('tableRows', [])):
+                for c_idx, cell in enumerate(row.get('tableCells', [])):
+                    yield pos, r_idx, c_idx, self._stitch(cell)
+
+    @staticmethod
+    def _stitch(cell):
+        text = ""
+        for item in cell.get('content', ()):
+            if 'paragraph' in item:
+                for run in item['paragraph']['elements']:
+                    if 'textRun' in run:
+                        text += run['textRun']['content']
+        return text
+
+    def find(self, anchor_name):
+        """(content position, row, col) of the first cell containing the anchor text, or None."""
+        if anchor_name in self._anchors:
+            return self._anchors[anchor_name]
+
+        # Search without the brackets (e.g. "{{LAB_ANCHOR}}" -> "LAB_ANCHOR")
+        clean_anchor_text = anchor_name.replace("{{", "").replace("}}", "").strip()
+        location = next(((pos, r, c) for pos, r, c, text in self.cells if clean_anchor_text in text), None)
+        if location is None:
+            for entry in self._scan:
+                self.cells.append(entry)
+                if clean_anchor_text in entry[3]:
+                    location = entry[:3]
+                    break
+
+        self._anchors[anchor_name] = location
+        return location
+
+    def table_end(self, table_pos):
+        """The index right after the table (where the next paragraph starts)."""
+        return self._content[table_pos]['endIndex']
+
+    def label_cells(self, table_pos, anchor_col):
+        """(row, col, text) of the non-empty row-label cells left of the date columns."""
+        labels = []
+        for r_idx, row in enumerate(self._content[table_pos]['table'].get('tableRows', [])):
+            for c_idx, cell in enumerate(row.get('tableCells', [])[:anchor_col]):
+                text = self._stitch(cell).rstrip("\n")
+                if text.strip():
+                    labels.append((r_idx, c_idx, text))
+        return labels
+
+    def row_ends(self, table_pos):
+        """[[cell endIndex per column] per row] of the table at this content position."""
+        ends = self._row_ends.get(table_pos)
+        if ends is None:
+            rows = self._content[table_pos]['table'].get('tableRows', [])
+            ends = [[cell.get('endIndex') for cell in row.get('tableCells', [])] for row in rows]
+            self._row_ends[table_pos] = ends
+        return ends
+
+
+def _fill_dates(inserts, dates, labs_data, keys, anchor_row, anchor_col, row_count, cell_insert_index):
+    """Appends (index, text) for each date column: the date in the anchor row, test values below it."""
+    for i, date in enumerate(dates):
+        target_col = anchor_col + i
+        try:
+            # A. Date header
+            header = cell_insert_index(anchor_row, target_col)
+            if header is None: continue
+            inserts.append((header, str(date)))
+
+            # B. Test values (the AI's keys come back in any case / spelling)
+            day_map = {_normalized(k): v for k, v in labs_data[date].items()}
+            for target_row, search_key in zip(range(anchor_row + 1, row_count), keys):
+                val = day_map.get(search_key, _MISSING)
+                if val is _MISSING: continue
+
+                val = str(val).translate(_STRIP_BRACKETS).strip()
+                if val:
+                    idx = cell_insert_index(target_row, target_col)
+                    if idx is not None:
+                        inserts.append((idx, val))
+        except Exception:
+            continue
+
+
+def _insert_requests(inserts):
+    # Highest index first (stable), so earlier inserts never shift later ones
+    inserts.sort(key=itemgetter(0), reverse=True)
+    return [{'insertText': {'location': {'index': idx}, 'text': text}} for idx, text in inserts]
+
+
+def new_table_cell_index(location, columns, row, col):
+    """Where text goes in cell (row, col) of an EMPTY table created by insertTable at 'location'.
+
+    insertTable puts a newline at 'location' and the table right after it; each
+    row takes 1 index and each empty cell 2 (the cell + its newline).
+    """
+    return location + 4 + row * (2 * columns + 1) + 2 * col
+
+
+def plan_grid(index, location, labs_data, test_order, anchor_name):
+    """insertText requests for {date: {test: value}} starting at the anchor cell, highest index first.
+
+    Dates go left to right from the anchor column, tests top to bottom from the
+    row below it. Values are matched case/underscore-insensitively.
+
+    Dates that don't fit (long admissions) are NOT dropped: the grid is
+    continued in as many empty copies of the table as needed, inserted right
+    after it in the same batchUpdate. Each copy is returned as one list - an
+    atomic group that docs_batch.plan_batch() keeps together and in order.
+    """
+    table_pos, anchor_row, anchor_col = location
+    row_ends = index.row_ends(table_pos)
+    column_count = len(row_ends[0])
+    row_count = len(row_ends)
+    keys = normalized_order(test_order)
+
+    dates = sorted(labs_data.keys(), key=date_order)
+    per_table = max(column_count - anchor_col, 0)
+
+    def cell_insert_index(row, col):
+        ends = row_ends[row]
+        return ends[col] - 1 if col < len(ends) else None
+
+    inserts = []  # (index, text)
+    _fill_dates(inserts, dates[:per_table], labs_data, keys, anchor_row, anchor_col, row_count, cell_insert_index)
+
+    requests = []
+    overflow = dates[per_table:] if per_table else []
+    if overflow:
+        blocks = [overflow[i:i + per_table] for i in range(0, len(overflow), per_table)]
+        after_table = index.table_end(table_pos)
+        labels = index.label_cells(table_pos, anchor_col)
+
+        # Every copy goes in at the same index, so the LAST block is inserted first
+        for block in reversed(blocks):
+            def clone_insert_index(row, col):
+                return new_table_cell_index(after_table, column_count, row, col)
+
+            block_inserts = [(clone_insert_index(r, c), text) for r, c, text in labels]
+            _fill_dates(block_inserts, block, labs_data, keys, anchor_row, anchor_col, row_count, clone_insert_index)
+            requests.append(
+                [{'insertTable': {'rows': row_count, 'columns': column_count, 'location': {'index': after_table}}}]
+                + _insert_requests(block_inserts)
+            )
+
+    requests.extend(_insert_requests(inserts))
+
+    # Clean the anchor text (replace {{ANCHOR}} with a space) after the inserts
+    requests.append({
+        'replaceAllText': {
+            'containsText': {'text': anchor_name, 'matchCase': True},
+            'replaceText': ' '
+        }
+    })
+    return requests
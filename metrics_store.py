@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import sqlite3
+import tempfile
+import threading
+import functools
+
+import resilience   # Per-case seconds spent in Gemini / Drive / Docs calls
+import structured_log  # JSON-lines logging with case context
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# THROUGHPUT METRICS (One sqlite row per finished job, live counters in memory)
+# ==============================================================================
+# Every job the app submits - a new case, an Edit & Regenerate patch, a section
+# re-extraction - is counted here:
+#   - live : jobs waiting for a worker and jobs running, per backend module
+#            (process-wide, every session's executor and the async loop)
+#   - done : one row per finished job - end-to-end time (submit -> result),
+#            seconds in Gemini / Drive / Docs calls, quota queue, cost, error
+# The admin page in app.py reads both. Nothing identifying a patient is
+# stored: no names, no field values, and error text is cut to ERROR_CHARS.
+#
+# Rows live in one sqlite file per process and expire after METRICS_DAYS.
+
+METRICS_DB = os.getenv("METRICS_DB", os.path.join(tempfile.gettempdir(), "scribe_metrics.sqlite3"))
+METRICS_DAYS = float(os.getenv("METRICS_DAYS", "30"))
+ERROR_CHARS = 120
+
+_COST = re.compile(r"[\d.]+")
+
+
+def parse_cost(cost_display):
+    """'₹3.18' -> 3.18 (0.0 for 'N/A' or anything unreadable)."""
+    match = _COST.search(str(cost_display or ""))
+    try:
+        return float(match.group(0)) if match else 0.0
+    except ValueError:
+        return 0.0
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+class Job:
+    """One submitted job, from submit() until finish()."""
+
+    def __init__(self, backend, kind):
+        self.backend = backend
+        self.kind = kind
+        self.submitted = time.time()
+        self.started = None
+        self.service_seconds = {}
+
+
+class MetricsStore:
+    def __init__(self, path=METRICS_DB, retention_days=METRICS_DAYS):
+        self.path = path
+        self.ttl = retention_days * 86400
+        self._db = None
+        self._lock = threading.Lock()
+        self._queued = {}  # backend -> jobs waiting for a worker
+        self._active = {}  # backend -> jobs running
+
+    def _connect(self):
+        # Caller holds the lock
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " finished REAL NOT NULL, backend TEXT NOT NULL, kind TEXT NOT NULL, ok INTEGER NOT NULL,"
+                " total_s REAL, wait_s REAL, gemini_s REAL, drive_s REAL, docs_s REAL, queue_s REAL,"
+                " cost REAL, error TEXT)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished)")
+            self._db.execute("DELETE FROM jobs WHERE finished < ?", (time.time() - self.ttl,))
+            self._db.commit()
+        return self._db
+
+    # --- LIVE COUNTERS ---
+    def submit(self, backend, kind="case"):
+        with self._lock:
+            self._queued[backend] = self._queued.get(backend, 0) + 1
+        return Job(backend, kind)
+
+    def start(self, job):
+        with self._lock:
+            self._queued[job.backend] -= 1
+            self._active[job.backend] = self._active.get(job.backend, 0) + 1
+        job.started = time.time()
+        job.service_seconds = resilience.start_case_timing()
+
+    def finish(self, job, result):
+        with self._lock:
+            self._active[job.backend] -= 1
+        if isinstance(result, dict):
+            error = result.get("error")
+        else:
+            error = result  # The backends return a plain string on failure
+        seconds = job.service_seconds
+        row = (
+            time.time(), job.backend, job.kind, 0 if error else 1,
+            time.time() - job.submitted, job.started - job.submitted,
+            seconds.get("gemini", 0.0), seconds.get("drive", 0.0), seconds.get("docs", 0.0),
+            result.get("queue_wait", 0.0) if isinstance(result, dict) else 0.0,
+            parse_cost(result.get("cost")) if isinstance(result, dict) else 0.0,
+            str(error)[:ERROR_CHARS] if error else None,
+        )
+        try:
+            with self._lock:
+                self._connect().execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                self._db.commit()
+        except sqlite3.Error as e:
+            log.warning("Metrics write failed", error=e)
+
+    def live(self):
+        """{backend: {"queued": n, "active": n}} right now."""
+        with self._lock:
+            backends = set(self._queued) | set(self._active)
+            return {b: {"queued": self._queued.get(b, 0), "active": self._active.get(b, 0)} for b in sorted(backends)}
+
+    # --- REPORTS ---
+    def _rows(self, since, columns):
+        try:
+            with self._lock:
+                return self._connect().execute(f"SELECT {columns} FROM jobs WHERE finished >= ? ORDER BY finished", (since,)).fetchall()
+        except sqlite3.Error as e:
+            log.warning("Metrics read failed", error=e)
+            return []
+
+    def summary(self, hours=24):
+        """Per backend over the last 'hours': jobs, errors, p50/p95 seconds, Gemini/Drive/Docs split, spend."""
+        rows = self._rows(time.time() - hours * 3600, "backend, kind, ok, total_s, wait_s, gemini_s, drive_s, docs_s, queue_s, cost")
+        report = {}
+        for backend, kind, ok, total, wait, gemini, drive, docs, queue, cost in rows:
+            entry = report.setdefault(backend, {"jobs": 0, "errors": 0, "totals": [], "worker_wait": 0.0,
+                                                "gemini": 0.0, "drive": 0.0, "docs": 0.0, "quota": 0.0, "cost": 0.0})
+            entry["jobs"] += 1
+            entry["errors"] += 0 if ok else 1
+            entry["cost"] += cost or 0.0
+            for name, value in (("worker_wait", wait), ("gemini", gemini), ("drive", drive), ("docs", docs), ("quota", queue)):
+                entry[name] += value or 0.0
+            if ok and kind == "case":
+                entry["totals"].append(total)  # Latency is for whole cases only - a patch takes seconds
+
+        for entry in report.values():
+            totals = entry.pop("totals")
+            entry["cases"] = len(totals)
+            entry["p50"] = percentile(totals, 50)
+            entry["p95"] = percentile(totals, 95)
+            entry["error_rate"] = entry["errors"] / entry["jobs"] if entry["jobs"] else 0.0
+        return report
+
+    def hourly(self, hours=24):
+        """{hour start (epoch): {backend: jobs finished OK}} for the last 'hours'."""
+        buckets = {}
+        for finished, backend, ok in self._rows(time.time() - hours * 3600, "finished, backend, ok"):
+            if ok:
+                hour = int(finished // 3600 * 3600)
+                counts = buckets.setdefault(hour, {})
+                counts[backend] = counts.get(backend, 0) + 1
+        return buckets
+
+    def recent_errors(self, limit=10):
+        rows = self._rows(time.time() - self.ttl, "finished, backend, kind, error")
+        return [row for row in rows if row[3]][-limit:][::-1]
+
+
+metrics = MetricsStore()
+
+
+def tracked(job, task):
+    """Wraps a worker function so the job is counted as running while it runs."""
+    @functools.wraps(task)
+    def run(*args, **kwargs):
+        metrics.start(job)
+        result = None
+        try:
+            result = task(*args, **kwargs)
+            return result
+        finally:
+            metrics.finish(job, result if result is not None else {"error": "crashed"})
+    return run
+
+
+def tracked_async(job, task):
+    """tracked() for a coroutine function (ASYNC_PIPELINE=1)."""
+    @functools.wraps(task)
+    async def run(*args, **kwargs):
+        metrics.start(job)
+        result = None
+        try:
+            result = await task(*args, **kwargs)
+            return result
+        finally:
+            metrics.finish(job, result if result is not None else {"error": "crashed"})
+    return run
@@ -1,28 +1,35 @@
-import io # Required for handling image bytes
-import time
 from googleapiclient.http import MediaIoBaseUpload # Required for uploading files to Drive
 
 import warnings
 warnings.filterwarnings("ignore")
 
 
-import socket
-socket.setdefaulttimeout(600)  # Force Windows to wait 600 seconds (10 mins) before failing
-
 import google.generativeai as genai
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 import json
 import os
-import re  # The Nuclear Cleaning Tool
+import sys
 from dotenv import load_dotenv  # Loads the secret .env file
 
 import csv
 import datetime
 from pathlib import Path
 
+import token_cache  # Shared in-memory Google credentials
+import resilience   # Shared timeouts, retry/backoff and circuit breaker for Google calls
+import rate_limit   # Process-wide token buckets for Gemini / Drive / Docs quotas
+import docs_batch   # Plans grid + text fills into ONE batchUpdate
+import grid_fill    # Flattened cell index + precomputed keys for the lab grids
+import transcribe   # Two-stage mode: parallel page transcripts + page cache
+import postprocess  # One-pass cleaning of the AI's JSON (per-department profile)
+import prompts      # Department prompts compiled once at import
+import preprocess   # PDF / TIFF pages, typed pages sent as text
+import pipeline_async  # The same case as a coroutine (many cases on one event loop)
+import template_pool  # Template copied while Gemini runs, renamed once the name is known
+import tracing      # Spans around Gemini / Drive / Docs calls (TRACING=file|otlp)
+import structured_log  # JSON-lines logging with case context
+
+log = structured_log.get_logger(__name__)
+
 # --- PRICING TABLE (Jan 2026) ---
 # We define the cost per 1 Million tokens for your models
 PRICING = {
@@ -32,6 +39,15 @@ PRICING = {
     "gemini-3-pro-preview":   {"input": 2.00, "output": 12.00}
 }
 
+# --- RATE LIMITS (per minute, shared by ALL departments in this process) ---
+# Keep these a little under your AI Studio quota so bursts queue instead of failing.
+RATE_LIMITS = {
+    "gemini-2.5-pro":   {"requests": 150, "input_tokens": 2_000_000},
+    "gemini-2.5-flash": {"requests": 1000, "input_tokens": 1_000_000},
+    "gemini-3-flash-preview": {"requests": 1000, "input_tokens": 1_000_000},
+    "gemini-3-pro-preview":   {"requests": 50, "input_tokens": 1_000_000}
+}
+
 def log_usage(response, model_name, note=""):
     try:
         # 1. Get Token Counts
@@ -52,14 +68,14 @@ def log_usage(response, model_name, note=""):
             f"Cost: {cost_string}\n"
         )
         
-        print(f"   [💰 Cost Logged: {cost_string} for {note}]")
+        log.info("Cost logged", cost=cost_string, note=note)
         
         # --- CRITICAL FIX: You MUST return these two values ---
         return cost_string, log_details 
         # ------------------------------------------------------
 
     except Exception as e:
-        print(f"   [⚠️ Cost Logging Failed: {e}]")
+        log.warning("Cost logging failed", error=e)
         # In case of error, return defaults so it doesn't crash
         return "N/A", ""
 
@@ -83,8 +99,7 @@ FEEDBACK_FOLDER_ID = os.getenv("FEEDBACK_FOLDER_ID")   # <--- Shared
 
 # 3. Safety Check
 if not GENAI_API_KEY or not MASTER_TEMPLATE_ID:
-    print("CRITICAL ERROR: Keys are missing.")
-    print("Make sure you created the '.env' file with your API keys.")
+    log.error("Keys are missing - create the '.env' file with GENAI_API_KEY and MASTER_TEMPLATE_ID")
     exit()
 
 # ==============================================================================
@@ -113,6 +128,11 @@ OBS_TEST_ORDER = [
     "urine_cs"             # Row 14
 ]
 
+# ALL GRIDS: (AI JSON key, row order, anchor cell text in the template, label)
+GRIDS = [
+    ("{{labs_json}}", OBS_TEST_ORDER, "{{LAB_ANCHOR}}", "OBGYN Lab Grid"),  # Ensure Doc cell has ONLY the anchor text
+]
+
 
 
 # ==============================================================================
@@ -421,151 +441,124 @@ placeholder_rules = {
 }
 
 
+# --- PLACEHOLDER GROUPS ("Re-extract Section" on a finished case) ---
+# Text fields only - the lab grids are not patched in place.
+# (HPLC / smear / USG series are unpacked from JSON in run_pipeline - fix those by hand)
+PLACEHOLDER_GROUPS = {
+    "Patient Details": ["{{patient_name}}", "{{uhid}}", "{{age}}", "{{address}}", "{{aadhar}}", "{{unit}}", "{{unit_incharge}}", "{{doa}}", "{{dod}}", "{{consultant}}"],
+    "Diagnosis & Management": ["{{diagnosis}}", "{{management}}", "{{lscs_date}}"],
+    "History": ["{{brief_history}}", "{{anc_history_t1}}", "{{anc_history_t2_t3}}", "{{lmp}}", "{{pmc}}", "{{obs_history}}", "{{past_history}}", "{{family_history}}", "{{surgical_history}}"],
+    "General Exam & Vitals": ["{{pallor}}", "{{icterus}}", "{{cyanosis}}", "{{clubbing}}", "{{lymphadenopathy}}", "{{edema}}", "{{gc}}", "{{pulse}}", "{{rr}}", "{{bp}}", "{{temp}}", "{{spo2}}", "{{Height}}", "{{Weight}}", "{{blood_group}}"],
+    "Systemic Exam": ["{{cvs_exam}}", "{{rs_exam}}", "{{pa_exam}}", "{{le_exam}}", "{{pv_exam}}"],
+    "Hospital & Post-op Course": ["{{hospital_course}}", "{{per_op_findings}}", "{{post_op_course}}"],
+    "Discharge Advice": ["{{discharge_advice}}"],
+    "Baby Details": ["{{sex_of_baby}}", "{{birth_date_time}}", "{{birth_weight}}", "{{apgar_score}}"],
+    "Staff": ["{{junior_residents}}", "{{senior_residents}}", "{{consultants}}"],
+}
+
+
 # ==============================================================================
-# SECTION D: THE LOGIC ENGINE
+# POST-PROCESSING PROFILE (How this department's JSON is cleaned, see postprocess.py)
 # ==============================================================================
+POSTPROCESS = postprocess.Profile(
+    grid_keys=[data_key for data_key, _, _, _ in GRIDS],
+    slots=[
+        # {'hplc': [...], 'ps': [...]} -> 4 HPLC + 4 Peripheral Smear report slots
+        postprocess.SlotRule("{{hplc_smear_json}}", "hplc", "hplc", "HPLC", 4),
+        postprocess.SlotRule("{{hplc_smear_json}}", "ps", "ps", "Peripheral Smear", 4),
+        # [...] -> 7 USG OBS report slots
+        postprocess.SlotRule("{{usg_series_json}}", None, "usg", "USG OBS", 7),
+    ],
+)
 
-def get_user_credentials():
-    """Handles Google Login with Aggressive Retries for Cloud Stability."""
-    SCOPES = ['https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/drive']
-    creds = None
-    
-    # --- PHASE 1: AGGRESSIVE RETRY LOOP (Max 5 Seconds) ---
-    # We try 5 times to grab the token.json in case it is being written or is locked.
-    for attempt in range(5):
-        if os.path.exists('token.json'):
-            try:
-                creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-                if creds and creds.valid:
-                    # Found it! Stop waiting and return immediately.
-                    return creds
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                    return creds
-            except Exception as e:
-                print(f"⚠️ Attempt {attempt+1}: token.json found but read failed ({e}). Retrying...")
-        else:
-            print(f"⚠️ Attempt {attempt+1}: token.json not found yet. Retrying...")
-        
-        # Wait 1 second before trying again (unless it's the last attempt)
-        if attempt < 4:
-            time.sleep(1)
 
-    # --- PHASE 2: IF TOKEN STILL FAILS AFTER 5 TRIES ---
-    
-    # CRITICAL CHECK: Only try browser login if we are LOCALLY running (File exists).
-    # This prevents the "No such file" crash on Streamlit Cloud.
-    if CLIENT_SECRET_FILE and os.path.exists(CLIENT_SECRET_FILE):
-        print("--- Launching Browser for Local Login... ---")
-        flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES)
-        creds = flow.run_local_server(port=0)
-        
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-        return creds
-    
-    else:
-        # If we are on Cloud and Token failed 5 times, STOP HERE.
-        # Do not crash. Just raise a clear error.
-        raise Exception("CRITICAL ERROR: Could not load 'token.json' after 5 attempts. The Google Token in Secrets is missing or invalid.")
-
-
-def normalize_key(text):
-    """Turns 'EsR', 'esr', 'ESR', 'Es_r' into just 'esr' for easier matching."""
-    if not text: return ""
-    return str(text).lower().replace("_", "").replace(" ", "").replace("-", "").strip()
-
-def fill_smart_grid(service, doc_id, labs_data, test_order, anchor_name):
-    """Fills grid starting EXACTLY at the anchor column."""
-    print(f"   -> Processing Grid for Anchor: {anchor_name}...")
-    doc = service.documents().get(documentId=doc_id).execute(num_retries=5)
-    content = doc.get('body').get('content')
-
-    anchor_found = False
-    table_index = -1
-    anchor_row = -1
-    anchor_col = -1
+# ==============================================================================
+# THE PROMPT (Built once at import - a case only fills in the page count)
+# ==============================================================================
+# --- YOUR CUSTOM PROMPT (MERGED WITH NEW LAB RULES) ---
+PROMPT = prompts.compile_prompt(f"""
+    You are a professional medical scribe. Extract data from the handwritten note below.
+
+    You are an expert Medical Scribe. 
+    I have provided {prompts.PAGES} images of handwritten patient notes.
     
-    clean_anchor_text = anchor_name.replace("{{", "").replace("}}", "").strip()
-
-    # 1. Find the Anchor
-    for i, element in enumerate(content):
-        if 'table' in element:
-            for r_idx, row in enumerate(element['table']['tableRows']):
-                for c_idx, cell in enumerate(row['tableCells']):
-                    full_cell_text = ""
-                    if 'content' in cell:
-                        for content_item in cell['content']:
-                            if 'paragraph' in content_item:
-                                for elem in content_item['paragraph']['elements']:
-                                    if 'textRun' in elem:
-                                        full_cell_text += elem['textRun']['content']
-                    
-                    if clean_anchor_text in full_cell_text:
-                        anchor_found = True
-                        table_index = i
-                        anchor_row = r_idx
-                        anchor_col = c_idx
-                        print(f"      FOUND {anchor_name} at Table {i}, Row {r_idx}, Col {c_idx}")
-                        break
-                if anchor_found: break
-        if anchor_found: break
+    ### CRITICAL INSTRUCTION: DEEP READING MODE
+    The handwriting is messy. Do NOT jump to the JSON immediately.
+
+    - Key: "{{labs_json}}". Keys: {OBS_TEST_ORDER} 
+
+    ### 0. LOGIC FOR LAB DATA (NEW):
+    - Extract ALL lab values associated with dates.
+    - Return a JSON object under key "{{labs_json}}".
+    # CHANGED: Uses OBS_TEST_ORDER now
+    - Keys must match EXACTLY: {OBS_TEST_ORDER} 
     
-    if not anchor_found:
-        print(f"      WARNING: {anchor_name} NOT FOUND.")
-        return []
 
-    requests = []
-    # 2. Clean the Anchor Text (So it doesn't stay behind)
-    requests.append({
-        'replaceAllText': {
-            'containsText': {'text': anchor_name, 'matchCase': True},
-            'replaceText': ' ' 
-        }
-    })
+    ### CRITICAL INSTRUCTION: SEMANTIC SEARCH
+    Understand the **biological meaning** of tests. 
+    - Map "CK-MB" or "Creatine Kinase-MB" to "cpkmb".
+    - Map "GeneXpert" or "MTB/RIF" to "csfcbnaat".
+    - Map "Cell Count" in CSF to "csftlc".
 
-    # 3. Sort Dates
-    sorted_dates = sorted(labs_data.keys())
-    table = content[table_index]['table']
 
-    # 4. Loop through Dates
-    for i, date in enumerate(sorted_dates):
-        # --- THE FIX IS HERE ---
-        # We use 'anchor_col + i' so the first date (i=0) goes exactly into the Anchor Cell.
-        target_col = anchor_col + i 
-        
-        if target_col >= len(table['tableRows'][0]['tableCells']): break
+    ### 1. LOGIC FOR "+ve / -ve" FIELDS:
+    For placeholders {{pallor}}, {{icterus}}, {{cyanosis}}, {{clubbing}}, {{lymphadenopathy}}, {{edema}}:
+    - READ the text carefully.
+    - If the note says "Present", "Positive", "++" -> Output: "Present"
+    - If the note says "Absent", "Negative", "--", "Nil", or DOES NOT MENTION it -> Output: "Absent"
 
-        try:
-            # A. Fill Date Header (Top Row)
-            cell = table['tableRows'][anchor_row]['tableCells'][target_col]
-            end_index = cell['endIndex'] - 1
-            requests.append({'insertText': {'location': {'index': end_index}, 'text': str(date)}})
-            
-            # B. Fill Test Values
-            day_map = {normalize_key(k): v for k, v in labs_data[date].items()}
-            
-            for test_idx, python_key in enumerate(test_order):
-                target_row = anchor_row + 1 + test_idx
-                
-                if target_row >= len(table['tableRows']): break
-                
-                search_key = normalize_key(python_key)
-                val = str(day_map.get(search_key, ""))
-                
-                # Cleanup
-                val = val.replace("{", "").replace("}", "").replace("[", "").replace("]", "").strip()
-
-                if val and val != "":
-                    try:
-                        cell = table['tableRows'][target_row]['tableCells'][target_col]
-                        end_index = cell['endIndex'] - 1
-                        requests.append({'insertText': {'location': {'index': end_index}, 'text': val}})
-                    except: pass
-        except: continue
-
-    # 5. Sort requests
-    requests.sort(key=lambda x: x.get('insertText', {}).get('location', {}).get('index', 0), reverse=True)
+
+    ### 3. RULES FOR RESIDENTS/FACULTY:
+    - Extract exact titles like "(SR): DR NAME", "(JR): DR NAME". 
+    - Keep them on separate lines.
+
+
+
+    ### 6. DATA CLEANING:
+    - Return ONLY valid JSON.
+    - Keys must match the placeholders exactly (e.g., "{{pallor}}").
+    - Values must be PLAIN TEXT. Do NOT include brackets {{ }} in the values.
+
+    ### INPUT DATA:
+    PLACEHOLDERS: {prompts.RULES}
+    """, placeholder_rules)
+
+
+# ==============================================================================
+# SECTION D: THE LOGIC ENGINE
+# ==============================================================================
+
+@tracing.traced("get_user_credentials")
+def get_user_credentials():
+    """Returns the shared, background-refreshed Google credentials (no disk I/O after first load)."""
+    return token_cache.get_credentials(CLIENT_SECRET_FILE)
+
+
+@tracing.traced("fill_smart_grid")
+def fill_smart_grid(service, doc_id, labs_data, test_order, anchor_name, doc=None, index=None):
+    """Fills grid starting EXACTLY at the anchor column. Pass "doc" (or its grid_fill.CellIndex) to reuse an already fetched snapshot."""
+    log.info("Processing grid", anchor=anchor_name)
+    tracing.current().set(anchor=anchor_name, dates=len(labs_data))
+    if index is None:
+        if doc is None:
+            doc = resilience.execute(service.documents().get(documentId=doc_id), "docs")
+        index = grid_fill.CellIndex(doc)
+
+    # 1. Find the Anchor (cell texts were stitched once, for all grids)
+    location = index.find(anchor_name)
+    if location is None:
+        log.warning("Grid anchor not found", anchor=anchor_name)
+        return []
+    table_index, anchor_row, anchor_col = location
+    log.info("Grid anchor found", anchor=anchor_name, table=table_index, row=anchor_row, col=anchor_col)
+
+    # 2. Dates across, tests down (case-insensitive keys), highest index first - then clear the anchor
+    requests = grid_fill.plan_grid(index, location, labs_data, test_order, anchor_name)
+
+    # Long stays: dates that don't fit continue in copies of the table (same batchUpdate)
+    extra_tables = sum(isinstance(req, list) for req in requests)
+    if extra_tables:
+        log.info("Grid continued in more tables", anchor=anchor_name, dates=len(labs_data), extra_tables=extra_tables)
     return requests
 
 # --- NEW: Upload Images to a Specific Folder ---
@@ -573,7 +566,7 @@ def upload_patient_images(image_list, patient_name):
     if not IMAGES_FOLDER_ID: return 
     
     creds = get_user_credentials()
-    drive_service = build('drive', 'v3', credentials=creds)
+    drive_service = resilience.build_service('drive', 'v3', creds)
     
     try:
         # 1. Create a Sub-Folder for this specific Patient
@@ -582,33 +575,32 @@ def upload_patient_images(image_list, patient_name):
             'parents': [IMAGES_FOLDER_ID],
             'mimeType': 'application/vnd.google-apps.folder'
         }
-        folder = drive_service.files().create(body=folder_metadata, fields='id').execute()
+        folder = resilience.execute(drive_service.files().create(body=folder_metadata, fields='id'), "drive")
         patient_folder_id = folder.get('id')
         
         # 2. Upload all images into that sub-folder
-        print(f"   -> Backing up {len(image_list)} images to Drive...")
+        log.info("Backing up pages", stage="backup", pages=len(image_list))
         for i, img in enumerate(image_list):
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='JPEG')
-            img_byte_arr.seek(0)
+            # A typed PDF page is backed up as .txt, everything else as .jpg
+            file_name, img_byte_arr, mimetype = preprocess.page_file(img, i + 1)
             
             file_metadata = {
-                'name': f"Page_{i+1}.jpg",
+                'name': file_name,
                 'parents': [patient_folder_id]
             }
-            media = MediaIoBaseUpload(img_byte_arr, mimetype='image/jpeg')
-            drive_service.files().create(body=file_metadata, media_body=media).execute()
+            media = MediaIoBaseUpload(img_byte_arr, mimetype=mimetype)
+            resilience.execute(drive_service.files().create(body=file_metadata, media_body=media), "drive")
             
     except Exception as e:
-        print(f"   ⚠️ Image Backup Failed: {e}")
+        log.warning("Image backup failed", stage="backup", error=e)
 
 # --- NEW: Save Cost Log to Drive ---
 def log_cost_to_drive(text_content, patient_name):
     if not COST_FOLDER_ID: return
     
     creds = get_user_credentials()
-    drive_service = build('drive', 'v3', credentials=creds)
-    docs_service = build('docs', 'v1', credentials=creds)
+    drive_service = resilience.build_service('drive', 'v3', creds)
+    docs_service = resilience.build_service('docs', 'v1', creds)
     
     try:
         # Create a simple Google Doc for the cost log
@@ -618,22 +610,22 @@ def log_cost_to_drive(text_content, patient_name):
             'parents': [COST_FOLDER_ID],
             'mimeType': 'application/vnd.google-apps.document'
         }
-        doc = drive_service.files().create(body=file_metadata).execute()
+        doc = resilience.execute(drive_service.files().create(body=file_metadata), "drive")
         
         # Write the cost details
         requests = [{'insertText': {'location': {'index': 1}, 'text': text_content}}]
-        docs_service.documents().batchUpdate(documentId=doc.get('id'), body={'requests': requests}).execute()
-        print("   -> Cost Log Saved to Drive.")
+        resilience.execute(docs_service.documents().batchUpdate(documentId=doc.get('id'), body={'requests': requests}), "docs")
+        log.info("Cost log saved", stage="cost_log")
     except Exception as e:
-        print(f"   ⚠️ Cost Drive Upload Failed: {e}")
+        log.warning("Cost log upload failed", stage="cost_log", error=e)
 
 # --- NEW: Save Feedback to Drive ---
 def save_feedback_online(text):
     if not FEEDBACK_FOLDER_ID: return False
     
     creds = get_user_credentials()
-    drive_service = build('drive', 'v3', credentials=creds)
-    docs_service = build('docs', 'v1', credentials=creds)
+    drive_service = resilience.build_service('drive', 'v3', creds)
+    docs_service = resilience.build_service('docs', 'v1', creds)
     
     try:
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -642,23 +634,30 @@ def save_feedback_online(text):
             'parents': [FEEDBACK_FOLDER_ID],
             'mimeType': 'application/vnd.google-apps.document'
         }
-        doc = drive_service.files().create(body=file_metadata).execute()
+        doc = resilience.execute(drive_service.files().create(body=file_metadata), "drive")
         
         requests = [{'insertText': {'location': {'index': 1}, 'text': text}}]
-        docs_service.documents().batchUpdate(documentId=doc.get('id'), body={'requests': requests}).execute()
+        resilience.execute(docs_service.documents().batchUpdate(documentId=doc.get('id'), body={'requests': requests}), "docs")
         return True
     except Exception as e:
-        print(f"Feedback Error: {e}")
+        log.warning("Feedback upload failed", error=e)
         return False
 
-def run_pipeline(image_list=None, model_choice="Gemini 2.5 Pro"):  # <--- 1. Accept model choice
+@structured_log.case_scope(department=__name__)
+@tracing.traced("case", department=__name__)
+def run_pipeline(image_list=None, model_choice="Gemini 2.5 Pro", two_stage=None):  # <--- 1. Accept model choice
     
     # 1. Validation
     if not image_list:
         return "Error: No images provided to Logic Engine."
+    tracing.current().set(model=model_choice, pages=len(image_list), image_bytes=tracing.image_bytes(image_list) if tracing.enabled() else None)
     
-    print("--- 1. Authenticating... ---")
+    log.stage("auth", "Authenticating", pages=len(image_list))
+    rate_limit.reset_wait()  # Quota wait time is reported per case
     creds = get_user_credentials()
+
+    # The template is copied under a temporary name while Gemini reads the notes
+    template_copy = template_pool.start_copy(creds, MASTER_TEMPLATE_ID, OUTPUT_FOLDER_ID)
     
     # 2. Map User Choice to Actual Model ID
     # This connects the Frontend Radio Button to the Backend Logic
@@ -671,7 +670,7 @@ def run_pipeline(image_list=None, model_choice="Gemini 2.5 Pro"):  # <--- 1. Acc
     # Default to Pro if something goes wrong
     selected_model_id = model_map.get(model_choice, "models/gemini-2.5-pro")
     
-    print(f"--- 2. AI Processing using {model_choice} ({selected_model_id}) ---")
+    log.stage("gemini", "AI processing", model=selected_model_id)
     
     genai.configure(api_key=GENAI_API_KEY)
     
@@ -685,53 +684,8 @@ def run_pipeline(image_list=None, model_choice="Gemini 2.5 Pro"):  # <--- 1. Acc
         ]
     )
 
-    # --- YOUR CUSTOM PROMPT (MERGED WITH NEW LAB RULES) ---
-    final_prompt_text = f"""
-    You are a professional medical scribe. Extract data from the handwritten note below.
-
-    You are an expert Medical Scribe. 
-    I have provided {len(image_list)} images of handwritten patient notes.
-    
-    ### CRITICAL INSTRUCTION: DEEP READING MODE
-    The handwriting is messy. Do NOT jump to the JSON immediately.
-
-    - Key: "{{labs_json}}". Keys: {OBS_TEST_ORDER} 
-
-    ### 0. LOGIC FOR LAB DATA (NEW):
-    - Extract ALL lab values associated with dates.
-    - Return a JSON object under key "{{labs_json}}".
-    # CHANGED: Uses OBS_TEST_ORDER now
-    - Keys must match EXACTLY: {OBS_TEST_ORDER} 
-    
-
-    ### CRITICAL INSTRUCTION: SEMANTIC SEARCH
-    Understand the **biological meaning** of tests. 
-    - Map "CK-MB" or "Creatine Kinase-MB" to "cpkmb".
-    - Map "GeneXpert" or "MTB/RIF" to "csfcbnaat".
-    - Map "Cell Count" in CSF to "csftlc".
-
-
-    ### 1. LOGIC FOR "+ve / -ve" FIELDS:
-    For placeholders {{pallor}}, {{icterus}}, {{cyanosis}}, {{clubbing}}, {{lymphadenopathy}}, {{edema}}:
-    - READ the text carefully.
-    - If the note says "Present", "Positive", "++" -> Output: "Present"
-    - If the note says "Absent", "Negative", "--", "Nil", or DOES NOT MENTION it -> Output: "Absent"
-
-
-    ### 3. RULES FOR RESIDENTS/FACULTY:
-    - Extract exact titles like "(SR): DR NAME", "(JR): DR NAME". 
-    - Keep them on separate lines.
-
-
-
-    ### 6. DATA CLEANING:
-    - Return ONLY valid JSON.
-    - Keys must match the placeholders exactly (e.g., "{{pallor}}").
-    - Values must be PLAIN TEXT. Do NOT include brackets {{ }} in the values.
-
-    ### INPUT DATA:
-    PLACEHOLDERS: {json.dumps(placeholder_rules)}
-    """
+    # --- YOUR CUSTOM PROMPT (compiled once at import, see PROMPT above) ---
+    final_prompt_text = PROMPT.render(len(image_list))
     
     # --- COMBINE PROMPT + IMAGES ---
     prompt_content = [final_prompt_text]
@@ -740,15 +694,28 @@ def run_pipeline(image_list=None, model_choice="Gemini 2.5 Pro"):  # <--- 1. Acc
     # Initialize variables
     cost_display = "N/A"
     log_content = ""
+    pages = None
 
-    try:
-        # Run AI
-        response = model.generate_content(prompt_content)
+    clean_model_name = selected_model_id.replace("models/", "")
 
-        clean_model_name = selected_model_id.replace("models/", "")
+    try:
+        if transcribe.enabled(two_stage):
+            # Two-stage: pages transcribed in parallel (earlier uploads come from the page cache),
+            # then the prompt below runs on the text only
+            pages = transcribe.transcribe_pages(model, clean_model_name, image_list, RATE_LIMITS, PRICING)
+            prompt_content = [final_prompt_text] + pages.prompt_parts()
+
+        # Run AI - every attempt (retries too) waits for its turn in the shared Gemini quota (all departments)
+        est_tokens = rate_limit.estimate_input_tokens(prompt_content)
+        response = resilience.call(model.generate_content, "gemini", prompt_content, request_options=resilience.gemini_request_options(),
+                                   before_attempt=lambda: rate_limit.wait_for_gemini(clean_model_name, est_tokens, RATE_LIMITS))
+        rate_limit.settle_gemini_tokens(clean_model_name, est_tokens, getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None), RATE_LIMITS)
         
         # --- NEW: Capture Cost Data ---
         cost_display, log_content = log_usage(response, clean_model_name, note=f"Medical Extraction ({model_choice})")
+        if pages is not None:
+            cost_display = pages.total_cost(response, clean_model_name, PRICING)
+            log_content += pages.log
         
         # Clean JSON
         raw_text = response.text
@@ -759,118 +726,21 @@ def run_pipeline(image_list=None, model_choice="Gemini 2.5 Pro"):  # <--- 1. Acc
                 json_text = raw_text[start_index:end_index]
                 extracted_data = json.loads(json_text)
 
-                # =========================================================
-                # LOGIC 1: UNPACK HPLC & PERIPHERAL SMEAR (Scope-Safe)
-                # =========================================================
-                # 1. Initialize Empty First (Prevents Crash if AI skips key)
-                safe_hplc_data = {} 
-
-                # 2. Try to fill it
-                if "{{hplc_smear_json}}" in extracted_data:
-                    val = extracted_data["{{hplc_smear_json}}"]
-                    if isinstance(val, str): 
-                        try: safe_hplc_data = json.loads(val)
-                        except: safe_hplc_data = {}
-                    elif isinstance(val, dict):
-                        safe_hplc_data = val
-                    
-                    # Remove key so it doesn't print
-                    del extracted_data["{{hplc_smear_json}}"]
-
-                # 3. Handle HPLC (4 slots) - Uses safe_hplc_data
-                hplc_list = safe_hplc_data.get("hplc", [])
-                for i in range(1, 5): # 1 to 4
-                    key_date = f"{{{{hplc_date_{i}}}}}"
-                    key_res = f"{{{{hplc_res_{i}}}}}"
-                    
-                    if i <= len(hplc_list):
-                        item = hplc_list[i-1]
-                        raw_date = item.get("date", "").strip()
-                        extracted_data[key_date] = f"HPLC ({raw_date})" if raw_date else "HPLC"
-                        extracted_data[key_res] = item.get("result", "")
-                    else:
-                        extracted_data[key_date] = ""
-                        extracted_data[key_res] = ""
-
-                # 4. Handle Peripheral Smear (4 slots)
-                ps_list = safe_hplc_data.get("ps", [])
-                for i in range(1, 5): # 1 to 4
-                    key_date = f"{{{{ps_date_{i}}}}}"
-                    key_res = f"{{{{ps_res_{i}}}}}"
-                    
-                    if i <= len(ps_list):
-                        item = ps_list[i-1]
-                        raw_date = item.get("date", "").strip()
-                        extracted_data[key_date] = f"Peripheral Smear ({raw_date})" if raw_date else "Peripheral Smear"
-                        extracted_data[key_res] = item.get("result", "")
-                    else:
-                        extracted_data[key_date] = ""
-                        extracted_data[key_res] = ""
-
-                # =========================================================
-                # LOGIC 2: UNPACK USG SERIES (Scope-Safe)
-                # =========================================================
-                # 1. Initialize Empty First
-                safe_usg_list = []
-
-                # 2. Try to fill it
-                if "{{usg_series_json}}" in extracted_data:
-                    val = extracted_data["{{usg_series_json}}"]
-                    if isinstance(val, str): 
-                        try: safe_usg_list = json.loads(val)
-                        except: safe_usg_list = []
-                    elif isinstance(val, list):
-                        safe_usg_list = val
-                    
-                    del extracted_data["{{usg_series_json}}"]
-
-                # 3. Loop 7 times (Safe)
-                for i in range(1, 8): 
-                    key_date = f"{{{{usg_date_{i}}}}}"
-                    key_res = f"{{{{usg_res_{i}}}}}"
-                    
-                    if i <= len(safe_usg_list):
-                        item = safe_usg_list[i-1]
-                        raw_date = item.get("date", "").strip()
-                        extracted_data[key_date] = f"USG OBS ({raw_date})" if raw_date else "USG OBS"
-                        extracted_data[key_res] = item.get("result", "")
-                    else:
-                        extracted_data[key_date] = ""
-                        extracted_data[key_res] = ""
-                
-                if "{{usg_series_json}}" in extracted_data: del extracted_data["{{usg_series_json}}"]
-                # Check if the AI returned the grids as "Strings" instead of "Objects"
-                grid_keys = ["{{labs_json}}", "{{cardiac_json}}", "{{csf_json}}"]
-                
-                for key in grid_keys:
-                    if key in extracted_data:
-                        val = extracted_data[key]
-                        
-                        # If it is a string (The Error Cause), try to fix it
-                        if isinstance(val, str):
-                            # Clean up common AI mistakes
-                            clean_val = val.replace("```json", "").replace("```", "").strip()
-                            # Fix single quotes to double quotes
-                            if clean_val.startswith("{") and "'" in clean_val:
-                                clean_val = clean_val.replace("'", '"')
-                            
-                            try:
-                                print(f"   -> Auto-Correcting stringified JSON for {key}...")
-                                extracted_data[key] = json.loads(clean_val)
-                            except:
-                                # If it's really broken, just make it empty so we don't crash
-                                extracted_data[key] = {}
-                # --- ROBUST FIX END ---
+                # Grids repaired, slots expanded, every text field cleaned - in ONE pass
+                processed = POSTPROCESS.run(extracted_data)
 
         else:
+                template_copy.discard()
+                log.error("AI reply has no JSON")
                 return "Error: AI failed to generate JSON. Try again."
             
     except Exception as e:
+        template_copy.discard()
+        log.error("AI processing failed", error=e)
         return f"AI Logic Error: {e}"
 
     # Determine filename
-    patient_name = extracted_data.get("{{patient_name}}", "Unknown")
-    patient_name = re.sub(r'[\\/*?:"<>|]', "", patient_name)
+    patient_name = processed.patient_name
     
     # --- NEW: Upload Images & Cost Log ---
     if image_list:
@@ -883,141 +753,107 @@ def run_pipeline(image_list=None, model_choice="Gemini 2.5 Pro"):  # <--- 1. Acc
     model_tag = "Flash" if "Flash" in model_choice else "Pro"
     new_filename = f"Discharge Summary - {patient_name} ({model_tag})"
 
-    print(f"--- 3. Creating File: '{new_filename}' ---")
-    drive_service = build('drive', 'v3', credentials=creds)
+    log.stage("create_file", "Creating file", model_tag=model_tag)
+    drive_service = resilience.build_service('drive', 'v3', creds)
 
-    file_metadata = {
-        'name': new_filename,
-        'parents': [OUTPUT_FOLDER_ID],
-        'mimeType': 'application/vnd.google-apps.document'
-    }
-    
     NEW_DOCUMENT_ID = None
     
-    # --- NETWORK RETRY LOOP (The Fix for 10060 Error) ---
-    # We try 3 times. If internet flickers, it won't crash.
-    for attempt in range(1, 4):
-        try:
-            print(f"   -> Attempt {attempt} to create file...")
-            copy_response = drive_service.files().copy(
-                fileId=MASTER_TEMPLATE_ID,
-                body=file_metadata,
-                supportsAllDrives=True
-            ).execute(num_retries=5) 
-            
-            NEW_DOCUMENT_ID = copy_response.get('id')
-            print(f"   --> SUCCESS! File Created ID: {NEW_DOCUMENT_ID}")
-            break # It worked! Exit the loop.
-            
-        except Exception as e:
-            print(f"   ⚠️ Attempt {attempt} Failed: {e}")
-            time.sleep(3) # Wait 3 seconds and try again
+    # --- NETWORK RETRY (The Fix for 10060 Error) ---
+    # resilience.execute() retries dropped connections / 5xx with backoff,
+    # so a flickering connection won't crash the case.
+    try:
+        # Copied while Gemini was running - only the rename is left
+        NEW_DOCUMENT_ID = template_copy.claim(drive_service, new_filename)
+        log.info("File created", document_id=NEW_DOCUMENT_ID)
+        
+    except Exception as e:
+        log.error("Template copy failed", error=e)
 
-    # If it FAILED all 3 times, then we stop.
+    # If it FAILED after all retries, then we stop.
     if not NEW_DOCUMENT_ID:
         return {"error": "Network Error: Internet is too slow or blocking Google Drive. Try disabling VPN/Firewall."}
 
-    print(f"--- 4. Filling Data... ---")
-    docs_service = build('docs', 'v1', credentials=creds)
+    log.stage("fill", "Filling data")
+    docs_service = resilience.build_service('docs', 'v1', creds)
 
-    if "{{labs_json}}" in extracted_data:
-        lab_data = extracted_data["{{labs_json}}"]
-        
-        # --- FIX 1: FORCE CONVERT STRING TO DICT ---
-        if isinstance(lab_data, str):
-            try:
-                print(f"   ⚠️ Lab data was a String. Converting to Dict...")
-                lab_data = json.loads(lab_data)
-            except Exception as e:
-                print(f"   ❌ JSON Conversion Failed: {e}")
-                lab_data = {}
-        # -------------------------------------------
+    # Read the fresh copy ONCE - the grid is planned against this snapshot
+    doc = resilience.execute(docs_service.documents().get(documentId=NEW_DOCUMENT_ID), "docs")
+    grid_index = grid_fill.CellIndex(doc)  # Flatten every table cell ONCE for all grids
+    grid_requests = []
+
+    # Placeholders that really exist in this template (scanned once per template revision)
+    template_placeholders = docs_batch.template_placeholders(drive_service, docs_service, MASTER_TEMPLATE_ID)
+
+    for data_key, test_order, anchor, label in GRIDS:
+        if data_key not in processed.grids: continue
+        lab_data = processed.grids[data_key]  # Already a dict if the AI sent it as a string
 
         # Check if it is valid now
         if isinstance(lab_data, dict):
             # Debug Print: Show what keys we found vs what we expect
-            print(f"   -> AI Found {len(lab_data)} dates in Labs.")
+            log.info("Lab dates from AI", grid=label, dates=len(lab_data))
             
-            lab_requests = fill_smart_grid(
-                docs_service, 
-                NEW_DOCUMENT_ID, 
-                lab_data, 
-                OBS_TEST_ORDER,    # Ensure this list is defined at the top of obs.py
-                "{{LAB_ANCHOR}}"   # Ensure Doc cell has ONLY this text
-            )
+            lab_requests = fill_smart_grid(docs_service, NEW_DOCUMENT_ID, lab_data, test_order, anchor, index=grid_index)
             
             if lab_requests:
-                docs_service.documents().batchUpdate(
-                    documentId=NEW_DOCUMENT_ID, 
-                    body={'requests': lab_requests}
-                ).execute(num_retries=5)
-                print("   ✅ OBGYN Lab Grid Filled Successfully.")
+                grid_requests.extend(lab_requests)
+                log.info("Grid planned", grid=label)
             else:
-                print("   ⚠️ Lab Grid Logic ran, but generated NO requests. (Check Anchor or Row Count)")
+                log.warning("Grid produced no requests (check the anchor or row count)", grid=label)
         else:
-            print(f"   ❌ Skipping Labs: Data is still {type(lab_data)} (Not a Dict)")
-        
-        # Cleanup
-        if "{{labs_json}}" in extracted_data: del extracted_data["{{labs_json}}"]
+            log.warning("Grid skipped: AI did not return a dict", grid=label, got=type(lab_data).__name__)
 
 
-    # --- B. FILL TEXT FIELDS (With Smart Defaults Logic) ---
-    print("   -> Merging extracted data with Professional Defaults...")
-    
-    requests = []
-    final_data = extracted_data.copy()
-    
-
-    # 2. Create Replacement Requests (The "Brute Force" Method)
-    for placeholder, value in final_data.items():
-        if isinstance(value, dict) or isinstance(value, list): continue # Skip JSON grids
-        
-        # Clean brackets if any
-        text_value = str(value).replace("{", "").replace("}", "").replace("[", "").replace("]", "").strip()
+    # --- B. FILL TEXT FIELDS (cleaned by POSTPROCESS above) ---
+    text_values = processed.text_values
 
-        # --- THE NUCLEAR CLEANER: REMOVES "NONE" and "NOT FOUND" ---
-        if text_value.lower() in ["none", "null", "not_found", "not found"]:
-            text_value = ""
+    # 3. Keep only placeholders that exist in this template (empty ones go in one final block)
+    requests = docs_batch.build_text_requests(text_values, template_placeholders)
+    log.info("Text replacements planned", requests=len(requests), values=len(text_values))
 
-        req = {
-            'replaceAllText': {
-                'containsText': {'text': placeholder, 'matchCase': True},
-                'replaceText': text_value
-            }
-        }
-        requests.append(req)
-
-    if requests:
-        docs_service.documents().batchUpdate(documentId=NEW_DOCUMENT_ID, body={'requests': requests}).execute(num_retries=5)
-        print("--- 5. SUCCESS! ---")
+    # --- C. ONE ATOMIC WRITE: grid inserts (highest index first), then text replacements ---
+    batch = docs_batch.plan_batch(grid_requests + requests)
+    revision_id = None
+    if batch:
+        update_response = resilience.execute(docs_service.documents().batchUpdate(documentId=NEW_DOCUMENT_ID, body={'requests': batch}), "docs")
+        # Revision after our write - the .docx export cache is keyed by it
+        revision_id = update_response.get('writeControl', {}).get('requiredRevisionId')
+        log.info("Document filled", requests=len(batch))
         
-        # CHANGE 3: Return the link string instead of just printing it
-        final_link = f"https://docs.google.com/document/d/{NEW_DOCUMENT_ID}"
-    print(f"Link: {final_link}")
+    # CHANGE 3: Return the link string instead of just printing it
+    final_link = f"https://docs.google.com/document/d/{NEW_DOCUMENT_ID}"
+    log.stage("done", "Case done", link=final_link)
     
     # Return all the info we need for the button
     return {
         "link": final_link, 
         "id": NEW_DOCUMENT_ID, 
+        "revision": revision_id,
         "name": new_filename,
-        "cost": cost_display # <--- Send cost to App
+        "cost": cost_display, # <--- Send cost to App
+        "queue_wait": round(rate_limit.waited(), 1), # Seconds spent waiting for quota
+        "fields": text_values # What each text placeholder was filled with (for Edit & Regenerate)
     }
 
+async def run_pipeline_async(image_list=None, model_choice="Gemini 2.5 Pro", two_stage=None):
+    """run_pipeline() as a coroutine - Gemini, Drive and Docs awaited on the shared event loop."""
+    return await pipeline_async.run_pipeline_async(sys.modules[__name__], image_list, model_choice, two_stage)
+
 if __name__ == "__main__":
     run_pipeline()
 
 def export_docx(file_id):
     """Downloads the Google Doc as a .docx file for the user."""
     creds = get_user_credentials() # Uses your existing auth
-    drive_service = build('drive', 'v3', credentials=creds)
+    drive_service = resilience.build_service('drive', 'v3', creds)
     try:
         # Request to export the file as a Word Doc
         request = drive_service.files().export_media(
             fileId=file_id,
             mimeType='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
         )
-        file_data = request.execute() # Returns the actual file bytes
+        file_data = resilience.execute(request, "drive") # Returns the actual file bytes
         return file_data
     except Exception as e:
-        print(f"Export Error: {e}")
+        log.warning("Export failed", document_id=file_id, error=e)
         return None
\ No newline at end of file
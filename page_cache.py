@@ -0,0 +1,103 @@
+import os
+import time
+import hashlib
+import threading
+import collections
+
+from PIL import Image
+
+# ==============================================================================
+# PAGE CACHE (Per-page results, keyed by an exact hash of the page's pixels)
+# ==============================================================================
+# Inpatient notes grow day by day: residents re-upload the same first 10 pages
+# plus the two new ones. Per-page results (the transcript, see transcribe.py)
+# are stored under page_key(): a sha256 of the decoded pixels. Only the very
+# same image matches - two lab reports on the same printed layout differ in a
+# handful of pixels and never share a transcript.
+#
+# The cache is shared by the whole process: day 3 of an admission comes in a
+# new browser session and still finds the pages sent on days 1 and 2. A hit
+# needs the very same pixels, i.e. the same page uploaded again, so nothing
+# crosses from one patient to another. Entries live in memory only -
+# transcripts are patient notes and are never written to disk - and expire
+# after PAGE_CACHE_DAYS (a restart starts over).
+#
+# page_hash() / distance() are a perceptual hash for the optional
+# near-duplicate pre-filter (preprocess.py), never for looking up results.
+
+PAGE_CACHE_DAYS = float(os.getenv("PAGE_CACHE_DAYS", "14"))  # Covers most admissions
+MAX_PAGES = int(os.getenv("PAGE_CACHE_PAGES", "5000"))      # Oldest entries go first past this
+
+HASH_SIZE = 16
+STRIP_ROWS = 256  # Pixels are hashed a strip at a time: no second full copy of a 12 MP photo
+
+
+def page_key(image):
+    """sha256 of a PIL image's decoded pixels (mode and size included). Equal only for identical pages."""
+    digest = hashlib.sha256(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    width, height = image.size
+    for top in range(0, height, STRIP_ROWS):
+        digest.update(image.crop((0, top, width, min(height, top + STRIP_ROWS))).tobytes())
+    return digest.digest()
+
+
+def page_hash(image):
+    """256-bit difference hash of a PIL image (an int). Similar pages, not the same page."""
+    # reducing_gap lets PIL shrink a 12 MP photo in steps instead of resampling every pixel
+    small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class PageCache:
+    """(kind, page key) -> text, in memory, exact matches only."""
+
+    def __init__(self, ttl_days=PAGE_CACHE_DAYS, max_pages=MAX_PAGES):
+        self.ttl = ttl_days * 24 * 3600
+        self.max_pages = max_pages
+        self._entries = collections.OrderedDict()  # (kind, key) -> (text, created), oldest first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expire(self):
+        # Caller holds the lock
+        cutoff = time.time() - self.ttl
+        while self._entries:
+            oldest = next(iter(self._entries))
+            if self._entries[oldest][1] >= cutoff and len(self._entries) <= self.max_pages:
+                break
+            del self._entries[oldest]
+
+    def get(self, kind, page_key):
+        """The text stored for this exact page, else None."""
+        with self._lock:
+            self._expire()
+            entry = self._entries.get((kind, page_key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, kind, page_key, text):
+        with self._lock:
+            self._entries.pop((kind, page_key), None)  # Re-stored = newest
+            self._entries[(kind, page_key)] = (text, time.time())
+            self._expire()
+
+    def stats(self):
+        with self._lock:
+            return {"pages": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+page_cache = PageCache()
@@ -0,0 +1,272 @@
+import os
+import json
+import asyncio
+import datetime
+import threading
+
+from googleapiclient.http import MediaIoBaseUpload
+
+import resilience   # Shared timeouts, retry/backoff and circuit breaker (async variants)
+import rate_limit   # Process-wide token buckets for Gemini / Drive / Docs quotas
+import docs_batch   # Plans grid + text fills into ONE batchUpdate
+import grid_fill    # Flattened cell index for the lab grids
+import transcribe   # Two-stage mode: parallel page transcripts + page cache
+import preprocess   # Typed PDF pages backed up as .txt
+import doc_patch    # MODEL_MAP / SAFETY_SETTINGS shared with the section re-extraction
+import template_pool  # Template copied while Gemini runs, renamed once the name is known
+import tracing      # One "case" span per case, like the sync backends
+import structured_log  # JSON-lines logging with case context
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# ASYNC PIPELINE (Many cases in flight on one event loop)
+# ==============================================================================
+# A backend's run_pipeline() is blocking I/O in sequence - token, Gemini,
+# Drive copy, Docs get, Docs batchUpdate - so each case holds a worker thread
+# for the whole minute, most of it spent waiting on Gemini.
+#
+# run_pipeline_async(backend, ...) is the same case as a coroutine:
+#   - Gemini through generate_content_async() (the SDK's async client)
+#   - Drive / Docs through resilience.execute_async(): quota and backoff waits
+#     are asyncio.sleep(), and only the round trip itself borrows a thread
+#     from the shared Google I/O pool (googleapiclient has no async transport)
+#   - the template copy starts with the case (template_pool.py), and the image
+#     backup and the cost log run alongside the rename and fill
+# The result dict is the same as the backend's run_pipeline().
+#
+# Every case shares ONE event loop on a background thread. submit() returns a
+# concurrent.futures.Future right away (what app.py keeps in active_jobs);
+# run_pipeline() is the sync wrapper - it blocks its caller until the case is
+# done, exactly like backend.run_pipeline().
+#
+# ASYNC_PIPELINE=1 makes app.py send cases here.
+
+ENABLED = os.getenv("ASYNC_PIPELINE") == "1"
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def enabled():
+    return ENABLED
+
+
+def get_loop():
+    """The shared event loop (started on its own daemon thread on first use)."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="pipeline-loop", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def submit(coro):
+    """Schedules a coroutine on the shared loop. Returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_pipeline(backend, image_list=None, model_choice="Gemini 2.5 Pro", two_stage=None):
+    """Sync wrapper: runs the case on the shared loop and waits for its result."""
+    if threading.current_thread().name == "pipeline-loop":
+        raise RuntimeError("run_pipeline() would block the event loop - await run_pipeline_async() instead")
+    return submit(run_pipeline_async(backend, image_list, model_choice, two_stage)).result()
+
+
+async def _side_task(coro):
+    """Runs next to the main case; returns its own quota wait (its context is a copy)."""
+    rate_limit.reset_wait()
+    try:
+        await coro
+    except Exception as e:
+        log.warning("Drive side job failed", error=e)
+    return rate_limit.waited()
+
+
+# --- DRIVE SIDE JOBS (failures are logged, never fatal - same as the sync backends) ---
+async def upload_patient_images(backend, image_list, patient_name):
+    if not backend.IMAGES_FOLDER_ID: return
+
+    creds = await asyncio.to_thread(backend.get_user_credentials)
+    drive_service = await asyncio.to_thread(resilience.build_service, 'drive', 'v3', creds)
+
+    try:
+        folder_metadata = {
+            'name': f"{patient_name} - Images",
+            'parents': [backend.IMAGES_FOLDER_ID],
+            'mimeType': 'application/vnd.google-apps.folder'
+        }
+        folder = await resilience.execute_async(drive_service.files().create(body=folder_metadata, fields='id'), "drive")
+        patient_folder_id = folder.get('id')
+
+        log.info("Backing up pages", stage="backup", pages=len(image_list))
+        for i, img in enumerate(image_list):
+            # JPEG encoding is CPU work - keep it off the loop
+            file_name, img_byte_arr, mimetype = await asyncio.to_thread(preprocess.page_file, img, i + 1)
+            media = MediaIoBaseUpload(img_byte_arr, mimetype=mimetype)
+            file_metadata = {'name': file_name, 'parents': [patient_folder_id]}
+            await resilience.execute_async(drive_service.files().create(body=file_metadata, media_body=media), "drive")
+
+    except Exception as e:
+        log.warning("Image backup failed", stage="backup", error=e)
+
+
+async def log_cost_to_drive(backend, text_content, patient_name):
+    if not backend.COST_FOLDER_ID: return
+
+    creds = await asyncio.to_thread(backend.get_user_credentials)
+    drive_service = await asyncio.to_thread(resilience.build_service, 'drive', 'v3', creds)
+    docs_service = await asyncio.to_thread(resilience.build_service, 'docs', 'v1', creds)
+
+    try:
+        title = f"Cost - {patient_name} - {datetime.datetime.now().strftime('%d-%m')}"
+        file_metadata = {
+            'name': title,
+            'parents': [backend.COST_FOLDER_ID],
+            'mimeType': 'application/vnd.google-apps.document'
+        }
+        doc = await resilience.execute_async(drive_service.files().create(body=file_metadata), "drive")
+
+        requests = [{'insertText': {'location': {'index': 1}, 'text': text_content}}]
+        await resilience.execute_async(docs_service.documents().batchUpdate(documentId=doc.get('id'), body={'requests': requests}), "docs")
+        log.info("Cost log saved", stage="cost_log")
+    except Exception as e:
+        log.warning("Cost log upload failed", stage="cost_log", error=e)
+
+
+# --- THE CASE ---
+async def extract(backend, image_list, model_choice, two_stage):
+    """The Gemini half: (Processed, cost display, cost log), or None if the reply has no JSON."""
+    selected_model_id = doc_patch.MODEL_MAP.get(model_choice, "models/gemini-2.5-pro")
+    clean_model_name = selected_model_id.replace("models/", "")
+    log.stage("gemini", "AI processing", model=selected_model_id)
+
+    backend.genai.configure(api_key=backend.GENAI_API_KEY)
+    model = backend.genai.GenerativeModel(selected_model_id, safety_settings=doc_patch.SAFETY_SETTINGS)
+
+    final_prompt_text = backend.PROMPT.render(len(image_list))
+    prompt_content = [final_prompt_text]
+    prompt_content.extend(image_list)
+
+    pages = None
+    if transcribe.enabled(two_stage):
+        pages = await transcribe.transcribe_pages_async(model, clean_model_name, image_list, backend.RATE_LIMITS, backend.PRICING)
+        prompt_content = [final_prompt_text] + pages.prompt_parts()
+
+    est_tokens = rate_limit.estimate_input_tokens(prompt_content)
+    response = await resilience.call_async(model.generate_content_async, "gemini", prompt_content, request_options=resilience.gemini_request_options(),
+                                           before_attempt=lambda: rate_limit.wait_for_gemini_async(clean_model_name, est_tokens, backend.RATE_LIMITS))
+    rate_limit.settle_gemini_tokens(clean_model_name, est_tokens, getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None), backend.RATE_LIMITS)
+
+    cost_display, log_content = backend.log_usage(response, clean_model_name, note=f"Medical Extraction ({model_choice})")
+    if pages is not None:
+        cost_display = pages.total_cost(response, clean_model_name, backend.PRICING)
+        log_content += pages.log
+
+    raw_text = response.text
+    start_index = raw_text.find('{')
+    end_index = raw_text.rfind('}') + 1
+    if start_index == -1:
+        return None
+    extracted_data = json.loads(raw_text[start_index:end_index])
+    # Grids repaired, slots expanded, every text field cleaned - in ONE pass
+    return backend.POSTPROCESS.run(extracted_data), cost_display, log_content
+
+
+async def fill_document(backend, drive_service, docs_service, document_id, processed):
+    """One Docs read, one batchUpdate for every grid and text field. Returns (revision, text values)."""
+    log.stage("fill", "Filling data")
+    doc = await resilience.execute_async(docs_service.documents().get(documentId=document_id), "docs")
+    grid_index = grid_fill.CellIndex(doc)
+    # Cached per template revision - a Drive read at most, on the I/O pool
+    template_placeholders = await resilience.run_io(docs_batch.template_placeholders, drive_service, docs_service, backend.MASTER_TEMPLATE_ID)
+
+    grid_requests = []
+    for data_key, test_order, anchor, label in backend.GRIDS:
+        if data_key not in processed.grids: continue
+        grid_data = processed.grids[data_key]
+        if isinstance(grid_data, dict):
+            grid_requests.extend(backend.fill_smart_grid(docs_service, document_id, grid_data, test_order, anchor, index=grid_index))
+            log.info("Grid planned", grid=label)
+        else:
+            log.warning("Grid skipped: AI did not return a dict", grid=label, got=type(grid_data).__name__)
+
+    text_values = processed.text_values
+    requests = docs_batch.build_text_requests(text_values, template_placeholders)
+    log.info("Text replacements planned", requests=len(requests), values=len(text_values))
+
+    batch = docs_batch.plan_batch(grid_requests + requests)
+    revision_id = None
+    if batch:
+        update_response = await resilience.execute_async(docs_service.documents().batchUpdate(documentId=document_id, body={'requests': batch}), "docs")
+        revision_id = update_response.get('writeControl', {}).get('requiredRevisionId')
+        log.info("Document filled", requests=len(batch))
+    return revision_id, text_values
+
+
+async def run_pipeline_async(backend, image_list=None, model_choice="Gemini 2.5 Pro", two_stage=None):
+    """backend.run_pipeline() as a coroutine. Same arguments (plus the backend module), same result."""
+    if not image_list:
+        return "Error: No images provided to Logic Engine."
+    with structured_log.case(department=backend.__name__), \
+         tracing.span("case", department=backend.__name__, model=model_choice, pages=len(image_list),
+                      image_bytes=tracing.image_bytes(image_list) if tracing.enabled() else None):
+        return await _run_case(backend, image_list, model_choice, two_stage)
+
+
+async def _run_case(backend, image_list, model_choice, two_stage):
+    log.stage("auth", "Authenticating", pages=len(image_list))
+    rate_limit.reset_wait()  # This task's own context - other cases on the loop are not touched
+    creds = await asyncio.to_thread(backend.get_user_credentials)
+    template_copy = template_pool.start_copy(creds, backend.MASTER_TEMPLATE_ID, backend.OUTPUT_FOLDER_ID)
+
+    try:
+        extracted = await extract(backend, image_list, model_choice, two_stage)
+    except Exception as e:
+        template_copy.discard()
+        log.error("AI processing failed", error=e)
+        return f"AI Logic Error: {e}"
+    if extracted is None:
+        template_copy.discard()
+        log.error("AI reply has no JSON")
+        return "Error: AI failed to generate JSON. Try again."
+    processed, cost_display, log_content = extracted
+
+    patient_name = processed.patient_name
+    model_tag = "Flash" if "Flash" in model_choice else "Pro"
+    new_filename = f"Discharge Summary - {patient_name} ({model_tag})"
+
+    # Backup and cost log don't touch the summary - they run while it is being built
+    side_tasks = [asyncio.ensure_future(_side_task(upload_patient_images(backend, image_list, patient_name)))]
+    if log_content:
+        side_tasks.append(asyncio.ensure_future(_side_task(log_cost_to_drive(backend, log_content, patient_name))))
+
+    try:
+        drive_service = await asyncio.to_thread(resilience.build_service, 'drive', 'v3', creds)
+        docs_service = await asyncio.to_thread(resilience.build_service, 'docs', 'v1', creds)
+        log.stage("create_file", "Creating file", model_tag=model_tag)
+        try:
+            # Copied while Gemini was running - only the rename is left
+            document_id = await template_copy.claim_async(drive_service, new_filename)
+            log.info("File created", document_id=document_id)
+        except Exception as e:
+            log.error("Template copy failed", error=e)
+            return {"error": f"Google Drive Permission Error: {str(e)}"}
+        revision_id, text_values = await fill_document(backend, drive_service, docs_service, document_id, processed)
+    finally:
+        # Parallel waits overlap - the case waited for the longest
+        rate_limit.add_wait(max(await asyncio.gather(*side_tasks)))
+
+    final_link = f"https://docs.google.com/document/d/{document_id}"
+    log.stage("done", "Case done", link=final_link)
+    return {
+        "link": final_link,
+        "id": document_id,
+        "revision": revision_id,
+        "name": new_filename,
+        "cost": cost_display,
+        "queue_wait": round(rate_limit.waited(), 1),
+        "fields": text_values
+    }
@@ -0,0 +1,162 @@
+import re
+import json
+
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# POST-PROCESSING RULES (One pass over the AI's JSON, per-department profile)
+# ==============================================================================
+# Cleaning used to be scattered over every run_pipeline(): a "ROBUST FIX" loop
+# for stringified grids, a NOT_FOUND pass (Medicine only), a bracket-stripping
+# pass, a re.sub on the patient name, and OBGYN's own HPLC / smear / USG slot
+# unpacking - each one re-scanning extracted_data, and doc_patch.py had a copy.
+#
+# Now each backend declares a Profile next to its GRIDS:
+#   - grid keys       : JSON tables (stringified ones are repaired)
+#   - slot rules      : a JSON list spread over numbered placeholders
+#   - strict fields   : text that also gets Medicine's NOT_FOUND pass
+# and run() walks extracted_data ONCE. The output is exactly what the old code
+# produced (benchmarks/bench_postprocess.py checks that for every department).
+
+_FILENAME_UNSAFE = re.compile(r'[\\/*?:"<>|]')
+_CODE_FENCE = re.compile(r"```(?:json)?")
+
+# The AI's ways of saying "nothing here"
+NOT_FOUND_UPPER = frozenset(["NOT_FOUND", "NONE", "NULL", "NOT MENTIONED"])
+NOT_FOUND_LOWER = frozenset(["none", "null", "not_found", "not found"])
+
+
+# --- TEXT CLEANERS (str -> str) ---
+def clean_text(text):
+    """Every department: brackets out, then a lone 'none' / 'null' / 'not found' -> ''."""
+    # Chained replace() beats translate() here: each one is a C scan that finds nothing in most fields
+    text = text.replace("{", "").replace("}", "").replace("[", "").replace("]", "").strip()
+    return "" if text.lower() in NOT_FOUND_LOWER else text
+
+
+def clean_strict(text):
+    """Medicine's placeholders: 'NOT_FOUND', 'Not Mentioned' ... (any case) -> '' first, then clean_text()."""
+    text = text.strip()
+    if text.upper() in NOT_FOUND_UPPER:
+        return ""
+    return clean_text(text)
+
+
+def repair_grid(value, key=""):
+    """A grid the AI returned as a string ("```json {'DD/MM': ...}```") -> dict ({} if hopeless)."""
+    if not isinstance(value, str):
+        return value
+    clean_val = _CODE_FENCE.sub("", value).strip()
+    # Fix single quotes to double quotes
+    if clean_val.startswith("{") and "'" in clean_val:
+        clean_val = clean_val.replace("'", '"')
+    try:
+        log.info("Auto-correcting stringified JSON", key=key)
+        return json.loads(clean_val)
+    except ValueError:
+        return {}
+
+
+def safe_filename(name):
+    return _FILENAME_UNSAFE.sub("", str(name))
+
+
+class SlotRule:
+    """Spreads a JSON list over numbered placeholders.
+
+    SlotRule("{{usg_series_json}}", None, "usg", "USG OBS", 7) turns
+    [{"date": "12/01", "result": "..."}] into {{usg_date_1}} = "USG OBS (12/01)",
+    {{usg_res_1}} = "...", and blanks slots 2-7. 'path' picks a list inside a
+    dict source ({"hplc": [...], "ps": [...]}).
+    """
+
+    def __init__(self, source, path, prefix, label, slots):
+        self.source = source
+        self.path = path
+        self.label = label
+        self.keys = [(f"{{{{{prefix}_date_{i}}}}}", f"{{{{{prefix}_res_{i}}}}}") for i in range(1, slots + 1)]
+
+    def items(self, value):
+        if isinstance(value, str):
+            try: value = json.loads(value)
+            except ValueError: value = None
+        if self.path is not None:
+            value = value.get(self.path, []) if isinstance(value, dict) else []
+        return value if isinstance(value, list) else []
+
+    def expand(self, value):
+        """(placeholder, raw value) for every slot, filled or blank."""
+        items = self.items(value)
+        for i, (key_date, key_res) in enumerate(self.keys):
+            if i < len(items) and isinstance(items[i], dict):
+                raw_date = str(items[i].get("date") or "").strip()
+                yield key_date, f"{self.label} ({raw_date})" if raw_date else self.label
+                yield key_res, items[i].get("result", "")
+            else:
+                yield key_date, ""
+                yield key_res, ""
+
+
+class Processed:
+    def __init__(self, text_values, grids, patient_name):
+        self.text_values = text_values  # {placeholder: clean text}, in fill order
+        self.grids = grids              # {grid data key: dict (or whatever the AI sent)}
+        self.patient_name = patient_name
+
+
+class Profile:
+    """A department's post-processing rules, compiled once at import."""
+
+    def __init__(self, grid_keys=(), slots=(), strict_fields=(), fill_missing=False):
+        self.grid_keys = frozenset(grid_keys)
+        self.slots = tuple(slots)
+        self._slot_sources = {rule.source for rule in self.slots}
+        self._strict_order = tuple(strict_fields)
+        self.strict_fields = frozenset(self._strict_order) - self.grid_keys - self._slot_sources
+        # Strict placeholders the AI skipped still get a (blank) value - a grid key too, as it always did
+        self.fill_missing = fill_missing
+
+    def clean(self, key, value):
+        """One text field, exactly as run() would clean it."""
+        text = value if type(value) is str else str(value if value is not None else "")
+        return clean_strict(text) if key in self.strict_fields else clean_text(text)
+
+    def run(self, extracted_data):
+        """The single pass: grids out, slots expanded, every text field cleaned. Returns Processed."""
+        text_values = {}
+        grids = {}
+        slot_values = {}
+        strict = self.strict_fields
+        for key, value in extracted_data.items():
+            if type(value) is str:
+                # The common case first: a plain text field
+                if key in self.grid_keys:
+                    grids[key] = repair_grid(value, key)
+                elif key in self._slot_sources:
+                    slot_values[key] = value
+                else:
+                    text_values[key] = clean_strict(value) if key in strict else clean_text(value)
+            elif key in self.grid_keys:
+                grids[key] = value
+            elif key in self._slot_sources:
+                slot_values[key] = value
+            elif key in strict:
+                text_values[key] = self.clean(key, value)  # Even a list: "['Tab A', 'Tab B']" -> "'Tab A', 'Tab B'"
+            elif not isinstance(value, (dict, list)):
+                text_values[key] = self.clean(key, value)
+            # else: some other JSON block - never text
+
+        if self.fill_missing:
+            for key in self._strict_order:
+                if key not in text_values:
+                    text_values[key] = ""
+
+        # Slots go last, in rule order (missing sources still blank their slots)
+        for rule in self.slots:
+            for key, value in rule.expand(slot_values.get(rule.source)):
+                text_values[key] = self.clean(key, value)
+
+        patient_name = safe_filename(extracted_data.get("{{patient_name}}", "Unknown"))
+        return Processed(text_values, grids, patient_name)
@@ -0,0 +1,363 @@
+import io
+import os
+import concurrent.futures
+
+from PIL import Image, ImageFilter, ImageOps, ImageSequence
+
+from page_cache import page_key, page_hash, distance
+import tracing
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# PAGE PREPROCESSING (Every uploaded file -> the pages the pipeline reads)
+# ==============================================================================
+# Photos (jpg / png) are one page each. Scanned case files come as a PDF or a
+# multi-page TIFF and used to be split into images by hand; now they are split
+# here. iter_pages() is a generator: a page is rendered only when the caller
+# asks for the next one, so a 60-page scan is never decoded in one go before
+# the first page is even looked at - session_store.open_images() stops pulling
+# (and refuses the case) as soon as the page or decoded-size cap is crossed.
+#
+# PDF pages with a real text layer (typed discharge letters, LIS lab printouts)
+# go to Gemini as TEXT instead of pixels: a fraction of the tokens, and nothing
+# to read off an image. A page that is mostly one big picture is a scan -
+# maybe with an OCR layer on top, which is useless on handwriting - and is
+# rendered at PDF_DPI like any photo.
+#
+# PDFs need pypdfium2 (requirements.txt). Without it photos and TIFFs still work.
+#
+# drop_redundant() then takes out blank pages (the back of a sheet) and pages
+# photographed twice, before any of them costs Gemini tokens or latency. Both
+# tests are deliberately timid - sending a useless page costs a few paise,
+# dropping a real one loses notes:
+#   - blank     : under BLANK_INK of the page is ink (darker than the paper by
+#                 INK_CONTRAST). Faint show-through from the other side isn't ink.
+#   - duplicate : exactly the same pixels as an earlier page (page_cache.page_key,
+#                 a sha256 of the decoded image): a re-sent file, the same page
+#                 picked twice. A second photo of the same sheet is NOT caught -
+#                 and two lab reports on one printed layout, which only differ
+#                 in a name and a few values, are never merged.
+#   - near duplicate (opt-in, NEAR_DUPLICATES=1): perceptual hash (page_hash)
+#                 within DUPLICATE_DISTANCE bits of an earlier page AND about as
+#                 much ink - catches bursts of the same shot, but also same-layout
+#                 forms of different patients. Only for uploads known not to
+#                 have those.
+# PAGE_FILTER=0 turns it off. The case card lists what was dropped.
+#
+# crop_pages() (optional: "Auto-crop" per case, ROI_CROP=1 for the default)
+# cuts each photo down to the sheet of paper and straightens it, fully offline
+# and with PIL alone:
+#   - paper  : the bright region (Otsu threshold on a small grey copy, specks
+#              removed) - the desk, hands and shadows around it go
+#   - skew   : the angle (within MAX_SKEW) at which the rows of the page show
+#              the sharpest line / gap pattern, i.e. the text lines run level
+# Anything doubtful (paper filling almost all of the photo, or too little of
+# it, no clear text lines) leaves the page as it was. Fewer pixels means fewer
+# image tokens and a faster upload, and the Drive backup gets the cropped page.
+
+PDF_DPI = int(os.getenv("PDF_DPI", "150"))  # ~1240 x 1750 px for A4: handwriting stays legible
+MIN_TEXT_CHARS = 200   # Less than this is a header/footer on a scanned page, not a typed page
+SCAN_COVERAGE = 0.5    # An image covering half the page makes it a scan
+
+# What the file uploaders accept
+UPLOAD_TYPES = ["jpg", "png", "jpeg", "pdf", "tif", "tiff"]
+
+PAGE_FILTER = os.getenv("PAGE_FILTER", "1") != "0"
+BLANK_INK = float(os.getenv("BLANK_INK", "0.0001"))               # Share of the page: a lone signature is more
+INK_CONTRAST = 40                                                   # Grey levels darker than the paper
+NEAR_DUPLICATES = os.getenv("NEAR_DUPLICATES") == "1"              # Off: exact duplicates only
+DUPLICATE_DISTANCE = int(os.getenv("DUPLICATE_DISTANCE", "10"))   # Of 256 bits (near duplicates only)
+DUPLICATE_INK = 0.2  # ... and ink within 20% of each other
+INK_WIDTH = 1000  # Measured on a copy this wide: a pen stroke still survives the downscale
+
+ROI_CROP = os.getenv("ROI_CROP") == "1"
+ROI_WIDTH = 400        # Paper and skew are found on a copy this wide
+MIN_PAPER = 0.2        # The sheet must fill at least this share of the photo ...
+MAX_PAPER = 0.92       # ... and leave more margin than this, or there is nothing to crop
+CROP_MARGIN = 0.01     # Kept around the sheet, so a bad edge never cuts text
+MAX_SKEW = 8.0         # Degrees, either way
+MIN_SKEW = 0.3         # Straighter than this is left alone
+
+# Page checks of ALL cases share this pool (hashing a 12 MP photo is mostly PIL work outside the GIL)
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "4"))
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+
+
+class TextPage(str):
+    """A page that goes to Gemini as text (a PDF page's own text layer), not as an image."""
+
+    def __new__(cls, text, source=""):
+        page = super().__new__(cls, f"[Typed page: {source}]\n{text}" if source else text)
+        page.source = source
+        return page
+
+
+def iter_pages(paths, dpi=PDF_DPI):
+    """Yields every page of the uploaded files, in order: PIL images or TextPage."""
+    for path in paths:
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".pdf":
+            yield from _pdf_pages(path, dpi)
+        elif ext in (".tif", ".tiff"):
+            yield from _tiff_pages(path)
+        else:
+            yield _open_image(path)
+
+
+def _open_image(path):
+    with Image.open(path) as img:
+        img.load()
+        # copy() detaches the pixels from the file so nothing keeps it open
+        return img.copy()
+
+
+def _tiff_pages(path):
+    with Image.open(path) as tif:
+        for frame in ImageSequence.Iterator(tif):
+            # convert() makes a new image, so the frame is free before the next seek
+            yield frame.convert("RGB")
+
+
+def _pdf_pages(path, dpi):
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        raise RuntimeError("PDF upload needs the 'pypdfium2' package (pip install pypdfium2).")
+
+    name = os.path.basename(path)
+    pdf = pdfium.PdfDocument(path)
+    try:
+        for i in range(len(pdf)):
+            page = pdf[i]
+            try:
+                text = _text_layer(page)
+                if text is not None:
+                    yield TextPage(text, f"{name}, page {i + 1}")
+                else:
+                    yield page.render(scale=dpi / 72).to_pil().convert("RGB")
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+
+
+def _text_layer(page):
+    """The page's text if it is a typed page, None if it has to be read as an image."""
+    import pypdfium2.raw as pdfium_c
+
+    textpage = page.get_textpage()
+    try:
+        text = textpage.get_text_bounded().strip()
+    finally:
+        textpage.close()
+    if len(text) < MIN_TEXT_CHARS:
+        return None
+
+    width, height = page.get_size()
+    for obj in page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_IMAGE]):
+        bounds = obj.get_bounds() if hasattr(obj, "get_bounds") else obj.get_pos()  # pypdfium2 5 / 4
+        left, bottom, right, top = bounds
+        if (right - left) * (top - bottom) >= SCAN_COVERAGE * width * height:
+            return None  # A scan with an OCR layer on top
+    return text
+
+
+@tracing.traced("encode_page")
+def page_file(page, number):
+    """(file name, bytes, mimetype) for backing a page up to Drive."""
+    data = io.BytesIO()
+    if isinstance(page, TextPage):
+        data.write(page.encode("utf-8"))
+        data.seek(0)
+        return f"Page_{number}.txt", data, "text/plain"
+    page.save(data, format='JPEG')
+    tracing.current().set(page=number, bytes=data.tell())
+    data.seek(0)
+    return f"Page_{number}.jpg", data, "image/jpeg"
+
+
+# --- BLANK / DUPLICATE FILTER ---
+def _thumbnail(image):
+    """Grey copy about INK_WIDTH wide (reduce() box-averages: far cheaper than resampling 12 MP)."""
+    factor = image.size[0] // INK_WIDTH
+    if factor > 1:
+        image = image.reduce(factor)
+    return image.convert("L")
+
+
+def ink_ratio(image):
+    """Share of the page darker than the paper by INK_CONTRAST (the paper = the median grey)."""
+    histogram = _thumbnail(image).histogram()
+    total = sum(histogram)
+    seen = 0
+    for paper, count in enumerate(histogram):
+        seen += count
+        if seen * 2 >= total:
+            break
+    return sum(histogram[:max(0, paper - INK_CONTRAST)]) / total
+
+
+def _page_features(page):
+    """(exact key, perceptual hash or None, ink). Typed pages are never blank; their key is the text."""
+    if isinstance(page, TextPage):
+        return page, None, 1.0
+    thumbnail = _thumbnail(page)
+    near = page_hash(thumbnail) if NEAR_DUPLICATES else None
+    return page_key(page), near, ink_ratio(thumbnail)
+
+
+def drop_redundant(pages):
+    """Drops blank and repeated pages. Returns (kept pages, [(page number, reason), ...]).
+
+    Page numbers are 1-based positions in the upload. Dropped images are closed.
+    """
+    if not PAGE_FILTER or len(pages) < 2:
+        return pages, []
+    features = list(_pool.map(_page_features, pages))
+
+    kept = []
+    seen = {}        # exact key (pixel sha256 or text) -> page number, of every kept page
+    kept_near = []   # (perceptual hash, ink, page number) - NEAR_DUPLICATES only
+    dropped = []
+    for number, (page, (key, near, ink)) in enumerate(zip(pages, features), start=1):
+        if ink < BLANK_INK:
+            dropped.append((number, "blank"))
+            continue
+        same = seen.get(key)
+        if same is None and near is not None:
+            same = next((n for k, k_ink, n in kept_near
+                         if distance(k, near) <= DUPLICATE_DISTANCE
+                         and abs(k_ink - ink) <= DUPLICATE_INK * max(k_ink, ink)), None)
+        if same is not None:
+            dropped.append((number, f"same as page {same}"))
+            continue
+        kept.append(page)
+        seen[key] = number
+        if near is not None:
+            kept_near.append((near, ink, number))
+
+    if not kept:
+        return pages, []  # Nothing but blanks? Let the AI look rather than send nothing
+    kept_ids = {id(page) for page in kept}
+    for page in pages:
+        if id(page) not in kept_ids and hasattr(page, "close"):
+            page.close()
+    if dropped:
+        log.info("Pre-filter dropped pages", dropped=len(dropped), pages=len(pages))
+    return kept, dropped
+
+
+def describe_dropped(dropped):
+    """'page 3 (blank), page 5 (same as page 4)' for the case card."""
+    return ", ".join(f"page {number} ({reason})" for number, reason in dropped)
+
+
+# --- AUTO-CROP + DESKEW ---
+def crop_enabled(auto_crop=None):
+    """Whether this case's pages are cropped (the per-case choice wins over the ROI_CROP default)."""
+    return ROI_CROP if auto_crop is None else bool(auto_crop)
+
+
+def _otsu(histogram):
+    """Grey level that best splits the histogram in two (paper vs. everything darker)."""
+    total = sum(histogram)
+    weighted = sum(level * count for level, count in enumerate(histogram))
+    best, threshold = -1.0, 127
+    below = below_weighted = 0
+    for level, count in enumerate(histogram):
+        below += count
+        if below == 0 or below == total:
+            continue
+        below_weighted += level * count
+        mean_low = below_weighted / below
+        mean_high = (weighted - below_weighted) / (total - below)
+        spread = below * (total - below) * (mean_low - mean_high) ** 2
+        if spread > best:
+            best, threshold = spread, level
+    return threshold
+
+
+def paper_box(grey):
+    """Bounding box of the sheet in a grey image, or None if it isn't clearly smaller than the photo."""
+    threshold = _otsu(grey.histogram())
+    small = grey.reduce(2)  # The sheet's outline needs no detail - and the filters below cost per pixel
+    mask = small.point(lambda v: 255 if v > threshold else 0)
+    # Opening: specks and thin glare go, the sheet (with its text holes closed) stays
+    mask = mask.filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.MinFilter(5)).filter(ImageFilter.MaxFilter(3))
+    box = mask.getbbox()
+    if box is None:
+        return None
+    share = (box[2] - box[0]) * (box[3] - box[1]) / (small.size[0] * small.size[1])
+    if not MIN_PAPER <= share <= MAX_PAPER:
+        return None
+    return tuple(min(edge * 2, limit) for edge, limit in zip(box, grey.size * 2))
+
+
+def _line_score(ink, angle):
+    width, height = ink.size
+    # Only the middle of the page: the corners rotated in from outside would score as "lines" too
+    rotated = ink.rotate(angle, resample=Image.BILINEAR).crop((width // 6, height // 6, width - width // 6, height - height // 6))
+    # Row means in C (resize to 1 px wide), then how sharply neighbouring rows differ
+    rows = list(rotated.resize((1, rotated.size[1]), Image.BOX).getdata())
+    return sum((b - a) ** 2 for a, b in zip(rows, rows[1:]))
+
+
+def skew_angle(grey):
+    """Degrees to rotate (counter-clockwise) so the text lines run level; 0 if unsure."""
+    ink = ImageOps.invert(grey)  # Ink bright, paper dark
+    level = _line_score(ink, 0)
+    best_score, best = level, 0.0
+    for step in range(-int(MAX_SKEW), int(MAX_SKEW) + 1):  # Whole degrees ...
+        score = _line_score(ink, step)
+        if score > best_score:
+            best_score, best = score, float(step)
+    for step in range(-4, 5):  # ... then fifths around the best
+        angle = best + step / 5
+        score = _line_score(ink, angle)
+        if score > best_score:
+            best_score, best = score, angle
+    # No clear winner (no text lines, a photo of a wound) - leave it
+    if abs(best) < MIN_SKEW or best_score < level * 1.1:
+        return 0.0
+    return round(best, 1)
+
+
+def crop_page(page):
+    """The page cut to its sheet of paper and straightened (the same object if nothing to do)."""
+    if isinstance(page, TextPage):
+        return page
+    factor = max(1, page.size[0] // ROI_WIDTH)
+    grey = page.reduce(factor).convert("L")
+
+    box = paper_box(grey)
+    result = page
+    if box is not None:
+        width, height = page.size
+        margin_x, margin_y = int(width * CROP_MARGIN), int(height * CROP_MARGIN)
+        result = page.crop((
+            max(0, box[0] * factor - margin_x), max(0, box[1] * factor - margin_y),
+            min(width, box[2] * factor + margin_x), min(height, box[3] * factor + margin_y),
+        ))
+        grey = grey.crop(box)
+
+    angle = skew_angle(grey)
+    if angle:
+        result = result.rotate(angle, resample=Image.BILINEAR, fillcolor="white")
+    return result
+
+
+def crop_pages(pages):
+    """Auto-crop + deskew for every page, on the shared pool. Replaced images are closed."""
+    cropped = list(_pool.map(crop_page, pages))
+    before = after = 0
+    for page, new in zip(pages, cropped):
+        if new is not page:
+            before += page.size[0] * page.size[1]
+            after += new.size[0] * new.size[1]
+            page.close()
+    if before:
+        log.info("Auto-crop", cropped=sum(new is not page for page, new in zip(pages, cropped)),
+                 fewer_pixels_pct=100 - after * 100 // before)
+    return cropped
@@ -0,0 +1,192 @@
+import os
+import sys
+import time
+import cProfile
+import tempfile
+import threading
+import functools
+import collections
+
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# CASE PROFILING (Opt-in: every Nth case profiled, output kept next to the result)
+# ==============================================================================
+# For the slow cases that aren't the network - huge photos, a 40-date lab
+# grid, the page filters. When a case is picked, the thread running it is
+# profiled from start to result and one file is written to PROFILE_DIR:
+#   - sample   : a sampling profiler (a helper thread reads the case thread's
+#                stack every PROFILE_INTERVAL_MS) -> "<case>.folded", the
+#                collapsed-stack format flamegraph.pl / speedscope / inferno
+#                turn into a flame graph. Costs the case next to nothing.
+#   - cprofile : cProfile, every call counted -> "<case>.pstats"
+#                (python -m pstats, snakeviz). Slower, exact call counts.
+# The path goes into the case result as "profile" (download on the case card).
+#
+#   PROFILE_EVERY=N  profile every Nth case (0 = off, 1 = every case). The
+#                    admin page changes it at runtime for this process.
+#   PROFILE_MODE     sample (default) or cprofile
+#
+# With ASYNC_PIPELINE=1 the case runs on the shared event loop thread, so its
+# profile also shows whatever else the loop ran meanwhile. One profile per
+# thread at a time - a case picked while its thread is busy profiling runs
+# without one.
+
+PROFILE_EVERY = int(os.getenv("PROFILE_EVERY", "0"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "scribe_profiles"))
+PROFILE_KEEP = 50  # Oldest profiles are deleted past this many
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+class StackSampler:
+    """Samples one thread's stack on a helper thread. Stacks are counted root-first."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class CaseProfiler:
+    def __init__(self, every=PROFILE_EVERY, mode=PROFILE_MODE, folder=PROFILE_DIR):
+        self.every = every
+        self.mode = mode
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._seen = 0
+        self._busy = set()  # Thread idents with a profile running
+
+    def set_every(self, every):
+        with self._lock:
+            self.every = max(0, int(every))
+
+    def _pick(self, thread_id):
+        """Counts one case. True if this one should be profiled (and its thread is free)."""
+        with self._lock:
+            if self.every <= 0:
+                return False
+            self._seen += 1
+            if self._seen % self.every or thread_id in self._busy:
+                return False
+            self._busy.add(thread_id)
+            return True
+
+    def _start(self):
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            return profile
+        sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+        sampler.start()
+        return sampler
+
+    def _save(self, profile, label, seconds):
+        os.makedirs(self.folder, exist_ok=True)
+        stem = os.path.join(self.folder, f"{time.strftime('%Y%m%d-%H%M%S')}-{label}")
+        if isinstance(profile, cProfile.Profile):
+            profile.disable()
+            path = stem + ".pstats"
+            profile.dump_stats(path)
+        else:
+            profile.stop()
+            path = stem + ".folded"
+            profile.write(path)
+        log.info("Profile saved", mode=self.mode, seconds=round(seconds, 1), path=path)
+        self._prune()
+        return path
+
+    def _prune(self):
+        try:
+            files = sorted((os.path.join(self.folder, name) for name in os.listdir(self.folder)), key=os.path.getmtime)
+            for path in files[:-PROFILE_KEEP]:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def recent(self, limit=10):
+        """Newest profile files first."""
+        try:
+            files = [os.path.join(self.folder, name) for name in os.listdir(self.folder)]
+        except OSError:
+            return []
+        return sorted(files, key=os.path.getmtime, reverse=True)[:limit]
+
+    def _finish(self, profile, label, started, result):
+        thread_id = threading.get_ident()
+        try:
+            path = self._save(profile, label, time.monotonic() - started)
+            if isinstance(result, dict):
+                result["profile"] = path
+        except Exception as e:
+            log.warning("Profile not saved", error=e)
+        finally:
+            with self._lock:
+                self._busy.discard(thread_id)
+
+
+profiler = CaseProfiler()
+
+
+def profiled(task, label):
+    """Wraps a worker function: the picked cases run under the profiler, the rest untouched."""
+    @functools.wraps(task)
+    def run(*args, **kwargs):
+        if not profiler._pick(threading.get_ident()):
+            return task(*args, **kwargs)
+        started = time.monotonic()
+        profile = profiler._start()
+        result = None
+        try:
+            result = task(*args, **kwargs)
+            return result
+        finally:
+            profiler._finish(profile, label, started, result)
+    return run
+
+
+def profiled_async(task, label):
+    """profiled() for a coroutine function - profiles the event loop thread while the case runs."""
+    @functools.wraps(task)
+    async def run(*args, **kwargs):
+        if not profiler._pick(threading.get_ident()):
+            return await task(*args, **kwargs)
+        started = time.monotonic()
+        profile = profiler._start()
+        result = None
+        try:
+            result = await task(*args, **kwargs)
+            return result
+        finally:
+            profiler._finish(profile, label, started, result)
+    return run
@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import textwrap
+
+# ==============================================================================
+# PROMPT TEMPLATES (Built once at import, only the page count filled per case)
+# ==============================================================================
+# run_pipeline() used to rebuild its giant f-string and json.dumps() every
+# placeholder rule on every call. Now each backend compiles its prompt ONCE
+# (PROMPT = prompts.compile_prompt(...) next to placeholder_rules) with two
+# markers: PAGES where the image count goes and RULES where the placeholder
+# rules go. A case only joins three strings.
+#
+# Every prompt also gets a minified variant, which is what is sent unless
+# PROMPT_MINIFY=0:
+#   - indentation, trailing spaces and runs of blank lines are dropped
+#   - an instruction line that repeats an earlier line, or a placeholder rule
+#     word for word, is dropped (the model still reads it once)
+#   - a long key list ["hb", "tlc", ...] printed a second time becomes a
+#     pointer to the first one
+#   - the rules JSON is compact and keeps non-ASCII characters (≥, °, µ ...)
+#     instead of \u escapes, which cost several tokens each
+# Nothing is reworded: what stays is the tuned text, character for character.
+
+PAGES = "\x00pages\x00"
+RULES = "\x00rules\x00"
+
+MINIFY = os.getenv("PROMPT_MINIFY", "1") != "0"
+
+MIN_DUPLICATE = 30  # Shorter lines ("- Return ONLY valid JSON.") are never treated as repeats
+MIN_KEY_LIST = 60
+
+_BULLET = re.compile(r"^(?:[-*]\s+|\d+\.\s+)+")
+_KEY_LIST = re.compile(r"\[(?:'[^'\n]*',\s*)+'[^'\n]*'\]")
+_BLANK_RUNS = re.compile(r"\n{3,}")
+
+
+class Template:
+    """A prompt split around its PAGES marker. Immutable; render() is one join."""
+
+    __slots__ = ("_head", "_tail")
+
+    def __init__(self, text):
+        head, marker, tail = text.partition(PAGES)
+        if not marker:
+            raise ValueError("Prompt has no page count marker (prompts.PAGES)")
+        object.__setattr__(self, "_head", head)
+        object.__setattr__(self, "_tail", tail)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Compiled prompts are read-only")
+
+    def render(self, pages):
+        return f"{self._head}{pages}{self._tail}"
+
+    def __len__(self):
+        return len(self._head) + len(self._tail)
+
+
+class Prompt:
+    """A department prompt: the full text as written, and the minified variant."""
+
+    __slots__ = ("full", "minified")
+
+    def __init__(self, full, minified):
+        object.__setattr__(self, "full", full)
+        object.__setattr__(self, "minified", minified)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Compiled prompts are read-only")
+
+    def render(self, pages, minify=None):
+        """Prompt text for a case with 'pages' images (minify=None follows PROMPT_MINIFY)."""
+        template = self.minified if (MINIFY if minify is None else minify) else self.full
+        return template.render(pages)
+
+
+def _dedupe_lines(text, rule_text):
+    seen = set()
+    lines = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        content = _BULLET.sub("", line.strip())
+        if len(content) >= MIN_DUPLICATE and PAGES not in content and RULES not in content:
+            if content in seen or content in rule_text:
+                continue
+            seen.add(content)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _dedupe_key_lists(text):
+    seen = set()
+
+    def replace(match):
+        key_list = match.group(0)
+        if len(key_list) < MIN_KEY_LIST:
+            return key_list
+        if key_list in seen:
+            return "(the same keys as listed above)"
+        seen.add(key_list)
+        return key_list
+
+    return _KEY_LIST.sub(replace, text)
+
+
+def minify(text, placeholder_rules):
+    """The minified variant of a prompt (see the header). Markers are left in place."""
+    rule_text = "\n".join(str(rule) for rule in placeholder_rules.values())
+    text = _dedupe_lines(textwrap.dedent(text).strip(), rule_text)
+    text = _dedupe_key_lists(text)
+    return _BLANK_RUNS.sub("\n\n", text) + "\n"
+
+
+def compile_prompt(text, placeholder_rules):
+    """Builds a department's Prompt from its text (with PAGES and RULES markers) and rules."""
+    full = text.replace(RULES, json.dumps(placeholder_rules))
+    compact = json.dumps(placeholder_rules, ensure_ascii=False, separators=(",", ":"))
+    minified = minify(text, placeholder_rules).replace(RULES, compact)
+    return Prompt(Template(full), Template(minified))
@@ -0,0 +1,202 @@
+import math
+import time
+import asyncio
+import threading
+import contextvars
+
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# PROCESS-WIDE RATE LIMITER (Shared by Medicine, Surgery and OBGYN)
+# ==============================================================================
+# When several residents submit at once, every worker thread used to fire at
+# Gemini / Drive / Docs independently and we tripped the per-minute quotas.
+# Each quota now has ONE token bucket for the whole process. A call that finds
+# the bucket empty waits its turn (first come, first served) instead of
+# failing - the time spent waiting is reported back in the case status.
+#
+# The *_async variants queue the same way on the same buckets, but wait with
+# asyncio.sleep() so a case on the event loop (pipeline_async.py) never holds
+# a thread while it waits for quota.
+
+# Google Workspace quotas (per user, per minute). Gemini limits are per model
+# and live in RATE_LIMITS next to PRICING in each backend.
+GOOGLE_LIMITS = {
+    "drive_writes": 180,
+    "docs_updates": 60,
+}
+
+DRIVE_WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+# Gemini image cost: 258 tokens per 768x768 tile (small images = 1 tile)
+IMAGE_TILE = 768
+TOKENS_PER_TILE = 258
+CHARS_PER_TOKEN = 4
+
+
+class TokenBucket:
+    """Token bucket that queues callers (by reserving tokens) instead of rejecting them."""
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount=1):
+        """Takes 'amount' tokens without waiting. Returns the seconds the caller must wait before using them."""
+        amount = min(amount, self.capacity)  # One oversized call must still get through
+        with self._lock:
+            self._refill()
+            # Reserve now (balance may go negative); later callers queue behind us
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def acquire(self, amount=1):
+        """Takes 'amount' tokens, sleeping until they are available. Returns seconds waited."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, amount=1):
+        """acquire() for the event loop: same queue, but the wait is an asyncio.sleep()."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def refund(self, amount):
+        """Gives back over-reserved tokens (a negative amount takes extra ones)."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+# A context variable rather than a thread-local: many cases share the event loop's thread
+_waited = contextvars.ContextVar("rate_limit_waited", default=0.0)
+
+
+def _bucket(name, per_minute):
+    with _buckets_lock:
+        if name not in _buckets:
+            _buckets[name] = TokenBucket(per_minute)
+        return _buckets[name]
+
+
+def _record_wait(seconds):
+    _waited.set(_waited.get() + seconds)
+
+
+# --- PER-CASE WAIT TRACKING (a worker thread or an asyncio task per case) ---
+def reset_wait():
+    _waited.set(0.0)
+
+
+def waited():
+    """Seconds the current case has spent queued behind the rate limiter."""
+    return _waited.get()
+
+
+def add_wait(seconds):
+    """Counts queue time spent on helper threads (e.g. parallel page calls) toward this case."""
+    _record_wait(seconds)
+
+
+# --- GEMINI ---
+def estimate_input_tokens(prompt_content):
+    """Rough input-token count for a [text, image, image...] prompt, before sending it."""
+    total = 0
+    for part in prompt_content:
+        if isinstance(part, str):
+            total += len(part) // CHARS_PER_TOKEN
+        elif hasattr(part, "size"):
+            width, height = part.size
+            total += TOKENS_PER_TILE * math.ceil(width / IMAGE_TILE) * math.ceil(height / IMAGE_TILE)
+    return total
+
+
+def _gemini_buckets(model_name, limits):
+    model_limits = limits.get(model_name)
+    if not model_limits:
+        return None
+    return (_bucket(f"gemini:{model_name}:requests", model_limits["requests"]),
+            _bucket(f"gemini:{model_name}:input_tokens", model_limits["input_tokens"]))
+
+
+def _gemini_waited(model_name, wait):
+    _record_wait(wait)
+    if wait > 1:
+        log.info("Waited for Gemini quota", model=model_name, wait_s=round(wait, 1))
+    return wait
+
+
+def wait_for_gemini(model_name, input_tokens, limits):
+    """Blocks until both the request and the input-token bucket for this model allow the call."""
+    buckets = _gemini_buckets(model_name, limits)
+    if not buckets:
+        return 0.0
+    wait = buckets[0].acquire(1)
+    wait += buckets[1].acquire(input_tokens)
+    return _gemini_waited(model_name, wait)
+
+
+async def wait_for_gemini_async(model_name, input_tokens, limits):
+    """wait_for_gemini() for the event loop."""
+    buckets = _gemini_buckets(model_name, limits)
+    if not buckets:
+        return 0.0
+    wait = await buckets[0].acquire_async(1)
+    wait += await buckets[1].acquire_async(input_tokens)
+    return _gemini_waited(model_name, wait)
+
+
+def settle_gemini_tokens(model_name, estimated, actual, limits):
+    """Corrects the token bucket once the real prompt_token_count is known."""
+    model_limits = limits.get(model_name)
+    if not model_limits or actual is None:
+        return
+    # Under-estimates go negative here, so the NEXT caller waits (not this finished one)
+    _bucket(f"gemini:{model_name}:input_tokens", model_limits["input_tokens"]).refund(estimated - actual)
+
+
+# --- DRIVE / DOCS ---
+def _google_bucket(service, request):
+    method = getattr(request, "method", "GET")
+    uri = getattr(request, "uri", "")
+
+    if service == "drive" and method in DRIVE_WRITE_METHODS:
+        return _bucket("drive_writes", GOOGLE_LIMITS["drive_writes"])
+    if service == "docs" and ":batchUpdate" in uri:
+        return _bucket("docs_updates", GOOGLE_LIMITS["docs_updates"])
+    return None
+
+
+def wait_for_google(service, request):
+    """Rate-limits Drive writes and Docs batchUpdates. Reads are not limited."""
+    bucket = _google_bucket(service, request)
+    if bucket is None:
+        return 0.0
+    wait = bucket.acquire(1)
+    _record_wait(wait)
+    return wait
+
+
+async def wait_for_google_async(service, request):
+    """wait_for_google() for the event loop."""
+    bucket = _google_bucket(service, request)
+    if bucket is None:
+        return 0.0
+    wait = await bucket.acquire_async(1)
+    _record_wait(wait)
+    return wait
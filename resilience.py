@@ -0,0 +1,302 @@
+import os
+import time
+import random
+import socket
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
+
+import httplib2
+import google_auth_httplib2
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+import rate_limit
+import tracing
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# SHARED RESILIENCE LAYER (Timeouts + Retry/Backoff + Circuit Breaker + Metrics)
+# ==============================================================================
+# Every Gemini / Drive / Docs call in the backends goes through call() or
+# execute(). Transient failures (429 / 5xx / timeouts / dropped connections)
+# are retried with jittered exponential backoff. If a service keeps failing,
+# its circuit "opens" and further calls fail fast instead of tying up a worker.
+#
+# call_async() / execute_async() are the same layer for the event loop
+# (pipeline_async.py): same breakers, same counters, but backoff and quota
+# waits are asyncio.sleep(). googleapiclient has no async transport, so a
+# Drive / Docs round trip itself runs on a small shared I/O pool - a thread is
+# only held while a request is actually on the wire.
+
+# Per-call socket timeouts in seconds (replaces the old global 600s default)
+TIMEOUTS = {
+    "gemini": int(os.getenv("GEMINI_TIMEOUT", "300")),
+    "drive": int(os.getenv("DRIVE_TIMEOUT", "60")),
+    "docs": int(os.getenv("DOCS_TIMEOUT", "60")),
+}
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1.0   # First retry waits ~1s, then ~2s, ~4s, ...
+MAX_DELAY = 30.0
+
+# Threads for Drive / Docs round trips made from the event loop (all cases share them)
+GOOGLE_IO_WORKERS = int(os.getenv("GOOGLE_IO_WORKERS", "16"))
+
+FAILURE_THRESHOLD = 5  # Consecutive transient failures before the circuit opens
+RESET_TIMEOUT = 30.0   # Seconds an open circuit waits before letting one trial call through
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit is open."""
+
+
+class CircuitBreaker:
+    """Classic closed -> open -> half-open breaker, one per external service."""
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let exactly one trial call through
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def release(self):
+        """A half-open trial that proved nothing (cancelled, client error): back to open, next caller may try."""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"  # opened_at unchanged - the reset timeout has already run out
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    log.error("Circuit open", service=self.name, failures=self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+_breakers = {name: CircuitBreaker(name) for name in TIMEOUTS}
+_io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=GOOGLE_IO_WORKERS, thread_name_prefix="google-io")
+
+_metrics_lock = threading.Lock()
+_metrics = {
+    name: {"calls": 0, "successes": 0, "failures": 0, "retries": 0, "short_circuits": 0, "total_seconds": 0.0}
+    for name in TIMEOUTS
+}
+
+
+# Seconds per service for the case running in this context (see start_case_timing)
+_case_seconds = contextvars.ContextVar("case_service_seconds", default=None)
+
+
+def _count(service, field, amount=1):
+    with _metrics_lock:
+        _metrics[service][field] += amount
+    if field == "total_seconds":
+        case_seconds = _case_seconds.get()
+        if case_seconds is not None:
+            with _metrics_lock:
+                case_seconds[service] = case_seconds.get(service, 0.0) + amount
+
+
+def start_case_timing():
+    """Starts counting call seconds per service for the current case. Returns the live {service: seconds} dict.
+
+    Helper threads and tasks that run in a copy of this context add to the same dict.
+    """
+    case_seconds = {}
+    _case_seconds.set(case_seconds)
+    return case_seconds
+
+
+def get_metrics():
+    """Snapshot of call counters and breaker state per service."""
+    with _metrics_lock:
+        snapshot = {name: dict(values) for name, values in _metrics.items()}
+    for name, breaker in _breakers.items():
+        snapshot[name]["circuit"] = breaker.state
+    return snapshot
+
+
+def is_retryable(exc):
+    """True for errors that are worth retrying (quota, server side, network)."""
+    if isinstance(exc, HttpError):
+        return exc.resp.status in RETRY_STATUSES
+    if isinstance(exc, (socket.timeout, TimeoutError, ConnectionError, httplib2.HttpLib2Error)):
+        return True
+    # google.api_core exceptions (used by the Gemini SDK) carry an HTTP code
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code in RETRY_STATUSES
+    return False
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: random(0, min(MAX_DELAY, BASE * 2^attempt))."""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** attempt)))
+
+
+def _model_name(fn):
+    """The Gemini model behind a bound generate_content (None for anything else)."""
+    return getattr(getattr(fn, "__self__", None), "model_name", None)
+
+
+def call(fn, service, *args, before_attempt=None, **kwargs):
+    """Runs fn(*args, **kwargs) with retries and the circuit breaker for 'service'.
+
+    before_attempt() runs before every attempt, retries included - pass the rate limiter
+    here (e.g. rate_limit.wait_for_gemini) so a retry takes its own token from the bucket.
+    """
+    with tracing.span(f"{service}.{fn.__name__}", service=service, model=_model_name(fn)):
+        return _call(fn, service, args, kwargs, before_attempt)
+
+
+def _call(fn, service, args, kwargs, before_attempt=None):
+    breaker = _breakers[service]
+
+    for attempt in range(MAX_ATTEMPTS):
+        if before_attempt:
+            # e.g. queue behind the shared rate limiter (not counted as call time).
+            # Before allow(): a half-open trial must not sit in a quota queue
+            before_attempt()
+
+        if not breaker.allow():
+            _count(service, "short_circuits")
+            raise CircuitOpenError(f"{service} is unavailable right now (circuit open). Please try again in a minute.")
+
+        _count(service, "calls")
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            if not isinstance(e, Exception):
+                breaker.release()  # Interrupted, not answered
+                raise
+            _count(service, "total_seconds", time.monotonic() - start)
+            if not is_retryable(e):
+                # Client errors (bad request, permissions, not found) say nothing about the
+                # service's health: the breaker is left as it was (a half-open trial is handed back)
+                breaker.release()
+                _count(service, "failures")
+                raise
+            breaker.record_failure()
+            _count(service, "failures")
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(attempt)
+            log.warning("Call failed, retrying", service=service, retry=attempt + 1, of=MAX_ATTEMPTS - 1, delay_s=round(delay, 1), error=e)
+            _count(service, "retries")
+            tracing.current().set(retries=attempt + 1)
+            time.sleep(delay)
+            continue
+
+        _count(service, "total_seconds", time.monotonic() - start)
+        _count(service, "successes")
+        breaker.record_success()
+        return result
+
+
+async def call_async(fn, service, *args, before_attempt=None, **kwargs):
+    """call() for the event loop: 'fn' and before_attempt() return awaitables (e.g. generate_content_async)."""
+    with tracing.span(f"{service}.{fn.__name__}", service=service, model=_model_name(fn)):
+        return await _call_async(fn, service, args, kwargs, before_attempt)
+
+
+async def _call_async(fn, service, args, kwargs, before_attempt=None):
+    breaker = _breakers[service]
+
+    for attempt in range(MAX_ATTEMPTS):
+        if before_attempt:
+            await before_attempt()
+
+        if not breaker.allow():
+            _count(service, "short_circuits")
+            raise CircuitOpenError(f"{service} is unavailable right now (circuit open). Please try again in a minute.")
+
+        _count(service, "calls")
+        start = time.monotonic()
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            if not isinstance(e, Exception):
+                # CancelledError (a sibling page failed, the case was dropped): an unfinished
+                # half-open trial would otherwise leave the circuit half open for good
+                breaker.release()
+                raise
+            _count(service, "total_seconds", time.monotonic() - start)
+            if not is_retryable(e):
+                breaker.release()
+                _count(service, "failures")
+                raise
+            breaker.record_failure()
+            _count(service, "failures")
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(attempt)
+            log.warning("Call failed, retrying", service=service, retry=attempt + 1, of=MAX_ATTEMPTS - 1, delay_s=round(delay, 1), error=e)
+            _count(service, "retries")
+            tracing.current().set(retries=attempt + 1)
+            await asyncio.sleep(delay)
+            continue
+
+        _count(service, "total_seconds", time.monotonic() - start)
+        _count(service, "successes")
+        breaker.record_success()
+        return result
+
+
+def run_io(fn, *args):
+    """Runs a blocking Google call on the shared I/O pool. Returns an awaitable."""
+    return asyncio.get_running_loop().run_in_executor(_io_pool, contextvars.copy_context().run, fn, *args)
+
+
+def execute(request, service):
+    """Executes a googleapiclient request (Drive/Docs) through call(), respecting the shared rate limits."""
+    with _request_span(request, service):
+        return _call(request.execute, service, (), {}, before_attempt=lambda: rate_limit.wait_for_google(service, request))
+
+
+async def execute_async(request, service):
+    """execute() for the event loop: quota and backoff waits don't hold a thread."""
+    with _request_span(request, service):
+        return await _call_async(run_io, service, (request.execute,), {},
+                                 before_attempt=lambda: rate_limit.wait_for_google_async(service, request))
+
+
+def _request_span(request, service):
+    # methodId is the API method, e.g. "drive.files.copy" / "docs.documents.batchUpdate"
+    return tracing.span(getattr(request, "methodId", None) or f"{service}.execute", service=service)
+
+
+def build_service(name, version, credentials):
+    """Same as googleapiclient build(), but with a per-service socket timeout."""
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=TIMEOUTS[name]))
+    return build(name, version, http=http, cache_discovery=False)
+
+
+def gemini_request_options():
+    """request_options for genai generate_content() so a hung call can't block forever."""
+    return {"timeout": TIMEOUTS["gemini"]}
@@ -0,0 +1,242 @@
+import os
+import time
+import shutil
+import uuid
+import tempfile
+import threading
+
+import preprocess  # Photos, PDF and TIFF pages
+import structured_log  # JSON-lines logging with case context
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# SESSION MEMORY MANAGER (Uploads live on disk, not in st.session_state)
+# ==============================================================================
+# A resident working through 25 cases used to keep every uploaded photo in
+# memory three times over: in the uploader widget, as PIL images captured by
+# the submitted future, and (until the export cache) as .docx bytes in the
+# results. Now the moment a case is submitted its upload bytes are written to
+# a per-session temp folder. The worker thread opens the pages from disk and
+# closes them as soon as the run is over. The photos are patient notes: the
+# folders are mode 0700 (this user only), and folders of dead sessions are
+# purged when the process starts and whenever a new session opens.
+#
+# The files of a finished case stay on disk (never in memory) so one section
+# can be re-read later ("Re-extract Section"), until the case is deleted or
+# started over.
+#
+# Each session may hold at most MAX_SESSION_MB of uploads. When a new case
+# needs room, the pages of the oldest finished cases are dropped first; only
+# then are new cases refused until running ones finish.
+#
+# That cap counts the files on disk - a 2 MB PDF can still render to hundreds
+# of MB of pixels. So the worker also caps what one case decodes: at most
+# MAX_CASE_PAGES pages and MAX_DECODED_MB of pixels. Past either, the pages
+# opened so far are closed and the case fails with a message.
+
+MAX_SESSION_MB = int(os.getenv("MAX_SESSION_MB", "150"))
+MAX_CASE_PAGES = int(os.getenv("MAX_CASE_PAGES", "40"))
+MAX_DECODED_MB = int(os.getenv("MAX_DECODED_MB", "400"))  # ~ 40 photos of 3 MP; a 150 DPI A4 page is ~6.5 MB
+SESSION_TTL = 24 * 3600  # Spill folders of abandoned sessions are purged after a day
+
+SPILL_ROOT = os.path.join(tempfile.gettempdir(), "scribe_sessions")
+
+
+def _private_folder(path):
+    """Creates 'path' readable by this user only (and tightens it if an older version left it open)."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    try:
+        os.chmod(path, 0o700)
+    except OSError:
+        pass  # Somebody else's folder - our session folders below are still 0700
+
+
+class SessionLimitError(Exception):
+    """Raised when a new case would push the session past MAX_SESSION_MB (or one case
+    past MAX_CASE_PAGES / MAX_DECODED_MB once decoded)."""
+
+
+class SessionStore:
+    """Per-session spill folder: case_id -> list of page files on disk."""
+
+    def __init__(self, max_bytes=MAX_SESSION_MB * 1024 * 1024, root=SPILL_ROOT):
+        self.session_id = uuid.uuid4().hex
+        self.folder = os.path.join(root, self.session_id)
+        self.max_bytes = max_bytes
+        self._cases = {}     # case_id -> (paths, total bytes)
+        self._finished = {}  # case_id -> None, oldest first (pages kept, can be dropped for room)
+        self._lock = threading.Lock()
+        _private_folder(root)
+        os.makedirs(self.folder, mode=0o700, exist_ok=True)
+
+    # --- UI THREAD ---
+    def spill_uploads(self, case_id, uploaded_files):
+        """Writes uploaded files to disk and returns their paths (the widget bytes can then go)."""
+        sizes = [f.size for f in uploaded_files]
+        self.release(case_id)  # A resubmitted case replaces its old pages
+        self._make_room(sum(sizes))
+        if self.usage() + sum(sizes) > self.max_bytes:
+            raise SessionLimitError(
+                f"Session limit of {self.max_bytes // (1024 * 1024)} MB reached. "
+                "Wait for running cases to finish (or delete some) before adding more."
+            )
+
+        case_folder = os.path.join(self.folder, str(case_id))
+        os.makedirs(case_folder, mode=0o700, exist_ok=True)
+
+        paths = []
+        for i, f in enumerate(uploaded_files):
+            ext = os.path.splitext(f.name)[1] or ".jpg"
+            path = os.path.join(case_folder, f"page_{i+1}{ext}")
+            with open(path, "wb") as out:
+                out.write(f.getbuffer())
+            paths.append(path)
+
+        with self._lock:
+            self._cases[case_id] = (paths, sum(sizes))
+        return paths
+
+    def _make_room(self, needed):
+        """Drops the pages of the oldest finished cases until 'needed' more bytes fit."""
+        while True:
+            with self._lock:
+                used = sum(size for _, size in self._cases.values())
+                if not self._finished or used + needed <= self.max_bytes:
+                    return
+                oldest = next(iter(self._finished))
+            log.info("Session cap: dropping kept pages", dropped_case=oldest)
+            self.release(oldest)
+
+    def has_pages(self, case_id):
+        with self._lock:
+            return case_id in self._cases
+
+    # --- WORKER THREAD ---
+    def checkout(self, case_id):
+        """Paths of a case's pages for another run (None if they were dropped), protected from eviction."""
+        with self._lock:
+            entry = self._cases.get(case_id)
+            if entry is None:
+                return None
+            self._finished.pop(case_id, None)
+            return list(entry[0])
+
+    def finish(self, case_id):
+        """The run is over: keep the pages on disk, but let them go first when room is needed."""
+        with self._lock:
+            if case_id in self._cases:
+                self._finished.pop(case_id, None)
+                self._finished[case_id] = None
+
+    def release(self, case_id):
+        """Deletes a case's spilled pages (safe to call more than once)."""
+        with self._lock:
+            self._cases.pop(case_id, None)
+            self._finished.pop(case_id, None)
+        shutil.rmtree(os.path.join(self.folder, str(case_id)), ignore_errors=True)
+
+    def usage(self):
+        with self._lock:
+            return sum(size for _, size in self._cases.values())
+
+    def stats(self):
+        with self._lock:
+            kept = len(self._finished)
+            pending = len(self._cases) - kept
+            used = sum(size for _, size in self._cases.values())
+        return {"session": self.session_id[:8], "pending_cases": pending, "kept_cases": kept,
+                "bytes": used, "max_bytes": self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self._cases.clear()
+            self._finished.clear()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _decoded_bytes(page):
+    if isinstance(page, preprocess.TextPage):
+        return len(page)
+    return page.width * page.height * len(page.getbands())
+
+
+def open_images(paths, max_pages=MAX_CASE_PAGES, max_bytes=MAX_DECODED_MB * 1024 * 1024):
+    """Opens spilled uploads as pages: fully loaded PIL images (file handles closed at once),
+    one per photo and one per PDF / TIFF page, or preprocess.TextPage for typed PDF pages.
+
+    Pages are pulled one at a time; past max_pages or max_bytes of pixels the ones already
+    open are closed and SessionLimitError is raised - the rest are never rendered.
+    """
+    images = []
+    total = 0
+    pages = preprocess.iter_pages(paths)
+    try:
+        for page in pages:
+            images.append(page)
+            total += _decoded_bytes(page)
+            if len(images) > max_pages:
+                raise SessionLimitError(
+                    f"This case has more than {max_pages} pages. Split it into smaller uploads."
+                )
+            if total > max_bytes:
+                raise SessionLimitError(
+                    f"The pages of this case decode to more than {max_bytes // (1024 * 1024)} MB. "
+                    "Upload fewer pages (or PDFs instead of large photos) per case."
+                )
+    except BaseException:
+        pages.close()  # Lets the PDF / TIFF generator close its file
+        close_images(images)
+        raise
+    return images
+
+
+def close_images(images):
+    """Frees the decoded pixel buffers as soon as the pipeline is done with them."""
+    for img in images:
+        try:
+            img.close()
+        except Exception:
+            pass  # Typed pages are plain text
+    images.clear()
+
+
+_purge_lock = threading.Lock()
+
+
+def purge_stale(root=SPILL_ROOT, max_age=SESSION_TTL):
+    """Removes spill folders left behind by sessions that ended without cleaning up."""
+    if not _purge_lock.acquire(blocking=False):
+        return
+    try:
+        if not os.path.isdir(root):
+            return
+        cutoff = time.time() - max_age
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                continue
+    finally:
+        _purge_lock.release()
+
+
+purge_stale()  # Process start: sessions of an earlier run never come back
+
+
+def process_rss():
+    """Resident memory of the whole Streamlit process in bytes (None if unknown)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return None
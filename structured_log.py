@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import inspect
+import logging
+import datetime
+import functools
+import contextlib
+import contextvars
+import logging.handlers
+
+# ==============================================================================
+# STRUCTURED LOGGING (JSON lines, written off the pipeline threads)
+# ==============================================================================
+# Every module logs through get_logger(__name__) instead of print(). Each event
+# is one JSON object:
+#   ts, level, logger, event, thread
+#   case_id, department      - the case this code runs for (see case() below)
+#   stage, duration_ms       - the pipeline stage and how long it has run so far
+#   elapsed_ms               - time since the case started
+#   error_class, error       - when an exception is passed as error=
+#   ...                      - whatever fields the call site adds
+#
+# Callers never touch stdout: a QueueHandler puts the record on an unbounded
+# queue and a listener thread formats and writes it, so a slow terminal or
+# disk never holds up a case. Case context lives in a ContextVar and follows
+# the case onto pool threads and async tasks (like tracing.py), and is read
+# at the call, not on the listener thread.
+#
+#   LOG_FORMAT   json (default) or text (one readable line per event, for a terminal)
+#   LOG_LEVEL    INFO by default
+#   LOG_FILE     append to this file instead of stdout
+#
+# Patient names and field values are never logged - document IDs and counts only.
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE")
+ERROR_CHARS = 300
+
+ROOT = "scribe"
+
+
+# --- CASE CONTEXT ---
+class CaseContext:
+    def __init__(self, case_id, department):
+        self.case_id = case_id
+        self.department = department
+        self.started = time.monotonic()
+        self.stage = None
+        self.stage_started = self.started
+
+    def fields(self):
+        now = time.monotonic()
+        return {
+            "case_id": self.case_id,
+            "department": self.department,
+            "stage": self.stage,
+            "duration_ms": round((now - self.stage_started) * 1000),
+            "elapsed_ms": round((now - self.started) * 1000),
+        }
+
+
+_case = contextvars.ContextVar("log_case", default=None)
+
+
+@contextlib.contextmanager
+def case(case_id=None, department=None):
+    """Everything logged inside belongs to this case. Nested: the inner scope keeps what it doesn't override."""
+    parent = _case.get()
+    context = CaseContext(
+        case_id or (parent.case_id if parent else uuid.uuid4().hex[:8]),
+        department or (parent.department if parent else None),
+    )
+    token = _case.set(context)
+    try:
+        yield context
+    finally:
+        _case.reset(token)
+
+
+def case_scope(department=None):
+    """Decorator: the whole call (sync or async) runs in case(department=...)."""
+    def wrap(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def run_async(*args, **kwargs):
+                with case(department=department):
+                    return await fn(*args, **kwargs)
+            return run_async
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with case(department=department):
+                return fn(*args, **kwargs)
+        return run
+    return wrap
+
+
+def set_stage(stage):
+    """Moves the current case to 'stage' (duration_ms restarts). No-op outside a case."""
+    context = _case.get()
+    if context is not None:
+        context.stage = stage
+        context.stage_started = time.monotonic()
+
+
+# --- LOGGER ---
+class EventLogger:
+    """log.info("event", key=value, ...) - fields end up as JSON keys, never in the message."""
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(f"{ROOT}.{name}")
+
+    def _log(self, level, event, error=None, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        context = _case.get()
+        data = context.fields() if context is not None else {}
+        if error is not None:
+            data["error_class"] = type(error).__name__
+            data["error"] = str(error)[:ERROR_CHARS]
+        if fields.get("stage", data.get("stage")) != data.get("stage"):
+            data.pop("duration_ms", None)  # A side job (backup, cost log) - the case's stage timer isn't its duration
+        data.update(fields)
+        self._logger.log(level, event, extra={"fields": data})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, **fields)
+
+    def stage(self, stage, event, **fields):
+        """set_stage() and an INFO event for the new stage."""
+        set_stage(stage)
+        if _case.get() is None:
+            fields.setdefault("stage", stage)  # No case to carry it
+        self._log(logging.INFO, event, **fields)
+
+
+def get_logger(name):
+    return EventLogger(name)
+
+
+# --- FORMATTERS (run on the listener thread) ---
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+            "thread": record.threadName,
+        }
+        event.update((k, v) for k, v in getattr(record, "fields", {}).items() if v is not None)
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {k: v for k, v in getattr(record, "fields", {}).items() if v is not None}
+        where = " ".join(str(fields.pop(k)) for k in ("case_id", "department", "stage") if k in fields)
+        fields.pop("elapsed_ms", None)
+        extras = " ".join(f"{k}={v}" for k, v in fields.items())
+        stamp = datetime.datetime.fromtimestamp(record.created).strftime("%H:%M:%S")
+        return f"{stamp} {record.levelname:<7} [{where}] {record.getMessage()} {extras}".rstrip()
+
+
+# --- QUEUE HANDLER + LISTENER ---
+_queue = queue.SimpleQueue()  # Unbounded: put() never blocks the caller
+_listener = None
+
+
+def _setup():
+    global _listener
+    root = logging.getLogger(ROOT)
+    if _listener is not None or root.handlers:
+        return
+    output = logging.FileHandler(LOG_FILE, encoding="utf-8") if LOG_FILE else logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    root.addHandler(logging.handlers.QueueHandler(_queue))
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)  # Flush what is still queued
+
+
+@contextlib.contextmanager
+def muted():
+    """Drops every event while inside - process-wide, for the benchmarks (never the app)."""
+    root = logging.getLogger(ROOT)
+    level = root.level
+    root.setLevel(logging.CRITICAL + 1)
+    try:
+        yield
+    finally:
+        root.setLevel(level)
+
+
+def flush():
+    """Waits until everything logged so far is written (benchmarks, tests)."""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+_setup()
@@ -0,0 +1,399 @@
+import os
+import time
+import uuid
+import asyncio
+import datetime
+import threading
+import contextvars
+import collections
+import concurrent.futures
+
+import resilience   # Shared timeouts, retry/backoff and circuit breaker for Google calls
+import rate_limit   # Process-wide token buckets for Gemini / Drive / Docs quotas
+import structured_log  # JSON-lines logging with case context
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# TEMPLATE COPIES (Started before the patient's name is known)
+# ==============================================================================
+# The summary's file name needs {{patient_name}}, so the files().copy of the
+# department template used to wait for Gemini. Now a case starts the copy
+# under a temporary name as soon as it begins, on a small shared pool, and
+# once the AI has answered one cheap metadata update gives it its real name.
+# The copy is hidden behind the model call instead of following it.
+#
+# A case that fails before claiming its copy deletes it (in the background,
+# the error goes back to the user right away). SPECULATIVE_COPY=0 goes back
+# to copying after the AI, with the final name. A copy orphaned by a restart
+# mid-case can't be deleted that way: temporary copies carry a Drive
+# appProperty (TEMP_PROPERTY, cleared on rename), and sweep_leftovers() deletes
+# the ones older than LEFTOVER_HOURS from the output folders at startup.
+#
+# WARM POOL: with TEMPLATE_STAGING_FOLDER_ID set, a background maintainer
+# keeps TEMPLATE_POOL_SIZE untouched copies of every department template in
+# that folder. A case claims a ready one - one update renames it and moves it
+# into the output folder - and the maintainer copies a replacement. No copy
+# is left on the case's path at all, even during the morning discharge rush.
+# Every staged copy carries the template revision it came from (Drive
+# appProperties); when the master template is edited, the stale copies are
+# deleted and the pool refills from the new revision. Staged copies outlive
+# a restart and are adopted again, so the staging folder must belong to ONE
+# app process. An empty pool falls back to the speculative copy.
+
+SPECULATIVE = os.getenv("SPECULATIVE_COPY", "1") != "0"
+TEMP_PREFIX = "~ In progress - "  # Never a real summary name: a leftover is easy to spot in Drive
+TEMP_PROPERTY = "scribe_temp"     # appProperties key on a copy not claimed yet
+LEFTOVER_HOURS = float(os.getenv("TEMPLATE_LEFTOVER_HOURS", "6"))  # Far longer than any case runs
+
+DOC_MIME = 'application/vnd.google-apps.document'
+
+STAGING_FOLDER_ID = os.getenv("TEMPLATE_STAGING_FOLDER_ID")  # The warm pool is off without it
+POOL_SIZE = int(os.getenv("TEMPLATE_POOL_SIZE", "3"))       # Ready copies per department template
+POOL_CHECK_SECONDS = 300  # How often the maintainer asks Drive whether a template changed
+STAGED_PREFIX = "~ Ready - "
+
+COPY_WORKERS = int(os.getenv("TEMPLATE_COPY_WORKERS", "8"))
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=COPY_WORKERS, thread_name_prefix="template-copy")
+
+
+def copy_template(drive_service, template_id, folder_id, name, properties=None):
+    """One files().copy of the template into 'folder_id'. Returns the new document ID."""
+    body = {'name': name, 'parents': [folder_id], 'mimeType': DOC_MIME}
+    if properties:
+        body['appProperties'] = properties
+    copy_response = resilience.execute(drive_service.files().copy(
+        fileId=template_id,
+        body=body,
+        supportsAllDrives=True
+    ), "drive")
+    return copy_response.get('id')
+
+
+def _move_request(drive_service, document_id, name, folder_id):
+    """Renames a staged copy and moves it from the staging folder into 'folder_id' (one update)."""
+    return drive_service.files().update(fileId=document_id, body={'name': name, 'appProperties': {'pool_template': None, 'pool_version': None}},
+                                        addParents=folder_id, removeParents=pool.staging_folder_id, supportsAllDrives=True)
+
+
+def _rename_request(drive_service, document_id, name):
+    """Gives a speculative copy its real name; it stops being a temporary copy."""
+    return drive_service.files().update(fileId=document_id, body={'name': name, 'appProperties': {TEMP_PROPERTY: None}},
+                                        supportsAllDrives=True)
+
+
+def delete_file(drive_service, file_id):
+    try:
+        resilience.execute(drive_service.files().delete(fileId=file_id, supportsAllDrives=True), "drive")
+        log.info("Removed unused template copy", document_id=file_id)
+    except Exception as e:
+        log.warning("Could not remove template copy", document_id=file_id, error=e)
+
+
+class TemplateCopy:
+    """The department template, copied for one case. start_copy() makes one."""
+
+    def __init__(self, credentials, template_id, folder_id, speculative=True, staged=None):
+        self.credentials = credentials
+        self.template_id = template_id
+        self.folder_id = folder_id
+        self.temp_name = f"{TEMP_PREFIX}{uuid.uuid4().hex[:12]}"
+        self.future = None
+        self.claimed = False
+        self.staged = staged  # (document ID, template version) taken from the warm pool
+        if speculative and staged is None:
+            # In a copy of the case's context, so per-case state follows the copy onto the pool
+            self.future = _pool.submit(contextvars.copy_context().run, self._copy)
+
+    def _copy(self):
+        rate_limit.reset_wait()
+        drive_service = resilience.build_service('drive', 'v3', self.credentials)
+        document_id = copy_template(drive_service, self.template_id, self.folder_id, self.temp_name,
+                                    properties={TEMP_PROPERTY: "1"})
+        return document_id, rate_limit.waited()
+
+    def _rename(self, drive_service, document_id, name):
+        resilience.execute(_rename_request(drive_service, document_id, name), "drive")
+
+    def claim(self, drive_service, name):
+        """The case's document, named 'name'. Waits for the copy if it is still running."""
+        if self.staged is not None:
+            try:
+                resilience.execute(_move_request(drive_service, self.staged[0], name, self.folder_id), "drive")
+                self.claimed = True
+                return self.staged[0]
+            except Exception as e:
+                # Deleted by hand, or a permissions change on the staging folder: copy the usual way
+                log.warning("Ready template copy unusable - copying now", error=e)
+                self.staged = None
+        if self.future is None:
+            self.claimed = True
+            return copy_template(drive_service, self.template_id, self.folder_id, name)
+        document_id, waited = self.future.result()
+        rate_limit.add_wait(waited)
+        try:
+            self._rename(drive_service, document_id, name)
+        except Exception:
+            self.discard()
+            raise
+        self.claimed = True
+        return document_id
+
+    async def claim_async(self, drive_service, name):
+        """claim() for the event loop."""
+        if self.staged is not None:
+            try:
+                await resilience.execute_async(_move_request(drive_service, self.staged[0], name, self.folder_id), "drive")
+                self.claimed = True
+                return self.staged[0]
+            except Exception as e:
+                log.warning("Ready template copy unusable - copying now", error=e)
+                self.staged = None
+        if self.future is None:
+            self.claimed = True
+            return await resilience.run_io(copy_template, drive_service, self.template_id, self.folder_id, name)
+        document_id, waited = await asyncio.wrap_future(self.future)
+        rate_limit.add_wait(waited)
+        try:
+            await resilience.execute_async(_rename_request(drive_service, document_id, name), "drive")
+        except Exception:
+            self.discard()
+            raise
+        self.claimed = True
+        return document_id
+
+    def discard(self):
+        """The case failed: delete the copy once it exists. Never blocks, never raises."""
+        if self.claimed:
+            return
+        if self.staged is not None:
+            pool.give_back(self.template_id, self.staged)  # Still untouched - the next case can have it
+            return
+        if self.future is None:
+            return
+        if self.future.cancel():
+            return  # Never started - nothing to delete
+        _pool.submit(self._delete_when_done)
+
+    def _delete_when_done(self):
+        try:
+            document_id, _ = self.future.result()
+        except Exception:
+            return  # The copy itself failed - there is no document
+        delete_file(resilience.build_service('drive', 'v3', self.credentials), document_id)
+
+
+# --- WARM POOL ---
+class WarmPool:
+    """Ready, untouched copies of each department template, refilled by one daemon thread."""
+
+    def __init__(self, size=POOL_SIZE, staging_folder_id=STAGING_FOLDER_ID, check_seconds=POOL_CHECK_SECONDS):
+        self.size = size
+        self.staging_folder_id = staging_folder_id
+        self.check_seconds = check_seconds
+        self._ready = {}      # template_id -> deque of (document ID, template version)
+        self._versions = {}   # template_id -> current revision of the master template
+        self._names = {}      # template_id -> template title (for the staged copies' names)
+        self._checked = {}    # template_id -> when its revision was last asked for
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._get_credentials = None
+        self._adopted = False
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return bool(self.staging_folder_id) and self.size > 0
+
+    def start(self, template_ids, get_credentials):
+        """Starts the maintainer (once per process) for these templates. Safe to call on every rerun."""
+        if not self.enabled():
+            return
+        with self._lock:
+            for template_id in template_ids:
+                if template_id:
+                    self._ready.setdefault(template_id, collections.deque())
+            self._get_credentials = get_credentials
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="template-pool", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        thread, self._thread = self._thread, None
+        if thread:
+            thread.join()
+
+    def take(self, template_id):
+        """A ready (document ID, version) for this template, or None. Wakes the maintainer to refill."""
+        with self._lock:
+            ready = self._ready.get(template_id)
+            staged = ready.popleft() if ready else None
+            if staged is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._wake.set()
+        return staged
+
+    def give_back(self, template_id, staged):
+        with self._lock:
+            if staged[1] == self._versions.get(template_id):
+                self._ready.setdefault(template_id, collections.deque()).appendleft(staged)
+                return
+        # The template changed meanwhile - nobody wants this one
+        _pool.submit(self._delete, staged[0])
+
+    def stats(self):
+        with self._lock:
+            ready = {template_id: len(docs) for template_id, docs in self._ready.items()}
+        return {"ready": ready, "size": self.size, "hits": self.hits, "misses": self.misses}
+
+    # --- MAINTAINER (daemon thread) ---
+    def _drive(self):
+        return resilience.build_service('drive', 'v3', self._get_credentials())
+
+    def _delete(self, document_id):
+        try:
+            delete_file(self._drive(), document_id)
+        except Exception as e:
+            log.warning("Could not remove staged copy", document_id=document_id, error=e)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                drive_service = self._drive()
+                for template_id in list(self._ready):
+                    self._check_version(drive_service, template_id)
+                if not self._adopted:
+                    self._adopt(drive_service)
+                    self._adopted = True
+                for template_id in list(self._ready):
+                    self._refill(drive_service, template_id)
+            except Exception as e:
+                log.warning("Template pool refill failed", error=e)
+            self._wake.wait(self.check_seconds)
+            self._wake.clear()
+
+    def _check_version(self, drive_service, template_id):
+        # A refill after every claim must not mean a Drive read after every claim
+        if time.monotonic() - self._checked.get(template_id, float("-inf")) < self.check_seconds:
+            return
+        meta = resilience.execute(drive_service.files().get(fileId=template_id, fields='version,name', supportsAllDrives=True), "drive")
+        version = str(meta.get('version'))
+        self._checked[template_id] = time.monotonic()
+        with self._lock:
+            self._names[template_id] = meta.get('name') or template_id
+            if self._versions.get(template_id) == version:
+                return
+            self._versions[template_id] = version
+            ready = self._ready[template_id]
+            stale = [doc for doc in ready if doc[1] != version]
+            self._ready[template_id] = collections.deque(doc for doc in ready if doc[1] == version)
+        if stale:
+            log.info("Template changed - replacing staged copies", template_id=template_id, stale=len(stale))
+        for document_id, _ in stale:
+            delete_file(drive_service, document_id)
+
+    def _adopt(self, drive_service):
+        """Copies staged by an earlier run of the app: kept if still current, otherwise deleted."""
+        query = f"'{self.staging_folder_id}' in parents and trashed = false"
+        page_token = None
+        while True:
+            listing = resilience.execute(drive_service.files().list(
+                q=query, fields="nextPageToken, files(id, appProperties)", pageToken=page_token,
+                supportsAllDrives=True, includeItemsFromAllDrives=True), "drive")
+            for item in listing.get('files', []):
+                props = item.get('appProperties') or {}
+                template_id, version = props.get('pool_template'), props.get('pool_version')
+                with self._lock:
+                    keep = (template_id in self._ready and version == self._versions.get(template_id)
+                            and len(self._ready[template_id]) < self.size)
+                    if keep:
+                        self._ready[template_id].append((item['id'], version))
+                if not keep:
+                    delete_file(drive_service, item['id'])
+            page_token = listing.get('nextPageToken')
+            if not page_token:
+                break
+
+    def _refill(self, drive_service, template_id):
+        while not self._stop.is_set():
+            with self._lock:
+                version = self._versions.get(template_id)
+                if version is None or len(self._ready[template_id]) >= self.size:
+                    return
+                name = f"{STAGED_PREFIX}{self._names.get(template_id, template_id)}"
+            document_id = copy_template(drive_service, template_id, self.staging_folder_id, name,
+                                        properties={'pool_template': template_id, 'pool_version': version})
+            with self._lock:
+                current = version == self._versions.get(template_id)
+                if current:
+                    self._ready[template_id].append((document_id, version))
+            if not current:
+                delete_file(drive_service, document_id)
+
+
+pool = WarmPool()
+
+
+def warm_up(template_ids, get_credentials):
+    """Starts the warm pool maintainer for these department templates (no-op without a staging folder)."""
+    pool.start(template_ids, get_credentials)
+
+
+_swept = set()
+_swept_lock = threading.Lock()
+
+
+def _sweep_folder(drive_service, folder_id, max_age):
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=max_age)
+    query = (f"'{folder_id}' in parents and trashed = false and createdTime < '{cutoff.strftime('%Y-%m-%dT%H:%M:%S')}' "
+             f"and (appProperties has {{ key='{TEMP_PROPERTY}' and value='1' }} or name contains 'In progress')")
+    removed = 0
+    page_token = None
+    while True:
+        listing = resilience.execute(drive_service.files().list(
+            q=query, fields="nextPageToken, files(id, name, appProperties)", pageToken=page_token,
+            supportsAllDrives=True, includeItemsFromAllDrives=True), "drive")
+        for item in listing.get('files', []):
+            props = item.get('appProperties') or {}
+            # 'contains' matches words anywhere - only our own prefix counts
+            if props.get(TEMP_PROPERTY) == "1" or (item.get('name') or "").startswith(TEMP_PREFIX):
+                delete_file(drive_service, item['id'])
+                removed += 1
+        page_token = listing.get('nextPageToken')
+        if not page_token:
+            break
+    if removed:
+        log.info("Removed leftover template copies", folder_id=folder_id, removed=removed)
+
+
+def _sweep(folder_ids, get_credentials, max_age):
+    try:
+        drive_service = resilience.build_service('drive', 'v3', get_credentials())
+        for folder_id in folder_ids:
+            _sweep_folder(drive_service, folder_id, max_age)
+    except Exception as e:
+        log.warning("Leftover template sweep failed", error=e)
+
+
+def sweep_leftovers(folder_ids, get_credentials, max_age=LEFTOVER_HOURS * 3600):
+    """Deletes temporary copies a restart left behind in these output folders (once per process, in the background)."""
+    with _swept_lock:
+        folder_ids = [f for f in dict.fromkeys(folder_ids) if f and f not in _swept]
+        _swept.update(folder_ids)
+    if folder_ids:
+        _pool.submit(_sweep, folder_ids, get_credentials, max_age)
+
+
+def start_copy(credentials, template_id, folder_id):
+    """The template copy for a new case: a ready one from the warm pool, else one started now. Returns a TemplateCopy."""
+    staged = pool.take(template_id) if pool.enabled() else None
+    if staged is not None:
+        return TemplateCopy(credentials, template_id, folder_id, staged=staged)
+    return TemplateCopy(credentials, template_id, folder_id, speculative=SPECULATIVE)
@@ -0,0 +1,155 @@
+import os
+import time
+import threading
+import datetime
+
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# SHARED GOOGLE CREDENTIAL CACHE (Used by Medicine, Surgery and OBGYN backends)
+# ==============================================================================
+# token.json is read ONCE per process. After that every caller gets the same
+# in-memory Credentials object, and a background timer refreshes it a few
+# minutes BEFORE it expires, so no case ever waits on disk I/O or a refresh.
+
+SCOPES = ['https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/drive']
+TOKEN_FILE = 'token.json'
+
+REFRESH_MARGIN = 300      # Refresh 5 minutes before the access token expires
+REFRESH_RETRY_DELAY = 30  # If a background refresh fails, try again after 30 seconds
+LOAD_ATTEMPTS = 5         # token.json may still be in the middle of being written
+
+
+class CredentialHolder:
+    """Loads token.json once and keeps the access token fresh in the background."""
+
+    def __init__(self, token_file=TOKEN_FILE, scopes=SCOPES, refresh_margin=REFRESH_MARGIN):
+        self.token_file = token_file
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self._creds = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def get(self, client_secret_file=None):
+        """Returns current credentials. Only the very first call touches the disk."""
+        creds = self._creds
+        if creds is not None and not self._needs_refresh(creds):
+            return creds
+
+        with self._lock:
+            if self._creds is None:
+                self._creds = self._load(client_secret_file)
+            elif self._needs_refresh(self._creds):
+                # The timer missed (e.g. machine slept) - refresh inline this once
+                self._creds.refresh(Request())
+            self._schedule_refresh()
+            return self._creds
+
+    def reset(self):
+        """Forgets the cached token (next get() reloads token.json)."""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = None
+            self._creds = None
+
+    # --- INTERNALS ---
+    def _needs_refresh(self, creds):
+        # 'valid' is False once the token is expired (google-auth adds its own clock skew)
+        return not creds.valid
+
+    def _load(self, client_secret_file):
+        # --- PHASE 1: RETRY LOOP (only ever runs once per process) ---
+        for attempt in range(LOAD_ATTEMPTS):
+            if os.path.exists(self.token_file):
+                try:
+                    creds = Credentials.from_authorized_user_file(self.token_file, self.scopes)
+                    if creds and creds.valid:
+                        return creds
+                    if creds and creds.expired and creds.refresh_token:
+                        creds.refresh(Request())
+                        return creds
+                except Exception as e:
+                    log.warning("Token file read failed - retrying", attempt=attempt + 1, token_file=self.token_file, error=e)
+            else:
+                log.warning("Token file not found yet - retrying", attempt=attempt + 1, token_file=self.token_file)
+
+            if attempt < LOAD_ATTEMPTS - 1:
+                time.sleep(1)
+
+        # --- PHASE 2: LOCAL BROWSER LOGIN (never on Streamlit Cloud) ---
+        if client_secret_file and os.path.exists(client_secret_file):
+            log.info("Launching browser for local login")
+            flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, self.scopes)
+            creds = flow.run_local_server(port=0)
+
+            with open(self.token_file, 'w') as token:
+                token.write(creds.to_json())
+            return creds
+
+        raise Exception(f"CRITICAL ERROR: Could not load '{self.token_file}' after {LOAD_ATTEMPTS} attempts. The Google Token in Secrets is missing or invalid.")
+
+    def _schedule_refresh(self, delay=None):
+        # Caller must hold self._lock
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        creds = self._creds
+        if creds is None or not creds.refresh_token:
+            return
+
+        if delay is None:
+            if creds.expiry is None:
+                return
+            remaining = (creds.expiry - datetime.datetime.utcnow()).total_seconds()
+            delay = max(remaining - self.refresh_margin, REFRESH_RETRY_DELAY)
+
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            if self._creds is None:
+                return
+            try:
+                self._creds.refresh(Request())
+                log.info("Google token refreshed in background")
+                self._schedule_refresh()
+            except Exception as e:
+                log.warning("Background token refresh failed", error=e)
+                self._schedule_refresh(delay=REFRESH_RETRY_DELAY)
+
+
+# One holder per process, shared by j.py, j_surgery.py and obs.py
+_holder = CredentialHolder()
+
+
+def get_credentials(client_secret_file=None):
+    return _holder.get(client_secret_file)
+
+
+def warm_up(client_secret_file=None):
+    """Loads the token on a daemon thread so the first case doesn't pay for it."""
+    if _holder._creds is not None:
+        return
+
+    def _load():
+        try:
+            _holder.get(client_secret_file)
+        except Exception as e:
+            log.warning("Token warm-up failed", error=e)
+
+    threading.Thread(target=_load, daemon=True).start()
+
+
+def reset():
+    _holder.reset()
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import random
+import inspect
+import tempfile
+import threading
+import functools
+import contextlib
+import contextvars
+
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# TRACING (Spans around every external call - off unless TRACING is set)
+# ==============================================================================
+# One trace per case. The root span "case" carries department, model, page
+# count and image bytes; under it:
+#   - get_user_credentials
+#   - gemini.generate_content / generate_content_async (model, retries)
+#   - every Drive / Docs .execute(), named by its API method (drive.files.copy,
+#     docs.documents.batchUpdate, ...)
+#   - encode_page (JPEG encoding for the image backup, with the bytes written)
+#   - fill_smart_grid (anchor, number of dates)
+# Spans follow the case onto pool threads and async tasks (contextvars), so
+# the transcription calls and the template copy land in the same trace.
+#
+#   TRACING unset  : no-op - span() hands back one shared do-nothing object
+#   TRACING=file   : one JSON line per finished span in TRACE_FILE
+#                    (OTLP-shaped field names, nothing else to install)
+#   TRACING=otlp   : OpenTelemetry SDK + OTLP/HTTP exporter (needs
+#                    opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http;
+#                    endpoint from OTEL_EXPORTER_OTLP_ENDPOINT, default localhost:4318)
+#
+# Attributes never include patient data - names, field values and prompts stay out.
+
+TRACING = os.getenv("TRACING", "").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(tempfile.gettempdir(), "scribe_traces.jsonl"))
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "medical-scribe")
+
+
+def _clean(attributes):
+    """Drops None values; anything that isn't a str / bool / int / float becomes a str."""
+    return {k: v if isinstance(v, (str, bool, int, float)) else str(v) for k, v in attributes.items() if v is not None}
+
+
+def image_bytes(image_list):
+    """Decoded size of the pages (width x height x bands; a typed page counts its characters)."""
+    total = 0
+    for page in image_list:
+        if isinstance(page, str):
+            total += len(page)
+        else:
+            total += page.width * page.height * len(page.getbands())
+    return total
+
+
+# --- NO-OP (the default) ---
+class _NoopSpan:
+    """Stands in for a span when tracing is off: a reusable context manager that records nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+# --- TRACING=file ---
+class Span:
+    def __init__(self, name, attributes, parent):
+        self.name = name
+        self.attributes = _clean(attributes)
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent.span_id if parent else None
+        self.start = time.time_ns()
+        self.end = None
+        self.status = "OK"
+
+    def set(self, **attributes):
+        self.attributes.update(_clean(attributes))
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start,
+            "end_time_unix_nano": self.end,
+            "duration_ms": round((self.end - self.start) / 1e6, 1),
+            "status": self.status,
+            "attributes": self.attributes,
+            "resource": {"service.name": SERVICE_NAME},
+        }
+
+
+class FileExporter:
+    """Appends finished spans to a JSON-lines file (one span per line)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def export(self, span):
+        line = json.dumps(span.to_json(), ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            self._file.write(line + "\n")
+
+
+_current = contextvars.ContextVar("current_span", default=None)
+_exporter = None
+
+
+@contextlib.contextmanager
+def _file_span(name, attributes):
+    span = Span(name, attributes, _current.get())
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "ERROR"
+        span.set(**{"error.type": type(e).__name__})
+        raise
+    finally:
+        _current.reset(token)
+        span.end = time.time_ns()
+        _exporter.export(span)
+
+
+# --- TRACING=otlp ---
+_tracer = None
+_otel_trace = None
+
+
+class _OtelSpan:
+    def __init__(self, span):
+        self._span = span
+
+    def set(self, **attributes):
+        self._span.set_attributes(_clean(attributes))
+
+
+@contextlib.contextmanager
+def _otel_span(name, attributes):
+    # The SDK records the exception and sets the ERROR status itself
+    with _tracer.start_as_current_span(name, attributes=_clean(attributes)) as span:
+        try:
+            yield _OtelSpan(span)
+        except BaseException as e:
+            span.set_attribute("error.type", type(e).__name__)
+            raise
+
+
+def _setup_otlp():
+    global _tracer, _otel_trace
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        log.warning("TRACING=otlp needs 'opentelemetry-sdk' and 'opentelemetry-exporter-otlp-proto-http' - tracing is off")
+        return False
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _otel_trace = trace
+    _tracer = trace.get_tracer(SERVICE_NAME)
+    return True
+
+
+if TRACING == "otlp":
+    ENABLED = _setup_otlp()
+elif TRACING == "file":
+    _exporter = FileExporter(TRACE_FILE)
+    ENABLED = True
+else:
+    ENABLED = False
+
+
+# --- PUBLIC API ---
+def enabled():
+    return ENABLED
+
+
+def span(name, **attributes):
+    """Context manager for one span (child of the current one). 'with span(...) as s: s.set(key=value)'."""
+    if not ENABLED:
+        return _NOOP
+    if _tracer is not None:
+        return _otel_span(name, attributes)
+    return _file_span(name, attributes)
+
+
+def current():
+    """The span this code runs in (a no-op span if there is none), to add attributes to it."""
+    if not ENABLED:
+        return _NOOP
+    if _tracer is not None:
+        otel_span = _otel_trace.get_current_span()
+        return _OtelSpan(otel_span) if otel_span.is_recording() else _NOOP
+    return _current.get() or _NOOP
+
+
+def traced(name, **attributes):
+    """Decorator: the whole call (sync or async) is one span. The function is returned untouched when tracing is off."""
+    def wrap(fn):
+        if not ENABLED:
+            return fn
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def run_async(*args, **kwargs):
+                with span(name, **attributes):
+                    return await fn(*args, **kwargs)
+            return run_async
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with span(name, **attributes):
+                return fn(*args, **kwargs)
+        return run
+    return wrap
@@ -0,0 +1,206 @@
+import os
+import weakref
+import asyncio
+import contextvars
+import concurrent.futures
+
+import resilience   # Shared timeouts, retry/backoff and circuit breaker for Google calls
+import rate_limit   # Process-wide token buckets for Gemini / Drive / Docs quotas
+from page_cache import page_cache, page_key
+from preprocess import TextPage
+import structured_log
+
+log = structured_log.get_logger(__name__)
+
+# ==============================================================================
+# TWO-STAGE PIPELINE (Pages transcribed in parallel, then one text-only call)
+# ==============================================================================
+# In two-stage mode a case runs in two steps:
+#   1. every page is transcribed on its own (verbatim text, lab tables as
+#      dated lines), all pages at once on a shared thread pool - unless the
+#      page cache already has it from an earlier upload (any session, same
+#      process: the very same image, see page_cache.py)
+#   2. the department prompt runs once on the stitched transcripts (text only)
+# Wall time is roughly the slowest page plus one text call, instead of one
+# long call that reads every image. Day 3 of an admission with 10 old pages
+# and 2 new ones costs two page calls plus the text call.
+#
+# Chosen per case in the app ("Two-stage"); PAGE_CACHE=1 makes it the default.
+# Off by default: the single multimodal call is what the prompts were tuned on.
+
+ENABLED = os.getenv("PAGE_CACHE") == "1"
+
+# Page calls of ALL cases share this pool, so 4 cases x 20 pages never means 80 threads
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "8"))
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS, thread_name_prefix="transcribe")
+# The same cap for cases on the event loop (pipeline_async.py), one semaphore per loop
+_slots = weakref.WeakKeyDictionary()
+
+INR_PER_USD = 87  # Same rate as log_usage() in the backends
+
+PAGE_PROMPT = """
+    You are an expert Medical Scribe. Transcribe this ONE page of handwritten inpatient notes.
+
+    - Transcribe VERBATIM, line by line, in reading order. Do NOT summarise or interpret.
+    - Keep every date, dose, frequency, vital sign and number exactly as written.
+    - Lab values: write one line per test as "DATE | TEST: VALUE" (keep the date of each column/entry).
+    - Tables: one row per line, cells separated by " | ".
+    - If a word is unreadable write [illegible]. If the page is blank write [BLANK PAGE].
+    - Return PLAIN TEXT only.
+    """
+
+TRANSCRIPT_NOTE = (
+    "NOTE: Instead of the images, you are given VERBATIM TRANSCRIPTS of the {pages} pages, "
+    "one block per page in the original order. Apply every rule above to this text."
+)
+
+
+def enabled(two_stage=None):
+    """Whether this case runs two-stage (the per-case choice wins over the PAGE_CACHE default)."""
+    return ENABLED if two_stage is None else bool(two_stage)
+
+
+class PageTranscripts:
+    """Transcripts of one upload, in page order, plus what they cost."""
+
+    def __init__(self, texts, new_pages, cost, log):
+        self.texts = texts
+        self.new_pages = new_pages
+        self.cached_pages = len(texts) - new_pages
+        self.cost = cost  # Rupees, for the page calls only
+        self.log = log
+
+    def prompt_parts(self):
+        """What replaces the images in the department prompt."""
+        parts = [TRANSCRIPT_NOTE.format(pages=len(self.texts))]
+        parts.extend(f"=== PAGE {i + 1} ===\n{text}" for i, text in enumerate(self.texts))
+        return parts
+
+    def total_cost(self, response, model_name, pricing):
+        """Cost display for the whole case: the page calls plus the final text-only call."""
+        return f"₹{self.cost + call_cost(response, model_name, pricing):.2f}"
+
+
+def call_cost(response, model_name, pricing):
+    """Rupee cost of one Gemini response (0 if the usage is unknown)."""
+    try:
+        usage = response.usage_metadata
+        rates = pricing.get(model_name, {"input": 0, "output": 0})
+        usd = (usage.prompt_token_count / 1_000_000) * rates["input"] + (usage.candidates_token_count / 1_000_000) * rates["output"]
+        return usd * INR_PER_USD
+    except Exception:
+        return 0.0
+
+
+def transcribe_page(model, model_name, image, rate_limits):
+    """One Gemini call for one page. Returns (response, seconds queued for quota, retries included)."""
+    prompt_content = [PAGE_PROMPT, image]
+    est_tokens = rate_limit.estimate_input_tokens(prompt_content)
+    waits = []
+    response = resilience.call(model.generate_content, "gemini", prompt_content, request_options=resilience.gemini_request_options(),
+                               before_attempt=lambda: waits.append(rate_limit.wait_for_gemini(model_name, est_tokens, rate_limits)))
+    rate_limit.settle_gemini_tokens(model_name, est_tokens, getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None), rate_limits)
+    return response, sum(waits)
+
+
+async def transcribe_page_async(model, model_name, image, rate_limits):
+    """transcribe_page() for the event loop (generate_content_async)."""
+    slots = _slots.get(asyncio.get_running_loop())
+    if slots is None:
+        slots = _slots[asyncio.get_running_loop()] = asyncio.Semaphore(TRANSCRIBE_WORKERS)
+    async with slots:
+        prompt_content = [PAGE_PROMPT, image]
+        est_tokens = rate_limit.estimate_input_tokens(prompt_content)
+        waits = []
+
+        async def queue():
+            waits.append(await rate_limit.wait_for_gemini_async(model_name, est_tokens, rate_limits))
+
+        response = await resilience.call_async(model.generate_content_async, "gemini", prompt_content, request_options=resilience.gemini_request_options(),
+                                               before_attempt=queue)
+        rate_limit.settle_gemini_tokens(model_name, est_tokens, getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None), rate_limits)
+        return response, sum(waits)
+
+
+def _known_pages(model_name, image_list):
+    """(cache kind, key per page, {key: text} for typed and cached pages)."""
+    kind = f"transcript:{model_name}"  # A Flash transcript is never reused for a Pro run
+    # A typed PDF page already is its transcript (its key is the text itself, never a bytes digest)
+    keys = [image if isinstance(image, TextPage) else page_key(image) for image in image_list]
+
+    texts = {key: key for key in keys if isinstance(key, TextPage)}
+    for key in keys:
+        if key not in texts:
+            cached = page_cache.get(kind, key)
+            if cached is not None:
+                texts[key] = cached
+    return kind, keys, texts
+
+
+def _new_pages(image_list, keys, texts):
+    """{key: image} for every page that needs a call (a pixel-identical page uploaded twice is sent once)."""
+    pending = {}
+    for image, key in zip(image_list, keys):
+        if key not in texts and key not in pending:
+            pending[key] = image
+    return pending
+
+
+def _store(kind, key, response, texts, model_name, pricing):
+    text = response.text.strip()
+    texts[key] = text
+    page_cache.put(kind, key, text)
+    return call_cost(response, model_name, pricing)
+
+
+def _transcripts(keys, texts, new_pages, cost):
+    cost_log = ""
+    if new_pages:
+        cost_log = f"Page transcription: {new_pages} new page(s), ₹{cost:.2f}\n"
+    typed = sum(isinstance(key, TextPage) for key in keys)
+    log.info("Pages transcribed", transcribed=new_pages, cached=len(keys) - new_pages - typed, typed=typed)
+    return PageTranscripts([texts[key] for key in keys], new_pages, cost, cost_log)
+
+
+def transcribe_pages(model, model_name, image_list, rate_limits, pricing):
+    """Transcripts for every page, from the page cache where possible. Returns PageTranscripts."""
+    kind, keys, texts = _known_pages(model_name, image_list)
+
+    # One call per NEW page, all at once - in a copy of the caller's context, so per-case state follows the page onto the pool
+    pending = {key: _pool.submit(contextvars.copy_context().run, transcribe_page, model, model_name, image, rate_limits)
+               for key, image in _new_pages(image_list, keys, texts).items()}
+
+    cost = 0.0
+    queued = 0.0
+    try:
+        for key, future in pending.items():
+            response, wait = future.result()
+            cost += _store(kind, key, response, texts, model_name, pricing)
+            queued = max(queued, wait)  # Parallel waits overlap - the case waited for the longest
+    finally:
+        for future in pending.values():
+            future.cancel()  # One page failed: don't start the ones still queued
+    rate_limit.add_wait(queued)
+    return _transcripts(keys, texts, len(pending), cost)
+
+
+async def transcribe_pages_async(model, model_name, image_list, rate_limits, pricing):
+    """transcribe_pages() for the event loop: every new page is a task, capped at TRANSCRIBE_WORKERS."""
+    # Hashing every page's pixels and the cache lock are off the loop - other cases keep running
+    kind, keys, texts = await asyncio.to_thread(_known_pages, model_name, image_list)
+    pending = {key: asyncio.ensure_future(transcribe_page_async(model, model_name, image, rate_limits))
+               for key, image in _new_pages(image_list, keys, texts).items()}
+
+    cost = 0.0
+    queued = 0.0
+    try:
+        for key, task in pending.items():
+            response, wait = await task
+            cost += await asyncio.to_thread(_store, kind, key, response, texts, model_name, pricing)
+            queued = max(queued, wait)
+    finally:
+        for task in pending.values():
+            task.cancel()
+    rate_limit.add_wait(queued)
+    return _transcripts(keys, texts, len(pending), cost)
+